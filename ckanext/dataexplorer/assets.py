@@ -0,0 +1,155 @@
+# encoding: utf-8
+'''
+Delivery of the built dataexplorer bundles. Bundle names carry the hash of
+their content, so they are sent with a long lived ``immutable``
+Cache-Control, other files keeping the CKAN one, and with their gzip or
+brotli variant when one was built next to them by ``ckan dataexplorer
+compress-assets`` and the browser accepts it.
+'''
+import gzip
+import hashlib
+import io
+import os
+import re
+import shutil
+
+from flask import send_file
+
+from ckan.common import config
+import ckan.plugins.toolkit as toolkit
+
+URL_PREFIX = '/webassets/dataexplorer/'
+COMPRESSIBLE = ('.js', '.css')
+# Content-Encoding, file suffix, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+MIMETYPES = {'.js': 'application/javascript', '.css': 'text/css'}
+# the content hash of webassets outputs (<hash>_dataexplorer.js) and of
+# webpack chunks (main.<hash>.chunk.js)
+FINGERPRINT = re.compile(r'(^|\.)[0-9a-f]{8,}[._]')
+
+_asset_version = None
+
+
+def assets_directory():
+    '''
+    Return the directory ``ckan asset build`` writes the dataexplorer
+    bundles to.
+    '''
+    root = config.get('ckan.webassets.path') or os.path.join(
+        config.get('ckan.storage_path') or '', 'webassets')
+    return os.path.join(root, 'dataexplorer')
+
+
+def asset_version():
+    '''
+    Return a digest of the names of the built bundles, which carry the hash
+    of their content, so that it changes when new bundles are deployed.
+    '''
+    global _asset_version
+    if _asset_version is None:
+        try:
+            names = sorted(os.listdir(assets_directory()))
+        except OSError:
+            names = []
+        _asset_version = hashlib.sha1(
+            u'\n'.join(names).encode('utf-8')).hexdigest()
+    return _asset_version
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def compress_assets(directory=None):
+    '''
+    Write the gzip (and, with the brotli package, brotli) variants of the
+    built bundles that do not have an up to date one, and return their
+    paths.
+    '''
+    directory = directory or assets_directory()
+    brotli = _brotli()
+    written = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.endswith(COMPRESSIBLE) or not os.path.isfile(path):
+            continue
+        mtime = os.path.getmtime(path)
+        for encoding, suffix in ENCODINGS:
+            target = path + suffix
+            if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                continue
+            if encoding == 'br':
+                if brotli is None:
+                    continue
+                with io.open(path, 'rb') as f:
+                    data = brotli.compress(f.read(),
+                                           mode=brotli.MODE_TEXT)
+                with io.open(target + '.tmp', 'wb') as f:
+                    f.write(data)
+            else:
+                with io.open(path, 'rb') as f:
+                    with gzip.GzipFile(target + '.tmp', 'wb', 9) as out:
+                        shutil.copyfileobj(f, out)
+            os.rename(target + '.tmp', target)
+            written.append(target)
+    return written
+
+
+def _max_age():
+    return toolkit.asint(config.get(
+        'ckanext.dataexplorer.assets.max_age', 31536000))
+
+
+def fingerprinted(name):
+    '''
+    Return whether the file name of a bundle carries the hash of its
+    content, so that its content never changes.
+    '''
+    return bool(FINGERPRINT.search(name.rsplit(u'/', 1)[-1]))
+
+
+def serve_precompressed():
+    '''
+    ``before_request`` hook sending the precompressed variant of a
+    dataexplorer bundle the browser accepts, None to let CKAN serve the
+    original.
+    '''
+    request = toolkit.request
+    if not request.path.startswith(URL_PREFIX):
+        return None
+    name = request.path[len(URL_PREFIX):]
+    extension = os.path.splitext(name)[1]
+    if extension not in COMPRESSIBLE or u'/' in name or \
+            name.startswith(u'.'):
+        return None
+    accepted = request.headers.get('Accept-Encoding', '')
+    path = os.path.join(assets_directory(), name)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.isfile(path + suffix):
+            response = send_file(path + suffix,
+                                 mimetype=MIMETYPES[extension],
+                                 conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            response.headers['Vary'] = 'Accept-Encoding'
+            if fingerprinted(name):
+                response.headers['Cache-Control'] = \
+                    'public, max-age={0}, immutable'.format(_max_age())
+            return response
+    return None
+
+
+def set_cache_headers(response):
+    '''
+    ``after_request`` hook marking the fingerprinted dataexplorer bundles
+    immutable.
+    '''
+    path = toolkit.request.path
+    if path.startswith(URL_PREFIX) and response.status_code == 200 and \
+            fingerprinted(path):
+        response.headers['Cache-Control'] = \
+            'public, max-age={0}, immutable'.format(_max_age())
+    return response
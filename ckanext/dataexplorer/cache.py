@@ -0,0 +1,252 @@
+# encoding: utf-8
+'''
+Process wide caches shared by the dataexplorer views and actions.
+'''
+import io
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from ckan.common import config
+
+_missing = object()
+
+
+class LRUCache(object):
+    '''
+    Thread safe least recently used cache whose entries also expire after
+    ``ttl`` seconds. Hit and miss counters are kept and reported by
+    ``stats()``.
+
+    :param maxsize: maximum number of entries kept, 0 disables the cache
+    :type maxsize: int
+    :param ttl: seconds an entry stays valid, 0 means no expiry
+    :type ttl: int
+    '''
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, maxsize=None, ttl=None):
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._data.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is not _missing:
+                expires, value = entry
+                if not expires or expires > time.time():
+                    # re-insert to mark the key as most recently used
+                    self._data[key] = self._data.pop(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            expires = time.time() + self.ttl if self.ttl else 0
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate):
+        '''
+        Drop every entry whose key matches ``predicate``.
+        '''
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Runs at most one call per key at a time: callers asking for a key while
+    its call is in flight wait for it and share its result (or exception).
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls), 'calls': self.calls,
+                    'coalesced': self.coalesced}
+
+
+class FileCache(object):
+    '''
+    Cache of text values stored as files in the on-disk cache directory,
+    shared by all the CKAN processes of a host. Keys must be safe file
+    names, such as hex digests.
+    '''
+
+    def __init__(self, name, ttl=300):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(cache_directory(self.name), key)
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            expires = os.path.getmtime(path) + self.ttl
+            if not self.ttl or expires > time.time():
+                with io.open(path, encoding='utf-8') as f:
+                    value = f.read()
+                self.hits += 1
+                return value
+        except (IOError, OSError):
+            pass
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.rename(tmp, path)
+
+    def stats(self):
+        return {'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+class RedisCache(object):
+    '''
+    Cache of text values stored in the CKAN Redis database, shared by all
+    the CKAN processes.
+    '''
+
+    def __init__(self, prefix, ttl=300):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _redis(self):
+        from ckan.lib.redis import connect_to_redis
+        return connect_to_redis()
+
+    def get(self, key, default=None):
+        value = self._redis().get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value):
+        if self.ttl:
+            self._redis().setex(self.prefix + key, self.ttl, value)
+        else:
+            self._redis().set(self.prefix + key, value)
+
+    def stats(self):
+        return {'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+def make_cache(name, backend, maxsize=1000, ttl=300):
+    '''
+    Return a cache using ``backend``: ``memory`` (per process LRU),
+    ``file`` (on-disk cache directory), ``redis`` (CKAN Redis) or ``none``.
+    '''
+    if backend == 'file':
+        return FileCache(name, ttl)
+    if backend == 'redis':
+        return RedisCache(
+            '{0}:dataexplorer:{1}:'.format(config.get('ckan.site_id'), name),
+            ttl)
+    if backend == 'none':
+        return LRUCache(0, ttl)
+    if backend != 'memory':
+        raise ValueError('Unknown cache backend {0!r}'.format(backend))
+    return LRUCache(maxsize, ttl)
+
+
+def cache_directory(*parts):
+    '''
+    Return (and create) a directory for on-disk caches, under
+    ``ckanext.dataexplorer.cache_dir`` or ``<ckan.storage_path>/dataexplorer``.
+    '''
+    root = config.get('ckanext.dataexplorer.cache_dir') or os.path.join(
+        config.get('ckan.storage_path') or tempfile.gettempdir(),
+        'dataexplorer')
+    path = os.path.join(root, *parts)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
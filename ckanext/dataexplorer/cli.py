@@ -0,0 +1,292 @@
+# encoding: utf-8
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+from flask import current_app
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import (
+    assets, db, fulltext, geoindex, indexes, profile, warm)
+from ckanext.dataexplorer.tableschema import request_schema_by_id
+
+
+def _site_context():
+    site_user = toolkit.get_action('get_site_user')(
+        {'ignore_auth': True}, {})
+    return {'ignore_auth': True, 'user': site_user['name']}
+
+
+@click.group(short_help=u'Data Explorer commands')
+def dataexplorer():
+    pass
+
+
+@dataexplorer.command(u'map-index')
+@click.argument(u'resource_ids', nargs=-1)
+def map_index(resource_ids):
+    u'''Index the coordinate fields used by dataexplorer map views.
+
+    Creates a (latitude, longitude) index on the DataStore table of every
+    resource with a lat/long map view, and a bounding box index on the
+    GeoJSON field of every geometry map view, or of the RESOURCE_IDS given.
+    '''
+    context = _site_context()
+    wanted = {}
+    geometry_fields = {}
+    for view in indexes.dataexplorer_views(resource_ids,
+                                           ['dataexplorer_map_view']):
+        config = view.config or {}
+        lat = config.get('latitude_field')
+        lon = config.get('longitude_field')
+        if config.get('map_field_type') == 'lat_long' and lat and lon:
+            wanted.setdefault(view.resource_id, []).append([lat, lon])
+        geometry_fields.setdefault(view.resource_id, set()).update(
+            indexes.view_geometry_fields(view.view_type, config))
+    for resource_id in sorted(set(wanted) | set(geometry_fields)):
+        try:
+            created = indexes.create_indexes(
+                context, resource_id, wanted.get(resource_id, []))
+        except (toolkit.ObjectNotFound, toolkit.ValidationError) as e:
+            click.secho(u'{0}: {1}'.format(resource_id, e), fg=u'red')
+            continue
+        created.extend([u'bbox({0})'.format(f)] for f in
+                       geoindex.index_resource(resource_id, sorted(
+                           geometry_fields.get(resource_id, ()))))
+        click.echo(u'{0}: {1}'.format(
+            resource_id,
+            u'created ' + u'; '.join(u', '.join(f) for f in created)
+            if created else u'up to date'))
+
+
+@dataexplorer.command(u'profile')
+@click.argument(u'resource_ids', nargs=-1)
+@click.option(u'--now', is_flag=True,
+              help=u'Profile in this process instead of queueing jobs')
+def profile_command(resource_ids, now):
+    u'''Compute the column profiles of DataStore resources.
+
+    Queues a background job profiling every DataStore table, or the
+    RESOURCE_IDS given. Resources already profiled at their current
+    revision are skipped by the job.
+    '''
+    for resource_id in resource_ids or db.datastore_tables():
+        if not now:
+            profile.enqueue_profile(resource_id)
+            click.echo(u'{0}: queued'.format(resource_id))
+            continue
+        try:
+            result = profile.profile_resource(resource_id)
+        except toolkit.ObjectNotFound as e:
+            click.secho(u'{0}: {1}'.format(resource_id, e), fg=u'red')
+            continue
+        click.echo(u'{0}: {1}'.format(
+            resource_id, u'{0} rows'.format(result['rows'])
+            if result else u'no DataStore table'))
+
+
+@dataexplorer.command(u'index-report')
+@click.argument(u'resource_ids', nargs=-1)
+@click.option(u'--create', is_flag=True,
+              help=u'Create the missing indexes')
+@click.option(u'--min-cost', type=float, default=10000.0, show_default=True,
+              help=u'Planner cost above which a view query is reported slow')
+def index_report(resource_ids, create, min_cost):
+    u'''Report the indexes dataexplorer views are missing.
+
+    Checks the filter, group, coordinate and sort fields of every
+    dataexplorer view, or of the views of the RESOURCE_IDS given, against
+    the indexes of their DataStore table and flags the views whose query
+    the planner runs with a sequential scan above --min-cost.
+    '''
+    context = _site_context() if create else None
+    by_resource = {}
+    for view in indexes.dataexplorer_views(resource_ids):
+        by_resource.setdefault(view.resource_id, []).append(view)
+    for resource_id, views in sorted(by_resource.items()):
+        try:
+            report = indexes.advise(
+                resource_id, views, request_schema_by_id(resource_id))
+        except (toolkit.ObjectNotFound, toolkit.ValidationError) as e:
+            click.secho(u'{0}: {1}'.format(resource_id, e), fg=u'red')
+            continue
+        click.echo(resource_id)
+        missing = []
+        bbox_missing = []
+        for entry in report:
+            plan = entry.get('plan') or {}
+            slow = plan.get('seq_scan') and plan['cost'] >= min_cost
+            click.secho(u'  {0} {1} ({2}){3}'.format(
+                entry['view_id'], entry['title'], entry['view_type'],
+                u' slow: seq scan, cost {0:.0f}'.format(plan['cost'])
+                if slow else u''), fg=u'yellow' if slow else None)
+            if 'error' in entry:
+                click.secho(u'    invalid config: {0}'.format(
+                    entry['error']), fg=u'red')
+            for fields in entry['missing']:
+                click.echo(u'    missing index: {0}'.format(
+                    u', '.join(fields)))
+                if fields not in missing:
+                    missing.append(fields)
+            for field in entry['bbox_missing']:
+                click.echo(u'    missing bounding box index: {0}'.format(
+                    field))
+                if field not in bbox_missing:
+                    bbox_missing.append(field)
+        if create and (missing or bbox_missing):
+            try:
+                created = indexes.create_indexes(
+                    context, resource_id, missing)
+            except (toolkit.ObjectNotFound, toolkit.ValidationError) as e:
+                click.secho(u'  {0}'.format(e), fg=u'red')
+                continue
+            created.extend([u'bbox({0})'.format(f)] for f in
+                           geoindex.index_resource(resource_id, bbox_missing))
+            click.echo(u'  created ' + u'; '.join(
+                u', '.join(f) for f in created))
+
+
+@dataexplorer.command(u'warm')
+@click.argument(u'resource_ids', nargs=-1)
+@click.option(u'-w', u'--workers', type=int, default=4, show_default=True,
+              help=u'Resources warmed in parallel')
+@click.option(u'-r', u'--rate', type=float, default=0, show_default=True,
+              help=u'Maximum resources started per second, 0 for no limit')
+@click.option(u'--page-size', type=int, default=100, show_default=True,
+              help=u'Rows of the first page read from each table')
+@click.option(u'--no-render', is_flag=True,
+              help=u'Only warm schemas and first pages, not view payloads')
+@click.option(u'--restart', is_flag=True,
+              help=u'Forget the resources warmed by a previous run')
+@click.option(u'--state-file', default=None,
+              help=u'File of the resources already warmed '
+                   u'(default: <cache_dir>/warm/done)')
+def warm_command(resource_ids, workers, rate, page_size, no_render, restart,
+                 state_file):
+    u'''Warm the caches of the resources with dataexplorer views.
+
+    Reads the table schema and first page of every resource with a
+    dataexplorer view, or of the RESOURCE_IDS given, and renders the view
+    payloads into the fragment cache, which must be shared with the web
+    workers (file or redis backend) unless --no-render is given. Warmed
+    resources are recorded in the state file and skipped when an
+    interrupted run is started again; use --restart after the next deploy.
+    '''
+    if not no_render and not warm.shared_payloads():
+        raise click.UsageError(
+            u'the fragment cache is not shared with the web workers, '
+            u'rendered payloads would be lost: set '
+            u'ckanext.dataexplorer.fragment_cache.backend to file or '
+            u'redis, or pass --no-render')
+    progress = warm.Progress(state_file)
+    if restart:
+        progress.reset()
+    views = warm.resources_to_warm()
+    if resource_ids:
+        views = dict((r, views.get(r, [])) for r in resource_ids)
+    done = progress.done()
+    todo = sorted(r for r in views if r not in done)
+    if done:
+        click.echo(u'Skipping {0} resources already warmed'.format(
+            len(views) - len(todo)))
+
+    context = _site_context()
+    limiter = warm.RateLimiter(rate)
+    flask_app = current_app._get_current_object()
+
+    def run(resource_id):
+        limiter.wait()
+        with flask_app.test_request_context():
+            return warm.warm_resource(context, resource_id,
+                                      views[resource_id], page_size,
+                                      render=not no_render)
+
+    errors = []
+    rendered = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = dict((pool.submit(run, r), r) for r in todo)
+        with click.progressbar(as_completed(futures), length=len(futures),
+                               label=u'Warming') as bar:
+            for future in bar:
+                resource_id = futures[future]
+                try:
+                    rendered += future.result()
+                except Exception as e:
+                    # report and go on, a broken resource must not stop
+                    # the warm up of the others
+                    errors.append((resource_id, e))
+                    continue
+                progress.add(resource_id)
+    click.echo(u'Warmed {0} resources, rendered {1} views'.format(
+        len(todo) - len(errors), rendered))
+    for resource_id, e in errors:
+        click.secho(u'{0}: {1}'.format(resource_id, e), fg=u'red')
+
+
+@dataexplorer.command(u'search-index')
+@click.argument(u'resource_ids', nargs=-1, required=True)
+@click.option(u'-f', u'--field', u'fields', multiple=True,
+              help=u'Text field to index (default: all the text fields)')
+@click.option(u'-w', u'--weight', u'weights', multiple=True,
+              help=u'FIELD=A|B|C|D rank weight of a field (default: B)')
+@click.option(u'-l', u'--language', default=None,
+              help=u'Text search configuration '
+                   u'(default: ckan.datastore.default_fts_lang)')
+@click.option(u'--no-trigram', is_flag=True,
+              help=u'Do not create the trigram indexes of substring search')
+@click.option(u'--now', is_flag=True,
+              help=u'Build in this process instead of queueing jobs')
+@click.option(u'--drop', is_flag=True,
+              help=u'Remove the search index instead')
+def search_index(resource_ids, fields, weights, language, no_trigram, now,
+                 drop):
+    u'''Create the full-text search index of DataStore resources.
+
+    Indexes the text fields of the RESOURCE_IDS given for
+    dataexplorer_text_search. Rows written afterwards are indexed as they
+    are written. Without --field, an existing index is rebuilt with its
+    fields and weights.
+    '''
+    try:
+        weights = dict(w.split(u'=', 1) for w in weights)
+    except ValueError:
+        raise click.BadParameter(u'FIELD=WEIGHT', param_hint=u'--weight')
+    for resource_id in resource_ids:
+        try:
+            if drop:
+                fulltext.drop_index(resource_id)
+                click.echo(u'{0}: dropped'.format(resource_id))
+            elif now:
+                index = fulltext.index_resource(
+                    resource_id, list(fields), weights, language,
+                    not no_trigram)
+                click.echo(u'{0}: {1}'.format(resource_id, u', '.join(
+                    u'{name} ({weight})'.format(**f)
+                    for f in index['fields'])
+                    if index else u'not indexed, see the log'))
+            else:
+                fulltext.enqueue_index(resource_id, list(fields), weights,
+                                       language, not no_trigram)
+                click.echo(u'{0}: queued'.format(resource_id))
+        except toolkit.ObjectNotFound as e:
+            click.secho(u'{0}: {1}'.format(resource_id, e), fg=u'red')
+
+
+@dataexplorer.command(u'compress-assets')
+def compress_assets():
+    u'''Write gzip and brotli variants of the built bundles.
+
+    Run after `ckan asset build`. Brotli variants need the brotli package.
+    '''
+    try:
+        written = assets.compress_assets()
+    except OSError as e:
+        click.secho(u'{0}, run ckan asset build first'.format(e), fg=u'red')
+        return
+    for path in written:
+        click.echo(path)
+    click.echo(u'{0} files written'.format(len(written)))
+
+
+def get_commands():
+    return [dataexplorer]
@@ -0,0 +1,102 @@
+# encoding: utf-8
+'''
+Column oriented pages of DataStore tables. Instead of one object per row
+repeating every field name, a page holds one array of values per field, sent
+as compact JSON or as an Apache Arrow IPC stream (when pyarrow is installed).
+'''
+import io
+
+from ckan.common import json, config
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db, export, paging
+from ckanext.dataexplorer.tableschema import schema_field_to_datastore_field
+
+WIRE_FORMATS = {
+    'json': 'application/json; charset=utf-8',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+def read_page(resource_id, schema, filters=None, sort=None, limit=100,
+              offset=0, include_total=True):
+    '''
+    Return a page of rows of a DataStore table, read with the same
+    ``filters``, ``sort``, ``limit`` and ``offset`` as datastore_search, as
+    a dict with the ``names`` of its fields and the row tuples in ``rows``.
+    '''
+    sort_field, descending = paging.parse_sort(sort)
+    db.check_fields([sort_field], schema)
+    rows_max = toolkit.asint(config.get(
+        'ckan.datastore.search.rows_max', 32000))
+    table = db.identifier(resource_id)
+    params = {}
+    where = db.where_clause(filters, schema, params)
+    page_params = dict(params, limit=min(limit, rows_max), offset=offset)
+    sql = (u'SELECT {0} FROM {1}{2} ORDER BY {3} {4}, "_id" '
+           u'LIMIT :limit OFFSET :offset').format(
+        db.select_columns(schema), table, where,
+        db.identifier(sort_field), u'DESC' if descending else u'ASC')
+    page = {
+        'resource_id': resource_id,
+        'names': [u'_id'] + [f['name'] for f in schema],
+        'types': ['integer'] + [f['type'] for f in schema],
+        'rows': list(db.stream(sql, page_params, batch_size=limit or 1)),
+        'limit': page_params['limit'],
+        'offset': offset,
+    }
+    if include_total:
+        page['total'], page['total_was_estimated'] = db.count_rows(
+            resource_id, where, params)
+    return page
+
+
+def columns_json(page):
+    '''
+    Return a page as JSON in the action API envelope, with the values of
+    each field in ``columns``, in ``fields`` order.
+    '''
+    columns = [[db.json_value(v) for v in column]
+               for column in zip(*page['rows'])] or [[] for n in page['names']]
+    result = {
+        'resource_id': page['resource_id'],
+        'fields': [schema_field_to_datastore_field({'name': n, 'type': t})
+                   for n, t in zip(page['names'], page['types'])],
+        'columns': columns,
+        'limit': page['limit'],
+        'offset': page['offset'],
+    }
+    for key in ('total', 'total_was_estimated'):
+        if key in page:
+            result[key] = page[key]
+    return json.dumps({'success': True, 'result': result},
+                      separators=(',', ':'))
+
+
+def arrow_available():
+    try:
+        import pyarrow  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def arrow_ipc(page):
+    '''
+    Return a page as an Arrow IPC stream with a single record batch. The
+    total and offset are stored in the schema metadata.
+    '''
+    import pyarrow as pa
+
+    metadata = {'offset': str(page['offset']), 'limit': str(page['limit'])}
+    if 'total' in page:
+        metadata['total'] = str(page['total'])
+        metadata['total_was_estimated'] = json.dumps(
+            page['total_was_estimated'])
+    schema = export.arrow_schema(page['names'], page['types']).with_metadata(
+        metadata)
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    writer.write_batch(export.arrow_batch(schema, page['rows']))
+    writer.close()
+    return sink.getvalue()
@@ -0,0 +1,321 @@
+# encoding: utf-8
+'''
+SQL helpers for the dataexplorer actions. Queries run directly against the
+DataStore read database, field names are checked against the resource table
+schema and values are always passed as bound parameters.
+'''
+import datetime
+import decimal
+import hashlib
+from logging import getLogger
+
+import six
+import sqlalchemy as sa
+from sqlalchemy.exc import ProgrammingError
+
+from ckan.common import config, json
+import ckan.plugins.toolkit as toolkit
+
+log = getLogger(__name__)
+
+
+def get_read_engine():
+    from ckanext.datastore.backend.postgres import get_read_engine
+    return get_read_engine()
+
+
+def get_write_engine():
+    from ckanext.datastore.backend.postgres import get_write_engine
+    return get_write_engine()
+
+
+def identifier(name):
+    '''
+    Return a quoted PostgreSQL identifier.
+    '''
+    return u'"{0}"'.format(name.replace(u'"', u'""'))
+
+
+def select_columns(schema):
+    '''
+    Return the column list of a ``SELECT`` returning the same columns as
+    datastore_search: ``_id`` and the table schema fields.
+    '''
+    return u', '.join(
+        [u'"_id"'] + [identifier(f['name']) for f in schema])
+
+
+def check_fields(names, schema):
+    '''
+    Raise ValidationError unless every name is a field of the table schema.
+    :param names: field names
+    :type names: list of strings
+    :param schema: table schema fields, as returned by
+        datastore_fields_to_schema
+    :type schema: list of dicts
+    '''
+    valid = set(f['name'] for f in schema) | set([u'_id'])
+    unknown = [n for n in names if n not in valid]
+    if unknown:
+        raise toolkit.ValidationError({
+            'fields': [u'Unknown field(s): {0}'.format(u', '.join(unknown))]})
+
+
+def where_clause(filters, schema, params, conditions=None):
+    '''
+    Return a WHERE clause for DataStore style ``filters`` (a dict of field
+    name to value or list of values), adding bound values to ``params``.
+    :param filters: view filters
+    :type filters: dict
+    :param schema: table schema fields
+    :type schema: list of dicts
+    :param params: bound parameters of the query
+    :type params: dict
+    :param conditions: extra SQL conditions to AND with the filters
+    :type conditions: list of strings
+    '''
+    filters = filters or {}
+    check_fields(list(filters), schema)
+    clauses = list(conditions or [])
+    for field, value in sorted(filters.items()):
+        values = value if isinstance(value, list) else [value]
+        names = []
+        for v in values:
+            name = u'p{0}'.format(len(params))
+            params[name] = v
+            names.append(u':' + name)
+        clauses.append(u'{0} IN ({1})'.format(
+            identifier(field), u', '.join(names)))
+    if not clauses:
+        return u''
+    return u' WHERE ' + u' AND '.join(clauses)
+
+
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date,
+                          datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.timedelta):
+        return six.text_type(value)
+    return value
+
+
+def _begin(connection):
+    timeout = toolkit.asint(config.get(
+        'ckanext.dataexplorer.statement_timeout', 60000))
+    transaction = connection.begin()
+    connection.execute(sa.text(
+        u'SET LOCAL statement_timeout = {0:d}'.format(timeout)))
+    return transaction
+
+
+def execute(sql, params=None):
+    '''
+    Run a read only query on the DataStore database and return its rows as
+    a list of dicts with JSON serializable values.
+    '''
+    with get_read_engine().connect() as connection:
+        with _begin(connection):
+            result = connection.execute(sa.text(sql), params or {})
+            keys = list(result.keys())
+            return [dict(zip(keys, [json_value(v) for v in row]))
+                    for row in result]
+
+
+def stream(sql, params=None, batch_size=1000, records=False):
+    '''
+    Run a read only query through a server side cursor and yield its rows
+    as tuples of raw values, or as dicts with JSON serializable values when
+    ``records`` is set, holding at most ``batch_size`` rows in memory.
+    '''
+    with get_read_engine().connect() as connection:
+        with _begin(connection):
+            result = connection.execution_options(
+                stream_results=True).execute(sa.text(sql), params or {})
+            keys = list(result.keys())
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    if records:
+                        yield dict(zip(keys, [json_value(v) for v in row]))
+                    else:
+                        yield tuple(row)
+
+
+def datastore_tables():
+    '''
+    Return the resource ids of all the DataStore tables, aliases excluded.
+    '''
+    rows = execute(u'''
+        SELECT name FROM "_table_metadata"
+        WHERE alias_of IS NULL ORDER BY name
+    ''')
+    # skip internal tables such as _table_metadata itself
+    return [r['name'] for r in rows if not r['name'].startswith(u'_')]
+
+
+REVISIONS_TABLE = u'_dataexplorer_revisions'
+REVISION_FUNCTION = u'_dataexplorer_bump_revision'
+REVISION_TRIGGER = u'_dataexplorer_revision'
+
+
+def _ensure_revisions(connection):
+    # created on the first write, the test fixtures drop every table and
+    # function of the DataStore database
+    found = connection.execute(sa.text(
+        u'SELECT to_regclass(:table) IS NOT NULL AND '
+        u'to_regproc(:function) IS NOT NULL'),
+        {'table': identifier(REVISIONS_TABLE),
+         'function': identifier(REVISION_FUNCTION)}).scalar()
+    if found:
+        return
+    connection.execute(sa.text(u'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            resource_id text PRIMARY KEY,
+            revision bigint NOT NULL DEFAULT 0
+        )
+    '''.format(table=identifier(REVISIONS_TABLE))))
+    connection.execute(sa.text(u'''
+        CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $body$
+        BEGIN
+            INSERT INTO {table} (resource_id, revision)
+            VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (resource_id)
+            DO UPDATE SET revision = {table}.revision + 1;
+            RETURN NULL;
+        END;
+        $body$ LANGUAGE plpgsql
+    '''.format(table=identifier(REVISIONS_TABLE),
+               function=identifier(REVISION_FUNCTION))))
+
+
+def bump_revision(resource_id, trigger=False):
+    '''
+    Increment the revision of a DataStore table. With ``trigger``, also
+    (re)install the statement trigger incrementing it whenever rows are
+    inserted, updated, deleted or truncated, including by direct SQL
+    writes such as xloader's COPY. The revision is kept when the table is
+    dropped, so a recreated table never reuses the revision of an older
+    one.
+    '''
+    with get_write_engine().begin() as connection:
+        _ensure_revisions(connection)
+        if trigger:
+            table = identifier(resource_id)
+            connection.execute(sa.text(
+                u'DROP TRIGGER IF EXISTS {0} ON {1}'.format(
+                    identifier(REVISION_TRIGGER), table)))
+            connection.execute(sa.text(
+                u'CREATE TRIGGER {0} AFTER INSERT OR UPDATE OR DELETE OR '
+                u'TRUNCATE ON {1} FOR EACH STATEMENT '
+                u'EXECUTE PROCEDURE {2}()'.format(
+                    identifier(REVISION_TRIGGER), table,
+                    identifier(REVISION_FUNCTION))))
+        connection.execute(sa.text(u'''
+            INSERT INTO {table} (resource_id, revision)
+            VALUES (:resource_id, 1)
+            ON CONFLICT (resource_id)
+            DO UPDATE SET revision = {table}.revision + 1
+        '''.format(table=identifier(REVISIONS_TABLE))),
+            {'resource_id': resource_id})
+
+
+def table_revisions(resource_ids):
+    '''
+    Return the revisions of DataStore tables by resource id, incremented in
+    the same transaction as every write of their rows (see
+    ``bump_revision``), 0 for tables never written since the extension was
+    installed. They are read with a primary key lookup and are the same in
+    every CKAN process and on hot standbys.
+    '''
+    revisions = dict.fromkeys(resource_ids, 0)
+    try:
+        rows = execute(
+            u'SELECT resource_id, revision FROM {0} '
+            u'WHERE resource_id = ANY(:resource_ids)'.format(
+                identifier(REVISIONS_TABLE)),
+            {'resource_ids': list(revisions)})
+    except ProgrammingError:
+        # nothing was written yet
+        return revisions
+    revisions.update((r['resource_id'], r['revision']) for r in rows)
+    return revisions
+
+
+def table_revision(resource_id):
+    '''
+    Return the revision of a DataStore table, see ``table_revisions``.
+    '''
+    return table_revisions([resource_id])[resource_id]
+
+
+def resource_revision(resource, revision=None):
+    '''
+    Return the revision of a DataStore resource for cache keys: its
+    ``metadata_modified`` and ``table_revision``, read unless given.
+    :param resource: resource dict
+    :type resource: dict
+    :param revision: ``table_revision`` of the resource, when known
+    :type revision: int
+    '''
+    if revision is None:
+        revision = table_revision(resource['id'])
+    return (resource.get('metadata_modified') or '', revision)
+
+
+def revision_key(resource):
+    '''
+    Return a hex digest identifying the current revision of a DataStore
+    resource in every CKAN process, from its ``metadata_modified`` and
+    ``table_revision``. Used to name on-disk cache entries.
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    return hashlib.sha1(json.dumps(
+        resource_revision(resource)).encode('utf-8')).hexdigest()
+
+
+def estimate_count(resource_id, where=u'', params=None):
+    '''
+    Return the planner estimate of the number of rows of a DataStore table
+    matching a WHERE clause: ``reltuples`` from the table statistics when
+    there is no clause, the EXPLAIN row estimate otherwise. Returns None
+    when the table has no statistics yet.
+    '''
+    if not where:
+        rows = execute(u'''
+            SELECT reltuples::BIGINT AS estimate FROM pg_class
+            WHERE relname = :resource_id AND relkind = 'r'
+        ''', {'resource_id': resource_id})
+        estimate = rows[0]['estimate'] if rows else None
+        # -1 (PostgreSQL 14+) or 0 until the table is analyzed
+        return estimate if estimate and estimate > 0 else None
+    plan = execute(u'EXPLAIN (FORMAT JSON) SELECT 1 FROM {0}{1}'.format(
+        identifier(resource_id), where), params)[0]
+    plan = list(plan.values())[0]
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_rows(resource_id, where=u'', params=None):
+    '''
+    Return ``(total, estimated)`` for the rows of a DataStore table matching
+    a WHERE clause. With ``ckanext.dataexplorer.count.strategy = estimate``
+    the planner estimate is returned when it is at least
+    ``ckanext.dataexplorer.count.estimate_threshold`` rows, a COUNT(*) is
+    run otherwise.
+    '''
+    if config.get('ckanext.dataexplorer.count.strategy') == 'estimate':
+        threshold = toolkit.asint(config.get(
+            'ckanext.dataexplorer.count.estimate_threshold', 100000))
+        estimate = estimate_count(resource_id, where, params)
+        if estimate is not None and estimate >= threshold:
+            return estimate, True
+    total = execute(u'SELECT COUNT(*) AS "count" FROM {0}{1}'.format(
+        identifier(resource_id), where), params)[0]['count']
+    return total, False
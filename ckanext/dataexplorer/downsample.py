@@ -0,0 +1,112 @@
+# encoding: utf-8
+'''
+Downsampling of ordered (x, y) series for line charts. Both methods consume
+the points as a stream and only keep two buckets in memory, so they can be
+fed straight from a server side database cursor.
+'''
+import calendar
+import datetime
+
+METHODS = ['lttb', 'minmax']
+
+
+def as_number(value):
+    '''
+    Return a float for a numeric, date or datetime x value.
+    '''
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) + \
+            value.microsecond / 1e6
+    if isinstance(value, datetime.date):
+        return float(calendar.timegm(value.timetuple()))
+    return float(value)
+
+
+def _buckets(points, total, threshold):
+    '''
+    Split ``total`` ordered points into the first point, ``threshold - 2``
+    buckets of about the same size and the last point.
+    '''
+    every = float(total - 2) / (threshold - 2)
+    iterator = iter(points)
+    for first in iterator:
+        yield [first]
+        break
+    bucket = []
+    number = 0
+    end = int(every) + 1
+    for index, point in enumerate(iterator, 1):
+        if index >= end and number < threshold - 2:
+            if bucket:
+                yield bucket
+            bucket = []
+            number += 1
+            end = int((number + 1) * every) + 1
+        bucket.append(point)
+    if bucket:
+        yield bucket
+
+
+def lttb(points, total, threshold):
+    '''
+    Largest-Triangle-Three-Buckets downsampling. Yield at most
+    ``threshold`` of the points, keeping the ones that best preserve the
+    visual shape of the line.
+
+    :param points: ``(x, y, row)`` tuples ordered by x, x and y numeric
+    :type points: iterable
+    :param total: number of points
+    :type total: int
+    :param threshold: number of points to keep
+    :type threshold: int
+    '''
+    if threshold >= total or threshold < 3:
+        for point in points:
+            yield point
+        return
+    buckets = _buckets(points, total, threshold)
+    a = next(buckets)[0]
+    yield a
+    current = next(buckets, None)
+    for following in buckets:
+        avg_x = sum(p[0] for p in following) / float(len(following))
+        avg_y = sum(p[1] for p in following) / float(len(following))
+        a = max(current, key=lambda p: abs(
+            (a[0] - avg_x) * (p[1] - a[1]) -
+            (a[0] - p[0]) * (avg_y - a[1])))
+        yield a
+        current = following
+    if current:
+        yield current[-1]
+
+
+def minmax(points, total, threshold):
+    '''
+    Min/max bucketing. Yield the first and last point of every bucket
+    together with the points holding the minimum and maximum of each
+    series, which keeps spikes visible.
+
+    :param points: ``(x, ys, row)`` tuples ordered by x, where ``ys`` is a
+        tuple with the value of every series
+    :type points: iterable
+    :param total: number of points
+    :type total: int
+    :param threshold: approximate number of points to keep
+    :type threshold: int
+    '''
+    per_bucket = 4
+    buckets_wanted = max(threshold // per_bucket, 3)
+    if threshold >= total or buckets_wanted + 2 >= total:
+        for point in points:
+            yield point
+        return
+    for bucket in _buckets(points, total, buckets_wanted + 2):
+        keep = set([0, len(bucket) - 1])
+        for serie in range(len(bucket[0][1])):
+            values = [(p[1][serie], i) for i, p in enumerate(bucket)
+                      if p[1][serie] is not None]
+            if values:
+                keep.add(min(values)[1])
+                keep.add(max(values)[1])
+        for i in sorted(keep):
+            yield bucket[i]
@@ -0,0 +1,222 @@
+# encoding: utf-8
+'''
+Streaming exports of DataStore tables. Rows are read through a server side
+cursor and written out batch by batch as CSV, NDJSON or Parquet, optionally
+gzipped on the fly, so the memory used does not depend on the export size.
+'''
+import csv
+import datetime
+import decimal
+import io
+import zlib
+
+import six
+
+from ckan.common import json
+
+from ckanext.dataexplorer import db, paging, querybuilder
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+BATCH_SIZE = 5000
+
+
+def export_query(resource_id, schema, fields, filters, sort, limit=None,
+                 where=None):
+    '''
+    Return the SQL and bound parameters reading the exported rows.
+    :param fields: exported field names, all the schema fields when empty
+    :type fields: list of strings
+    :param where: query builder conditions, see ``querybuilder``
+    :type where: list of dicts
+    :param sort: ``field``, ``field asc`` or ``field desc``
+    :type sort: string
+    '''
+    db.check_fields(fields, schema)
+    sort_field, descending = paging.parse_sort(sort)
+    db.check_fields([sort_field], schema)
+    params = {}
+    sql = u'SELECT {0} FROM {1}{2} ORDER BY {3} {4}, "_id"'.format(
+        u', '.join(db.identifier(f) for f in fields),
+        db.identifier(resource_id),
+        querybuilder.where_sql(filters, where, schema, params),
+        db.identifier(sort_field), u'DESC' if descending else u'ASC')
+    if limit:
+        params['limit'] = limit
+        sql += u' LIMIT :limit'
+    return sql, params
+
+
+def _text(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    value = db.json_value(value)
+    return u'' if value is None else six.text_type(value)
+
+
+def _batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(fields, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for batch in _batches(rows):
+        writer.writerows([_text(v) for v in row] for row in batch)
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(fields, rows):
+    for batch in _batches(rows):
+        yield u''.join(
+            json.dumps(dict(zip(fields, [db.json_value(v) for v in row])),
+                       separators=(',', ':')) + u'\n'
+            for row in batch).encode('utf-8')
+
+
+class _Sink(io.RawIOBase):
+    '''
+    Write only file collecting what the Parquet writer writes until it is
+    drained.
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_type(pa, field_type):
+    return {
+        'integer': pa.int64(),
+        'number': pa.float64(),
+        'boolean': pa.bool_(),
+        'date': pa.date32(),
+        'datetime': pa.timestamp('us'),
+        'time': pa.time64('us'),
+    }.get(field_type, pa.string())
+
+
+def _arrow_value(value, arrow_type, pa):
+    if value is None:
+        return None
+    if arrow_type == pa.float64() and isinstance(value, decimal.Decimal):
+        return float(value)
+    if arrow_type == pa.string():
+        return _text(value)
+    if arrow_type == pa.date32() and isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def arrow_schema(fields, types):
+    '''
+    Return the Arrow schema of a list of fields.
+    :param types: table schema type of each field
+    :type types: list of strings
+    '''
+    import pyarrow as pa
+    return pa.schema([(f, _arrow_type(pa, t)) for f, t in zip(fields, types)])
+
+
+def arrow_batch(schema, rows):
+    '''
+    Return a list of row tuples as an Arrow record batch of ``schema``.
+    '''
+    import pyarrow as pa
+    columns = list(zip(*rows)) or [()] * len(schema)
+    return pa.RecordBatch.from_arrays([
+        pa.array([_arrow_value(v, f.type, pa) for v in column], type=f.type)
+        for column, f in zip(columns, schema)], schema=schema)
+
+
+def parquet_chunks(fields, rows, types):
+    '''
+    Yield a Parquet file written one row group per batch of rows.
+    :param types: table schema type of each field
+    :type types: list of strings
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(fields, types)
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    for batch in _batches(rows):
+        writer.write_table(pa.Table.from_batches([arrow_batch(schema, batch)]))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def gzip_chunks(chunks, level=6):
+    '''
+    Gzip a stream of byte chunks on the fly.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(output, resource_id, schema, fields, filters, sort,
+                  limit=None, where=None):
+    '''
+    Yield the export of a DataStore table as chunks of bytes.
+    :param output: ``csv``, ``ndjson`` or ``parquet``
+    :type output: string
+    :param schema: table schema fields
+    :type schema: list of dicts
+    '''
+    fields = fields or [f['name'] for f in schema]
+    sql, params = export_query(resource_id, schema, fields, filters, sort,
+                               limit, where)
+    rows = db.stream(sql, params, batch_size=BATCH_SIZE)
+    if output == 'csv':
+        return csv_chunks(fields, rows)
+    if output == 'ndjson':
+        return ndjson_chunks(fields, rows)
+    types = dict((f['name'], f['type']) for f in schema)
+    types['_id'] = 'integer'
+    return parquet_chunks(fields, rows, [types[f] for f in fields])
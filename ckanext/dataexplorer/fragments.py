@@ -0,0 +1,285 @@
+# encoding: utf-8
+'''
+Cache of the serialized ``data-datapackage`` payload of rendered views and
+the matching ETags. A payload depends on the view config, on the locale,
+on the revision of the resource and of its profile, search index or file
+preview, and on the configuration and assets of the extension, so all of
+them make the key.
+
+Payloads are serialized as compact JSON (with orjson when it is installed),
+the schema of a resource once per revision for all its views, and
+escaped for a single quoted HTML attribute, where the quotes of the JSON
+need no escaping. In ``compact`` mode only what the widget needs to boot is
+embedded, the rest of the resource metadata is fetched from
+``/dataexplorer/metadata/<resource_id>.json``.
+'''
+import hashlib
+
+import six
+from flask import make_response
+from markupsafe import Markup
+from sqlalchemy.exc import SQLAlchemyError
+
+from ckan.common import json, config
+import ckan.lib.helpers as h
+import ckan.plugins as p
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import (
+    assets, db, metrics, preview, profile)
+from ckanext.dataexplorer.cache import LRUCache, make_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+fragment_cache = make_cache('fragments', 'memory')
+schema_fragments = LRUCache(1000, 600)
+
+# resource keys the widget needs to boot
+BOOT_KEYS = ['id', 'name', 'title', 'path', 'format', 'datastore_active',
+             'api', 'columnar', 'keyset', 'aggregate', 'downsample', 'map',
+             'prefetch', 'data', 'tiles', 'sample', 'export', 'query',
+             'search', 'preview']
+BOOT_FIELD_KEYS = ['name', 'type', 'format', 'stats']
+
+VIEW_TYPES = ['dataexplorer_view', 'dataexplorer_table_view',
+              'dataexplorer_chart_view', 'dataexplorer_map_view',
+              'dataexplorer_web_view']
+
+
+def configure(config):
+    global fragment_cache
+    fragment_cache = make_cache(
+        'fragments',
+        config.get('ckanext.dataexplorer.fragment_cache.backend', 'memory'),
+        maxsize=toolkit.asint(config.get(
+            'ckanext.dataexplorer.fragment_cache.size', 1000)),
+        ttl=toolkit.asint(config.get(
+            'ckanext.dataexplorer.fragment_cache.ttl', 600)))
+    schema_fragments.configure(
+        maxsize=toolkit.asint(config.get(
+            'ckanext.dataexplorer.fragment_cache.size', 1000)),
+        ttl=toolkit.asint(config.get(
+            'ckanext.dataexplorer.fragment_cache.ttl', 600)))
+
+
+def compact_mode():
+    return config.get('ckanext.dataexplorer.payload', 'full') == 'compact'
+
+
+def dumps(obj):
+    '''
+    Return the compact JSON of ``obj``, serialized by orjson when it is
+    installed.
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj, default=six.text_type).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), default=six.text_type)
+
+
+def _splice(obj_json, key, value_json):
+    # add a member to the JSON of an object without parsing it again
+    return u'{0}{1}{2}:{3}}}'.format(
+        obj_json[:-1], u'' if obj_json == u'{}' else u',', dumps(key),
+        value_json)
+
+
+def metadata_url(resource):
+    return h.url_for('/dataexplorer/metadata/{0}.json'.format(
+        resource['id']), _external=True)
+
+
+def _schema_json(resource, schema, compact, states):
+    # the schema of a resource is the same in all its views, serialize it
+    # once per state of its table and profile
+    if resource['id'] in states:
+        state = states[resource['id']]
+    else:
+        state = _datastore_state(resource)
+    key = (resource['id'], json.dumps(state), compact)
+    schema_json = schema_fragments.get(key) if state is not None else None
+    if schema_json is None:
+        if compact:
+            schema = dict(schema, fields=[
+                dict((k, f[k]) for k in BOOT_FIELD_KEYS if k in f)
+                for f in schema.get('fields', [])])
+        schema_json = dumps(schema)
+        if state is not None:
+            schema_fragments.set(key, schema_json)
+    return schema_json
+
+
+def _resource_json(resource, compact, states):
+    schema = resource.get('schema')
+    if compact:
+        embedded = dict((k, resource[k]) for k in BOOT_KEYS if k in resource)
+        if p.plugin_loaded('dataexplorer'):
+            embedded['metadata'] = metadata_url(resource)
+    else:
+        embedded = dict(resource)
+    embedded.pop('schema', None)
+    resource_json = dumps(embedded)
+    if isinstance(schema, dict) and 'id' in resource:
+        return _splice(resource_json, 'schema',
+                       _schema_json(resource, schema, compact, states))
+    if schema is not None:
+        return _splice(resource_json, 'schema', dumps(schema))
+    return resource_json
+
+
+def serialize_payload(data, states=None):
+    '''
+    Return the JSON of a ``{"widgets": ..., "datapackage": ...}`` payload,
+    assembled from the JSON of its widgets, resources and schemas.
+    :param states: DataStore state of the resources by id, when known
+    :type states: dict
+    '''
+    compact = compact_mode()
+    states = states or {}
+    datapackage = dict(data['datapackage'])
+    resources = datapackage.pop('resources', [])
+    resources_json = u'[{0}]'.format(
+        u','.join(_resource_json(r, compact, states) for r in resources))
+    datapackage_json = _splice(dumps(datapackage), 'resources',
+                               resources_json)
+    return _splice(_splice(u'{}', 'widgets', dumps(data['widgets'])),
+                   'datapackage', datapackage_json)
+
+
+def attribute_value(payload):
+    '''
+    Return the payload escaped for a single quoted HTML attribute.
+    '''
+    return Markup(payload.replace(u'&', u'&amp;').replace(u"'", u'&#39;')
+                  .replace(u'<', u'&lt;').replace(u'>', u'&gt;'))
+
+
+def _datastore_state(resource):
+    # revision of the table in every process, also incremented when its
+    # search index changes, and whether the profile built for it by a
+    # background job exists: a primary key lookup and a file stat
+    if not resource.get('datastore_active'):
+        return None
+    try:
+        revision = db.revision_key(resource)
+    except SQLAlchemyError:
+        return None
+    return [revision, profile.profile_exists(resource, revision)]
+
+
+def _preview_state(resource):
+    if resource.get('datastore_active') or not preview.preview_format(
+            resource):
+        return None
+    return preview.preview_state(resource)
+
+
+def _locale():
+    try:
+        return h.lang()
+    except (TypeError, RuntimeError):
+        return None  # outside of a request
+
+
+def _fragment_key(resource_view, resource, state):
+    parts = [resource_view, resource['id'], _locale(),
+             resource.get('metadata_modified') or
+             resource.get('last_modified'),
+             state, _preview_state(resource),
+             config.get('ckan.site_url'),
+             config.get('ckanext.dataexplorer.inline_rows'),
+             config.get('ckanext.dataexplorer.payload'),
+             config.get('ckanext.dataexplorer.wire_format'),
+             config.get('ckanext.dataexplorer.table.paging'),
+             config.get('ckanext.dataexplorer.count.strategy'),
+             assets.asset_version()]
+    return hashlib.sha1(json.dumps(
+        parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def fragment_key(resource_view, resource):
+    '''
+    Return the cache key, also used as strong ETag, of the payload of a
+    view: a digest of the view config, the locale of the request, the
+    resource revision, the state of its profile or file preview, the
+    configuration options changing the payload and the version of the
+    built assets. The same in every CKAN process.
+    :param resource_view: resource view dict
+    :type resource_view: dict
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    return _fragment_key(resource_view, resource,
+                         _datastore_state(resource))
+
+
+def view_payload(resource_view, resource, build):
+    '''
+    Return the serialized ``{"widgets": ..., "datapackage": ...}`` payload of
+    a view from the fragment cache, calling ``build`` to compute it on a
+    miss, escaped for the single quoted ``data-datapackage`` attribute. The
+    key is remembered for the ETag of the response.
+    :param build: function returning the widgets and datapackage dict
+    :type build: function
+    '''
+    state = _datastore_state(resource)
+    key = _fragment_key(resource_view, resource, state)
+    payload = fragment_cache.get(key)
+    if payload is None:
+        data = build()
+        with metrics.timer('serialize'):
+            payload = serialize_payload(data, {resource['id']: state})
+        fragment_cache.set(key, payload)
+    metrics.record_payload(resource_view.get('view_type'), len(payload))
+    try:
+        toolkit.g.dataexplorer_etag = key
+    except (TypeError, RuntimeError):
+        pass  # outside of a request
+    return attribute_value(payload)
+
+
+def is_view_request(request):
+    # the embeddable page of a view, /dataset/<id>/resource/<id>/view/<id>
+    endpoint = (request.endpoint or '').split('.')
+    return (len(endpoint) == 2 and endpoint[0].endswith('resource') and
+            endpoint[1] == 'view' and
+            bool((request.view_args or {}).get('view_id')))
+
+
+def not_modified():
+    '''
+    ``before_request`` hook answering 304 to conditional requests for an
+    unchanged dataexplorer view page, without rendering it.
+    '''
+    request = toolkit.request
+    if not request.if_none_match or not is_view_request(request):
+        return None
+    context = {'user': toolkit.g.user}
+    try:
+        resource_view = toolkit.get_action('resource_view_show')(
+            dict(context), {'id': request.view_args['view_id']})
+        resource = toolkit.get_action('resource_show')(
+            dict(context), {'id': request.view_args['resource_id']})
+    except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
+        return None
+    if resource_view.get('view_type') not in VIEW_TYPES:
+        return None
+    key = fragment_key(resource_view, resource)
+    if key in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(key)
+        return response
+    return None
+
+
+def set_etag(response):
+    '''
+    ``after_request`` hook adding the payload ETag to view pages.
+    '''
+    key = getattr(toolkit.g, 'dataexplorer_etag', None)
+    if key and response.status_code == 200 and is_view_request(
+            toolkit.request):
+        response.set_etag(key)
+    return response
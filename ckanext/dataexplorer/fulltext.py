@@ -0,0 +1,440 @@
+# encoding: utf-8
+'''
+Indexed full-text search of DataStore tables. The text columns chosen for a
+resource are folded, with a weight each, into a hidden ``_dataexplorer_tsv``
+tsvector column kept up to date by a row trigger, so every datastore_create
+and datastore_upsert only reindexes the rows it writes. The column has a GIN
+index and, with the pg_trgm extension, each chosen column gets a trigram
+index for substring searches.
+
+The trigger arguments (text search configuration, columns and weights) are
+the definition of the index: it lives with the table in the DataStore
+database and is read back from ``pg_trigger``. Every change of an index
+increments the revision of its table, which keys the cached payloads.
+'''
+import hashlib
+from logging import getLogger
+
+import six
+import sqlalchemy as sa
+from markupsafe import escape
+from sqlalchemy.exc import SQLAlchemyError
+
+from ckan.common import config
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db
+
+log = getLogger(__name__)
+
+COLUMN = u'_dataexplorer_tsv'
+TRIGGER = u'dataexplorer_search'
+FUNCTION = u'dataexplorer_search_vector'
+WEIGHTS = ['A', 'B', 'C', 'D']
+DEFAULT_WEIGHT = 'B'
+MODES = ['fulltext', 'substring']
+TEXT_TYPES = ['string']
+# ts_headline marks matches with these, the text is HTML escaped before
+# they are turned into <mark> tags
+START_SEL = u'\ue000'
+STOP_SEL = u'\ue001'
+
+FUNCTION_SQL = u'''
+    CREATE OR REPLACE FUNCTION {0}() RETURNS trigger AS $$
+    DECLARE
+        row_json jsonb := to_jsonb(NEW);
+        vector tsvector := ''::tsvector;
+        i integer := 1;
+    BEGIN
+        -- arguments: text search configuration, then column, weight pairs
+        WHILE i < TG_NARGS LOOP
+            vector := vector || setweight(to_tsvector(
+                TG_ARGV[0]::regconfig,
+                coalesce(row_json ->> TG_ARGV[i], '')),
+                TG_ARGV[i + 1]::"char");
+            i := i + 2;
+        END LOOP;
+        NEW.{1} := vector;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+'''
+
+
+def default_language():
+    return config.get('ckan.datastore.default_fts_lang') or u'english'
+
+
+def text_fields(schema):
+    '''
+    Return the names of the text fields of a table schema, the default
+    columns of a search index.
+    :param schema: table schema fields
+    :type schema: list of dicts
+    '''
+    return [f['name'] for f in schema if f['type'] in TEXT_TYPES]
+
+
+def _index_name(resource_id, suffix):
+    return u'{0}_{1}'.format(resource_id, suffix)
+
+
+def _trigram_index_name(resource_id, field):
+    return _index_name(resource_id, u'trgm_' + hashlib.md5(
+        field.encode('utf-8')).hexdigest()[:8])
+
+
+def _table_index_names(resource_id):
+    return set(r['indexname'] for r in db.execute(u'''
+        SELECT indexname FROM pg_indexes
+        WHERE tablename = :resource_id AND schemaname = 'public'
+    ''', {'resource_id': resource_id}))
+
+
+def _trigger_arguments(value):
+    # pg_trigger.tgargs: NUL terminated arguments
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return [a.decode('utf-8')
+            for a in six.binary_type(value).split(b'\x00')[:-1]]
+
+
+def search_index(resource_id):
+    '''
+    Return the search index of a DataStore table: its text search
+    ``language``, its ``fields`` (name and weight), whether the GIN index
+    of the search vector exists (``indexed``) and the fields with a
+    trigram index (``trigram``). None when the table has no search index.
+    :param resource_id: resource id
+    :type resource_id: string
+    '''
+    rows = db.execute(u'''
+        SELECT t.tgargs FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = :resource_id AND n.nspname = 'public'
+            AND t.tgname = :trigger
+    ''', {'resource_id': resource_id, 'trigger': TRIGGER})
+    if not rows:
+        return None
+    arguments = _trigger_arguments(rows[0]['tgargs'])
+    fields = [{'name': name, 'weight': weight}
+              for name, weight in zip(arguments[1::2], arguments[2::2])]
+    names = _table_index_names(resource_id)
+    return {
+        'language': arguments[0],
+        'fields': fields,
+        'indexed': _index_name(resource_id, u'tsv') in names,
+        'trigram': [f['name'] for f in fields
+                    if _trigram_index_name(resource_id, f['name']) in names],
+    }
+
+
+def validate_index(schema, fields, weights, language):
+    '''
+    Raise ValidationError unless ``fields`` are text fields of the table
+    schema, ``weights`` one of WEIGHTS for some of them and ``language`` a
+    text search configuration of the database.
+    '''
+    db.check_fields(fields, schema)
+    types = dict((f['name'], f['type']) for f in schema)
+    errors = {}
+    not_text = [n for n in fields if types.get(n) not in TEXT_TYPES]
+    if not fields:
+        errors['fields'] = [u'The resource has no text fields']
+    elif not_text:
+        errors['fields'] = [u'Not text field(s): {0}'.format(
+            u', '.join(not_text))]
+    bad_weights = [w for w in weights.values() if w not in WEIGHTS]
+    if bad_weights or set(weights) - set(fields):
+        errors['weights'] = [u'Weights are one of {0} for indexed fields'
+                             .format(u', '.join(WEIGHTS))]
+    if not db.execute(u'SELECT 1 FROM pg_ts_config WHERE cfgname = :name',
+                      {'name': language}):
+        errors['language'] = [u'Unknown text search configuration']
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+
+def _trigram_available(connection):
+    try:
+        with connection.begin_nested():
+            connection.execute(sa.text(
+                u'CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    except SQLAlchemyError as e:
+        log.warning('pg_trgm is not available, no substring search '
+                    'indexes: %s', e)
+        return False
+    return True
+
+
+def _drop_trigram_indexes(connection, resource_id, keep=()):
+    keep = set(_trigram_index_name(resource_id, name) for name in keep)
+    for name in _table_index_names(resource_id):
+        if name.startswith(_index_name(resource_id, u'trgm_')) and \
+                name not in keep:
+            connection.execute(sa.text(u'DROP INDEX IF EXISTS {0}'.format(
+                db.identifier(name))))
+
+
+def _create_indexes(engine, resource_id, fields, trigram):
+    table = db.identifier(resource_id)
+    with engine.begin() as connection:
+        connection.execute(sa.text(
+            u'CREATE INDEX IF NOT EXISTS {0} ON {1} USING gin ({2})'.format(
+                db.identifier(_index_name(resource_id, u'tsv')), table,
+                db.identifier(COLUMN))))
+        if trigram and _trigram_available(connection):
+            for name in fields:
+                connection.execute(sa.text(
+                    u'CREATE INDEX IF NOT EXISTS {0} ON {1} '
+                    u'USING gin ({2} gin_trgm_ops)'.format(
+                        db.identifier(_trigram_index_name(resource_id,
+                                                          name)),
+                        table, db.identifier(name))))
+        connection.execute(sa.text(u'ANALYZE {0}'.format(table)))
+
+
+def create_index(resource_id, schema, fields=None, weights=None,
+                 language=None, trigram=True, batch_size=10000):
+    '''
+    Create or replace the search index of a DataStore table: add the search
+    vector column and its trigger, fill the vectors of the existing rows in
+    batches of ``batch_size`` and build the GIN index, and the trigram
+    indexes of the fields when ``trigram`` is set. Returns the new
+    ``search_index``.
+    :param schema: table schema fields
+    :type schema: list of dicts
+    :param fields: indexed text fields (default: all the text fields)
+    :type fields: list of strings
+    :param weights: weight (A, B, C or D) of each field (default: B)
+    :type weights: dict
+    :param language: text search configuration (default:
+        ``ckan.datastore.default_fts_lang``)
+    :type language: string
+    '''
+    fields = list(fields or text_fields(schema))
+    weights = dict(weights or {})
+    language = language or default_language()
+    validate_index(schema, fields, weights, language)
+    table = db.identifier(resource_id)
+    arguments = [language]
+    for name in fields:
+        arguments.extend([name, weights.get(name, DEFAULT_WEIGHT)])
+
+    engine = db.get_write_engine()
+    with engine.begin() as connection:
+        connection.execute(sa.text(u'ALTER TABLE {0} ADD COLUMN IF NOT '
+                                   u'EXISTS {1} tsvector'.format(
+                                       table, db.identifier(COLUMN))))
+        connection.execute(sa.text(FUNCTION_SQL.format(
+            FUNCTION, db.identifier(COLUMN))))
+        connection.execute(sa.text(u'DROP TRIGGER IF EXISTS {0} ON {1}'
+                                   .format(TRIGGER, table)))
+        # searches wait for the new vectors rather than see a mix
+        connection.execute(sa.text(u'DROP INDEX IF EXISTS {0}'.format(
+            db.identifier(_index_name(resource_id, u'tsv')))))
+        _drop_trigram_indexes(connection, resource_id, fields)
+        # trigger arguments are string literals, not bound parameters
+        connection.execute(sa.text(
+            u'CREATE TRIGGER {0} BEFORE INSERT OR UPDATE ON {1} FOR EACH '
+            u'ROW EXECUTE PROCEDURE {2}({3})'.format(
+                TRIGGER, table, FUNCTION, u', '.join(
+                    u"'{0}'".format(a.replace(u"'", u"''"))
+                    .replace(u':', u'\\:') for a in arguments))))
+
+    # the trigger computes the vectors of the rows it updates
+    last = db.execute(u'SELECT max("_id") AS "last" FROM {0}'.format(
+        table))[0]['last'] or 0
+    for start in range(0, last, batch_size):
+        with engine.begin() as connection:
+            connection.execute(sa.text(
+                u'UPDATE {0} SET {1} = NULL '
+                u'WHERE "_id" > :start AND "_id" <= :end'.format(
+                    table, db.identifier(COLUMN))),
+                {'start': start, 'end': start + batch_size})
+
+    _create_indexes(engine, resource_id, fields, trigram)
+    db.bump_revision(resource_id)
+    log.info('Created search index of DataStore table %s on %s',
+             resource_id, fields)
+    return search_index(resource_id)
+
+
+def drop_index(resource_id):
+    '''
+    Remove the search index of a DataStore table: its trigger, search
+    vector column and indexes.
+    '''
+    table = db.identifier(resource_id)
+    with db.get_write_engine().begin() as connection:
+        connection.execute(sa.text(u'DROP TRIGGER IF EXISTS {0} ON {1}'
+                                   .format(TRIGGER, table)))
+        # dropping the column drops the indexes using it
+        connection.execute(sa.text(u'ALTER TABLE {0} DROP COLUMN IF EXISTS '
+                                   u'{1}'.format(table,
+                                                 db.identifier(COLUMN))))
+        _drop_trigram_indexes(connection, resource_id)
+    db.bump_revision(resource_id)
+
+
+def index_resource(resource_id, fields=None, weights=None, language=None,
+                   trigram=True):
+    '''
+    Create the search index of a resource, or rebuild its existing one
+    when no ``fields`` are given. Run as a background job.
+    '''
+    from ckanext.dataexplorer.tableschema import request_schema_by_id
+
+    current = search_index(resource_id)
+    if not fields and current:
+        fields = [f['name'] for f in current['fields']]
+        weights = dict((f['name'], f['weight']) for f in current['fields'])
+        language = language or current['language']
+    try:
+        return create_index(resource_id, request_schema_by_id(resource_id),
+                            fields, weights, language, trigram)
+    except (toolkit.ObjectNotFound, toolkit.ValidationError) as e:
+        log.warning('Could not create the search index of DataStore '
+                    'table %s: %s', resource_id, e)
+        return None
+
+
+def enqueue_index(resource_id, fields=None, weights=None, language=None,
+                  trigram=True):
+    toolkit.enqueue_job(index_resource,
+                        [resource_id, fields, weights, language, trigram],
+                        title=u'dataexplorer search index {0}'.format(
+                            resource_id))
+
+
+def restore_indexes(resource_id, trigram=True):
+    '''
+    Recreate the GIN indexes of a search index, the search vectors being
+    still maintained by its trigger. Run as a background job.
+    '''
+    index = search_index(resource_id)
+    if index:
+        _create_indexes(db.get_write_engine(), resource_id,
+                        [f['name'] for f in index['fields']], trigram)
+        db.bump_revision(resource_id)
+
+
+def repair_index(resource_id):
+    '''
+    Queue the restore of the indexes of a search index that lost them:
+    datastore_create drops the indexes of a table it is not given.
+    '''
+    index = search_index(resource_id)
+    if index and not index['indexed']:
+        toolkit.enqueue_job(
+            restore_indexes, [resource_id],
+            title=u'dataexplorer search index {0}'.format(resource_id))
+
+
+_server_version = {}
+
+
+def _tsquery():
+    # websearch_to_tsquery (quoted phrases, OR, -word) is PostgreSQL 11+
+    if 'num' not in _server_version:
+        _server_version['num'] = int(db.execute(
+            u'SHOW server_version_num')[0]['server_version_num'])
+    function = u'websearch_to_tsquery' \
+        if _server_version['num'] >= 110000 else u'plainto_tsquery'
+    return u'{0}(CAST(:language AS regconfig), :q)'.format(function)
+
+
+def _vector(fields, weights):
+    return u' || '.join(
+        u"setweight(to_tsvector(CAST(:language AS regconfig), "
+        u"coalesce({0}::text, '')), '{1}')".format(
+            db.identifier(name), weights[name]) for name in fields)
+
+
+def _like_pattern(q):
+    return u'%{0}%'.format(q.replace(u'\\', u'\\\\').replace(
+        u'%', u'\\%').replace(u'_', u'\\_'))
+
+
+def match(index, mode, fields, q, params):
+    '''
+    Return the SQL ``(condition, rank)`` of a search, adding its bound
+    values to ``params``. ``fulltext`` matches the words of ``q`` against
+    the search vector, limited to ``fields`` when they are not all the
+    indexed fields, and ranks rows with ``ts_rank_cd``. ``substring``
+    matches ``q`` anywhere in ``fields`` and ranks rows by trigram word
+    similarity.
+    :param index: ``search_index`` of the table
+    :type index: dict
+    '''
+    weights = dict((f['name'], f['weight']) for f in index['fields'])
+    if mode == 'substring':
+        params['pattern'] = _like_pattern(q)
+        params['q'] = q
+        condition = u' OR '.join(u'{0} ILIKE :pattern'.format(
+            db.identifier(name)) for name in fields)
+        rank = u'GREATEST({0})'.format(u', '.join(
+            u'word_similarity(:q, {0})'.format(db.identifier(name))
+            for name in fields))
+        return u'({0})'.format(condition), rank
+
+    params['language'] = index['language']
+    params['q'] = q
+    tsquery = _tsquery()
+    condition = u'{0} @@ {1}'.format(db.identifier(COLUMN), tsquery)
+    vector = db.identifier(COLUMN)
+    if set(fields) != set(weights):
+        # the GIN index finds the candidates, the vector of the fields
+        # asked for rechecks them
+        vector = _vector(fields, weights)
+        condition += u' AND ({0}) @@ {1}'.format(vector, tsquery)
+    return condition, u'ts_rank_cd({0}, {1}, 1)'.format(vector, tsquery)
+
+
+def headline_columns(fields, params):
+    '''
+    Return the ``ts_headline`` expressions of ``fields`` marking the words
+    of the query of a ``fulltext`` search.
+    '''
+    params['headline_options'] = (
+        u'StartSel="{0}", StopSel="{1}", MaxFragments=2, MaxWords=20, '
+        u'MinWords=5'.format(START_SEL, STOP_SEL))
+    return [u"ts_headline(CAST(:language AS regconfig), {0}::text, "
+            u"{1}, :headline_options)".format(db.identifier(name), _tsquery())
+            for name in fields]
+
+
+def highlight(text):
+    '''
+    Return the HTML of a ``ts_headline`` fragment, with the matches in
+    ``<mark>`` tags, or None when nothing matched.
+    '''
+    if not text or START_SEL not in text:
+        return None
+    return six.text_type(escape(text)).replace(
+        START_SEL, u'<mark>').replace(STOP_SEL, u'</mark>')
+
+
+def highlight_substring(value, q):
+    '''
+    Return the HTML of a value with the case insensitive occurrences of
+    ``q`` in ``<mark>`` tags, or None when it has none.
+    '''
+    if not isinstance(value, six.string_types):
+        return None
+    lower = value.lower()
+    needle = q.lower()
+    parts = []
+    start = 0
+    found = lower.find(needle)
+    while needle and found != -1:
+        parts.append(six.text_type(escape(value[start:found])))
+        parts.append(u'<mark>{0}</mark>'.format(
+            escape(value[found:found + len(needle)])))
+        start = found + len(needle)
+        found = lower.find(needle, start)
+    if not parts:
+        return None
+    parts.append(six.text_type(escape(value[start:])))
+    return u''.join(parts)
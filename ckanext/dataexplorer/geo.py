@@ -0,0 +1,232 @@
+# encoding: utf-8
+'''
+Geometry helpers for the dataexplorer map data actions.
+'''
+import math
+
+import six
+
+from ckan.common import json
+
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+
+
+def parse_bbox(value):
+    '''
+    Return a ``(min_lon, min_lat, max_lon, max_lat)`` tuple from a
+    ``"min_lon,min_lat,max_lon,max_lat"`` string or list, clamped to the
+    world extent. ``min_lon`` is greater than ``max_lon`` for boxes
+    crossing the antimeridian. Raise ValueError for malformed boxes.
+    '''
+    if not value:
+        return WORLD
+    if isinstance(value, six.string_types):
+        value = value.split(',')
+    min_lon, min_lat, max_lon, max_lat = [float(v) for v in value]
+    if min_lat > max_lat:
+        raise ValueError('bbox minimum is greater than its maximum')
+    return (min(max(min_lon, -180.0), 180.0), max(min_lat, -90.0),
+            max(min(max_lon, 180.0), -180.0), min(max_lat, 90.0))
+
+
+def split_bbox(bbox):
+    '''
+    Return the boxes covering a bounding box: the box itself, or its east
+    and west parts when it crosses the antimeridian.
+    '''
+    if bbox[0] <= bbox[2]:
+        return [bbox]
+    return [(bbox[0], bbox[1], 180.0, bbox[3]),
+            (-180.0, bbox[1], bbox[2], bbox[3])]
+
+
+def cell_size(zoom, cells_per_tile):
+    '''
+    Return the side in degrees of a clustering grid cell at a web map zoom
+    level, a 256px tile being split in ``cells_per_tile`` cells per side.
+    '''
+    return 360.0 / (2 ** zoom) / cells_per_tile
+
+
+def _positions(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for c in coordinates or []:
+        for position in _positions(c):
+            yield position
+
+
+def load_geometry(value):
+    '''
+    Return a GeoJSON geometry dict from a DataStore value, which may be a
+    JSON string, a geometry or a Feature. Invalid values return None.
+    '''
+    if isinstance(value, six.string_types):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    if not isinstance(value, dict):
+        return None
+    if value.get('type') == 'Feature':
+        value = value.get('geometry')
+    return value if isinstance(value, dict) else None
+
+
+def geometry_positions(geometry):
+    if geometry.get('type') == 'GeometryCollection':
+        for g in geometry.get('geometries', []):
+            for position in geometry_positions(g):
+                yield position
+        return
+    for position in _positions(geometry.get('coordinates')):
+        yield position
+
+
+def geometry_bbox(geometry):
+    '''
+    Return the ``(min_lon, min_lat, max_lon, max_lat)`` box of a GeoJSON
+    geometry, or None when it has no coordinates.
+    '''
+    xs = []
+    ys = []
+    for position in geometry_positions(geometry):
+        xs.append(position[0])
+        ys.append(position[1])
+    if not xs:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def bbox_intersects(a, b):
+    return any(not (a[2] < b[0] or a[0] > b[2] or a[3] < b[1] or
+                    a[1] > b[3]) for b in split_bbox(b))
+
+
+def grid_key(lon, lat, size):
+    return (int(math.floor(lon / size)), int(math.floor(lat / size)))
+
+
+def tile_bbox(z, x, y):
+    '''
+    Return the ``(min_lon, min_lat, max_lon, max_lat)`` box of a web
+    mercator (XYZ) tile.
+    '''
+    n = 2.0 ** z
+
+    def lat(row):
+        return math.degrees(
+            math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0,
+            lat(y))
+
+
+def tolerance(zoom):
+    '''
+    Return the simplification tolerance in degrees for a zoom level: the
+    size of one pixel of a 256px tile.
+    '''
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def precision(zoom):
+    '''
+    Return the number of decimals needed to keep sub pixel accuracy at a
+    zoom level.
+    '''
+    return max(int(math.ceil(-math.log10(tolerance(zoom)))) + 1, 0)
+
+
+def _perpendicular_distance(point, start, end):
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+    return abs(dy * point[0] - dx * point[1] + end[0] * start[1] -
+               end[1] * start[0]) / math.hypot(dx, dy)
+
+
+def douglas_peucker(points, tolerance):
+    '''
+    Return a simplified copy of a list of positions, keeping the ones more
+    than ``tolerance`` away from the simplified line.
+    '''
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        index = None
+        distance = tolerance
+        for i in range(first + 1, last):
+            d = _perpendicular_distance(points[i], points[first],
+                                        points[last])
+            if d > distance:
+                index = i
+                distance = d
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def _simplify_ring(ring, tolerance):
+    simplified = douglas_peucker(ring, tolerance)
+    # a linear ring needs at least 4 positions
+    return simplified if len(simplified) >= 4 else None
+
+
+def _simplify_polygon(rings, tolerance):
+    simplified = []
+    for i, ring in enumerate(rings):
+        s = _simplify_ring(ring, tolerance)
+        if s is None:
+            if i == 0:
+                # the exterior ring collapsed, the polygon is under a pixel
+                return None
+            continue
+        simplified.append(s)
+    return simplified
+
+
+def simplify(geometry, tolerance, decimals):
+    '''
+    Return a copy of a GeoJSON geometry simplified with Douglas-Peucker and
+    with coordinates rounded to ``decimals``. Parts that collapse below
+    ``tolerance`` are dropped; None is returned when nothing is left.
+    '''
+    kind = geometry.get('type')
+    coordinates = _round(geometry.get('coordinates'), decimals)
+    if kind in ('LineString', 'MultiPoint', 'Point'):
+        if kind == 'LineString':
+            coordinates = douglas_peucker(coordinates, tolerance)
+    elif kind == 'MultiLineString':
+        coordinates = [douglas_peucker(line, tolerance)
+                       for line in coordinates]
+    elif kind == 'Polygon':
+        coordinates = _simplify_polygon(coordinates, tolerance)
+    elif kind == 'MultiPolygon':
+        coordinates = [p for p in (_simplify_polygon(polygon, tolerance)
+                                   for polygon in coordinates) if p]
+    elif kind == 'GeometryCollection':
+        geometries = [g for g in (simplify(g, tolerance, decimals)
+                                  for g in geometry.get('geometries', []))
+                      if g]
+        return {'type': kind, 'geometries': geometries} \
+            if geometries else None
+    else:
+        return None
+    if not coordinates:
+        return None
+    return {'type': kind, 'coordinates': coordinates}
+
+
+def _round(coordinates, decimals):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        return [round(c, decimals) for c in coordinates]
+    return [_round(c, decimals) for c in coordinates or []]
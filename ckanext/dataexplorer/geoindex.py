@@ -0,0 +1,310 @@
+# encoding: utf-8
+'''
+Indexed bounding boxes of the GeoJSON fields of DataStore tables. The
+bounding box of each geometry is kept in a hidden ``box`` column, one per
+field, computed by a row trigger so every datastore_create and
+datastore_upsert only updates the rows it writes. The column has a GiST
+index, and map data and tile queries select the rows whose box overlaps
+the one they draw in SQL instead of parsing every geometry of the table.
+
+The trigger arguments (field and column) are the definition of the index:
+it lives with the table in the DataStore database and is read back from
+``pg_trigger``.
+'''
+import hashlib
+from logging import getLogger
+
+import six
+import sqlalchemy as sa
+from sqlalchemy.exc import SQLAlchemyError
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db, geo
+
+log = getLogger(__name__)
+
+COLUMN_PREFIX = u'_dataexplorer_bbox_'
+TRIGGER_PREFIX = u'dataexplorer_bbox_'
+BBOX_FUNCTION = u'dataexplorer_geojson_bbox'
+FUNCTION = u'dataexplorer_bbox_update'
+
+# the bounding box of the positions of a GeoJSON geometry, Feature or
+# GeometryCollection, as geo.geometry_bbox computes it; NULL when the value
+# is not JSON or has no positions
+BBOX_FUNCTION_SQL = u'''
+    CREATE OR REPLACE FUNCTION {0}(value text) RETURNS box AS $$
+    DECLARE
+        result box;
+    BEGIN
+        IF value IS NULL THEN
+            RETURN NULL;
+        END IF;
+        WITH RECURSIVE parts(part) AS (
+            SELECT value::jsonb
+            UNION ALL
+            SELECT child FROM parts, LATERAL (
+                SELECT part -> 'geometry' WHERE part ->> 'type' = 'Feature'
+                UNION ALL
+                SELECT part -> 'coordinates'
+                WHERE jsonb_typeof(part) = 'object'
+                UNION ALL
+                SELECT jsonb_array_elements(part -> 'geometries')
+                WHERE jsonb_typeof(part -> 'geometries') = 'array'
+                UNION ALL
+                SELECT jsonb_array_elements(part)
+                WHERE jsonb_typeof(part) = 'array'
+                    AND jsonb_typeof(part -> 0) = 'array'
+            ) AS children(child)
+            WHERE child IS NOT NULL
+        )
+        SELECT box(point(min((part ->> 0)::float8), min((part ->> 1)::float8)),
+                   point(max((part ->> 0)::float8), max((part ->> 1)::float8)))
+        INTO result FROM parts
+        WHERE jsonb_typeof(part) = 'array'
+            AND jsonb_typeof(part -> 0) = 'number'
+            AND jsonb_typeof(part -> 1) = 'number';
+        RETURN result;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE
+'''
+
+FUNCTION_SQL = u'''
+    CREATE OR REPLACE FUNCTION {0}() RETURNS trigger AS $$
+    BEGIN
+        -- arguments: GeoJSON column, bounding box column
+        NEW := jsonb_populate_record(NEW, jsonb_build_object(
+            TG_ARGV[1], {1}(to_jsonb(NEW) ->> TG_ARGV[0])));
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+'''
+
+
+def _suffix(field):
+    return hashlib.md5(field.encode('utf-8')).hexdigest()[:8]
+
+
+def bbox_column(field):
+    '''
+    Return the name of the hidden bounding box column of a GeoJSON field.
+    '''
+    return COLUMN_PREFIX + _suffix(field)
+
+
+def _trigger_name(field):
+    return TRIGGER_PREFIX + _suffix(field)
+
+
+def _index_name(resource_id, field):
+    return u'{0}_bbox_{1}'.format(resource_id, _suffix(field))
+
+
+def _trigger_arguments(value):
+    # pg_trigger.tgargs: NUL terminated arguments
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return [a.decode('utf-8')
+            for a in six.binary_type(value).split(b'\x00')[:-1]]
+
+
+def bbox_indexes(resource_id):
+    '''
+    Return the bounding box indexes of a DataStore table, a dict of GeoJSON
+    field names to whether the GiST index of their bounding boxes exists
+    and is usable.
+    :param resource_id: resource id
+    :type resource_id: string
+    '''
+    rows = db.execute(u'''
+        SELECT t.tgargs FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = :resource_id AND n.nspname = 'public'
+            AND t.tgname LIKE :prefix
+    ''', {'resource_id': resource_id, 'prefix': TRIGGER_PREFIX + u'%'})
+    valid = set(r['relname'] for r in db.execute(u'''
+        SELECT i.relname FROM pg_index idx
+        JOIN pg_class t ON t.oid = idx.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        JOIN pg_class i ON i.oid = idx.indexrelid
+        WHERE t.relname = :resource_id AND n.nspname = 'public'
+            AND idx.indisvalid
+    ''', {'resource_id': resource_id}))
+    result = {}
+    for row in rows:
+        field = _trigger_arguments(row['tgargs'])[0]
+        result[field] = _index_name(resource_id, field) in valid
+    return result
+
+
+def bbox_indexed(resource_id, field):
+    '''
+    Return whether the bounding boxes of a GeoJSON field are filled and
+    indexed, the index being built once every row has its box.
+    '''
+    try:
+        return bool(bbox_indexes(resource_id).get(field))
+    except SQLAlchemyError as e:
+        log.warning('Could not read the bounding box indexes of DataStore '
+                    'table %s: %s', resource_id, e)
+        return False
+
+
+def overlaps(field, bbox, params):
+    '''
+    Return the SQL condition selecting the rows whose GeoJSON ``field``
+    bounding box overlaps ``bbox``, adding its bound values to ``params``.
+    Only valid when ``bbox_indexed`` is true.
+    :param bbox: ``(min_lon, min_lat, max_lon, max_lat)``
+    :type bbox: tuple
+    '''
+    conditions = []
+    # boxes crossing the antimeridian are split in their east and west
+    # parts
+    for i, box in enumerate(geo.split_bbox(bbox)):
+        prefix = u'bbox{0}_'.format(i) if i else u'bbox_'
+        params.update({prefix + u'min_lon': box[0],
+                       prefix + u'min_lat': box[1],
+                       prefix + u'max_lon': box[2],
+                       prefix + u'max_lat': box[3]})
+        conditions.append(
+            u'{0} && box(point(:{1}min_lon, :{1}min_lat), '
+            u'point(:{1}max_lon, :{1}max_lat))'.format(
+                db.identifier(bbox_column(field)), prefix))
+    if len(conditions) == 1:
+        return conditions[0]
+    return u'(' + u' OR '.join(conditions) + u')'
+
+
+def _create_index(resource_id, field):
+    name = _index_name(resource_id, field)
+    # concurrent builds can not run in a transaction
+    engine = db.get_write_engine().execution_options(
+        isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        # left behind by a build that failed
+        connection.execute(sa.text(u'DROP INDEX CONCURRENTLY IF EXISTS {0}'
+                                   .format(db.identifier(name))))
+        connection.execute(sa.text(
+            u'CREATE INDEX CONCURRENTLY {0} ON {1} USING gist ({2})'.format(
+                db.identifier(name), db.identifier(resource_id),
+                db.identifier(bbox_column(field)))))
+        connection.execute(sa.text(u'ANALYZE {0}'.format(
+            db.identifier(resource_id))))
+
+
+def create_bbox_index(resource_id, schema, field, batch_size=10000):
+    '''
+    Create or rebuild the bounding box index of a GeoJSON field: add the
+    bounding box column and its trigger, fill the boxes of the existing
+    rows in batches of ``batch_size`` and build the GiST index
+    concurrently. Queries keep reading every geometry until the index is
+    built.
+    :param schema: table schema fields
+    :type schema: list of dicts
+    :param field: GeoJSON field
+    :type field: string
+    '''
+    db.check_fields([field], schema)
+    table = db.identifier(resource_id)
+    column = db.identifier(bbox_column(field))
+    trigger = db.identifier(_trigger_name(field))
+
+    engine = db.get_write_engine()
+    with engine.begin() as connection:
+        connection.execute(sa.text(u'ALTER TABLE {0} ADD COLUMN IF NOT '
+                                   u'EXISTS {1} box'.format(table, column)))
+        connection.execute(sa.text(BBOX_FUNCTION_SQL.format(BBOX_FUNCTION)))
+        connection.execute(sa.text(FUNCTION_SQL.format(
+            FUNCTION, BBOX_FUNCTION)))
+        # map queries fall back to reading the geometries until the boxes
+        # of every row are filled again
+        connection.execute(sa.text(u'DROP INDEX IF EXISTS {0}'.format(
+            db.identifier(_index_name(resource_id, field)))))
+        connection.execute(sa.text(u'DROP TRIGGER IF EXISTS {0} ON {1}'
+                                   .format(trigger, table)))
+        # trigger arguments are string literals, not bound parameters
+        connection.execute(sa.text(
+            u'CREATE TRIGGER {0} BEFORE INSERT OR UPDATE ON {1} FOR EACH '
+            u'ROW EXECUTE PROCEDURE {2}({3})'.format(
+                trigger, table, FUNCTION, u', '.join(
+                    u"'{0}'".format(a.replace(u"'", u"''"))
+                    .replace(u':', u'\\:')
+                    for a in [field, bbox_column(field)]))))
+
+    # the trigger computes the boxes of the rows it updates
+    last = db.execute(u'SELECT max("_id") AS "last" FROM {0}'.format(
+        table))[0]['last'] or 0
+    for start in range(0, last, batch_size):
+        with engine.begin() as connection:
+            connection.execute(sa.text(
+                u'UPDATE {0} SET {1} = NULL '
+                u'WHERE "_id" > :start AND "_id" <= :end'.format(
+                    table, column)),
+                {'start': start, 'end': start + batch_size})
+
+    _create_index(resource_id, field)
+    log.info('Created bounding box index of %s on DataStore table %s',
+             field, resource_id)
+    return bbox_indexes(resource_id)
+
+
+def drop_bbox_index(resource_id, field):
+    '''
+    Remove the bounding box index of a GeoJSON field: its trigger and
+    column, which drops the GiST index.
+    '''
+    table = db.identifier(resource_id)
+    with db.get_write_engine().begin() as connection:
+        connection.execute(sa.text(u'DROP TRIGGER IF EXISTS {0} ON {1}'
+                                   .format(db.identifier(_trigger_name(field)),
+                                           table)))
+        connection.execute(sa.text(u'ALTER TABLE {0} DROP COLUMN IF EXISTS '
+                                   u'{1}'.format(table, db.identifier(
+                                       bbox_column(field)))))
+
+
+def index_resource(resource_id, fields):
+    '''
+    Create the missing bounding box indexes of GeoJSON ``fields`` of a
+    resource and return the fields indexed. Run as a background job.
+    '''
+    from ckanext.dataexplorer.tableschema import request_schema_by_id
+
+    created = []
+    try:
+        current = bbox_indexes(resource_id)
+        schema = request_schema_by_id(resource_id)
+        for field in fields:
+            if not current.get(field):
+                create_bbox_index(resource_id, schema, field)
+                created.append(field)
+    except (toolkit.ObjectNotFound, toolkit.ValidationError,
+            SQLAlchemyError) as e:
+        log.warning('Could not create the bounding box index of DataStore '
+                    'table %s: %s', resource_id, e)
+    return created
+
+
+def restore_indexes(resource_id):
+    '''
+    Recreate the GiST indexes of bounding boxes still maintained by their
+    trigger. Run as a background job.
+    '''
+    for field, indexed in bbox_indexes(resource_id).items():
+        if not indexed:
+            _create_index(resource_id, field)
+
+
+def repair_indexes(resource_id):
+    '''
+    Queue the restore of the bounding box indexes of a table that lost
+    them: datastore_create drops the indexes of a table it is not given.
+    '''
+    if not all(bbox_indexes(resource_id).values()):
+        toolkit.enqueue_job(
+            restore_indexes, [resource_id],
+            title=u'dataexplorer bounding box index {0}'.format(resource_id))
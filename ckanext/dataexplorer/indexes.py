@@ -0,0 +1,309 @@
+# encoding: utf-8
+'''
+Management of the indexes the dataexplorer views need on DataStore tables:
+the fields views filter, group and sort on are checked against the btree
+indexes of the table and the missing ones created concurrently, without
+blocking writes or touching the other indexes. The GeoJSON fields of
+geometry map views get a bounding box index (see ``geoindex``).
+'''
+import hashlib
+from logging import getLogger
+
+import six
+import sqlalchemy as sa
+from sqlalchemy.exc import SQLAlchemyError
+
+from ckan.common import json
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db, geoindex, paging
+from ckanext.dataexplorer.tableschema import datastore_fields_to_schema
+
+log = getLogger(__name__)
+
+
+def table_indexes(resource_id):
+    '''
+    Return the field lists of the valid plain (btree, not unique, not
+    expression) indexes of a DataStore table.
+    :param resource_id: resource id
+    :type resource_id: string
+    '''
+    sql = u'''
+        SELECT array_agg(a.attname ORDER BY k.ord) AS fields
+        FROM pg_index idx
+        JOIN pg_class t ON t.oid = idx.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        JOIN pg_class i ON i.oid = idx.indexrelid
+        JOIN pg_am am ON am.oid = i.relam
+        CROSS JOIN LATERAL unnest(idx.indkey::int[])
+            WITH ORDINALITY AS k(attnum, ord)
+        LEFT JOIN pg_attribute a
+            ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE t.relname = :resource_id AND n.nspname = 'public'
+            AND am.amname = 'btree' AND idx.indisvalid
+            AND NOT idx.indisunique AND NOT idx.indisprimary
+        GROUP BY idx.indexrelid
+        HAVING bool_and(k.attnum <> 0)
+    '''
+    return [list(row['fields'])
+            for row in db.execute(sql, {'resource_id': resource_id})]
+
+
+def missing_indexes(resource_id, wanted, existing=None):
+    '''
+    Return the field lists in ``wanted`` that no index of the table, nor
+    another missing one, can serve, an index serving every leading prefix
+    of its fields.
+    :param resource_id: resource id
+    :type resource_id: string
+    :param wanted: field lists
+    :type wanted: list of lists of strings
+    '''
+    if existing is None:
+        existing = table_indexes(resource_id)
+    missing = []
+    for fields in wanted:
+        fields = list(fields)
+        if any(index[:len(fields)] == fields for index in existing):
+            continue
+        if fields not in missing:
+            missing.append(fields)
+    return [fields for fields in missing
+            if not any(len(other) > len(fields) and
+                       other[:len(fields)] == fields for other in missing)]
+
+
+def index_name(resource_id, fields):
+    '''
+    Return the name of the dataexplorer index of some fields of a table.
+    '''
+    return u'{0}_dx_{1}'.format(resource_id, hashlib.md5(
+        json.dumps(fields).encode('utf-8')).hexdigest()[:8])
+
+
+def _invalid_index(connection, name):
+    return connection.execute(sa.text(u'''
+        SELECT 1 FROM pg_index idx
+        JOIN pg_class i ON i.oid = idx.indexrelid
+        JOIN pg_namespace n ON n.oid = i.relnamespace
+        WHERE i.relname = :name AND n.nspname = 'public'
+            AND NOT idx.indisvalid
+    '''), {'name': name}).first() is not None
+
+
+def create_indexes(context, resource_id, wanted):
+    '''
+    Create the missing ``wanted`` btree indexes on a DataStore table and
+    return them. Each one is built with ``CREATE INDEX CONCURRENTLY``, which
+    does not block writes, and the other indexes of the table are left as
+    they are. Indexes that fail to build are logged and skipped.
+    :param resource_id: resource id
+    :type resource_id: string
+    :param wanted: field lists
+    :type wanted: list of lists of strings
+    '''
+    toolkit.check_access('datastore_create', dict(context),
+                         {'resource_id': resource_id})
+    resource = toolkit.get_action('resource_show')(
+        dict(context), {'id': resource_id})
+    schema = datastore_fields_to_schema(resource)
+    missing = missing_indexes(resource_id, wanted)
+    for fields in missing:
+        db.check_fields(fields, schema)
+    created = []
+    table = db.identifier(resource_id)
+    # concurrent builds can not run in a transaction
+    engine = db.get_write_engine().execution_options(
+        isolation_level='AUTOCOMMIT')
+    for fields in missing:
+        name = index_name(resource_id, fields)
+        log.info('Creating index %s on DataStore table %s',
+                 fields, resource_id)
+        with engine.connect() as connection:
+            try:
+                if _invalid_index(connection, name):
+                    # left behind by a build that failed
+                    connection.execute(sa.text(
+                        u'DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(
+                            db.identifier(name))))
+                connection.execute(sa.text(
+                    u'CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} '
+                    u'ON {1} ({2})'.format(
+                        db.identifier(name), table,
+                        u', '.join(db.identifier(f) for f in fields))))
+            except SQLAlchemyError as e:
+                log.warning('Could not create index %s on DataStore table '
+                            '%s: %s', fields, resource_id, e)
+                continue
+        created.append(fields)
+    return created
+
+
+def dataexplorer_views(resource_ids=None, view_types=None):
+    '''
+    Return the dataexplorer resource views, of the given resources and view
+    types or all of them, ordered by resource.
+    '''
+    import ckan.model as model
+    from ckanext.dataexplorer.fragments import VIEW_TYPES
+
+    query = model.Session.query(model.ResourceView).filter(
+        model.ResourceView.view_type.in_(view_types or VIEW_TYPES))
+    if resource_ids:
+        query = query.filter(
+            model.ResourceView.resource_id.in_(resource_ids))
+    return query.order_by(model.ResourceView.resource_id,
+                          model.ResourceView.order).all()
+
+
+def view_index_fields(view_type, config):
+    '''
+    Return the field lists the queries of a view filter, group or sort on:
+    the view filters, the chart group, the map latitude and longitude and
+    the sort field.
+    :param view_type: resource view type
+    :type view_type: string
+    :param config: resource view config
+    :type config: dict
+    '''
+    wanted = []
+    filters = config.get('filters') or {}
+    if filters:
+        wanted.append(sorted(filters))
+    if view_type == 'dataexplorer_chart_view' and config.get('group'):
+        wanted.append([config['group']])
+    lat = config.get('latitude_field')
+    lon = config.get('longitude_field')
+    if (view_type == 'dataexplorer_map_view' and lat and lon and
+            config.get('map_field_type') == 'lat_long'):
+        wanted.append([lat, lon])
+    if config.get('sort'):
+        sort_field = paging.parse_sort(config['sort'])[0]
+        if sort_field != '_id':
+            wanted.append([sort_field])
+    return wanted
+
+
+def view_geometry_fields(view_type, config):
+    '''
+    Return the GeoJSON fields whose bounding boxes the map data and tile
+    queries of a geometry map view select rows on.
+    :param view_type: resource view type
+    :type view_type: string
+    :param config: resource view config
+    :type config: dict
+    '''
+    field = config.get('geometry_field') or config.get('geojson_field')
+    if (view_type == 'dataexplorer_map_view' and field and
+            config.get('map_field_type') in ('geometry', 'geojson')):
+        return [field]
+    return []
+
+
+def _view_query(resource_id, schema, view_type, config, params):
+    # the query the view sends, as datastore_search or the dataexplorer
+    # actions would run it
+    where = db.where_clause(config.get('filters') or {}, schema, params)
+    order_by = u'"_id"'
+    if view_type == 'dataexplorer_chart_view' and config.get('group'):
+        order_by = db.identifier(config['group'])
+    elif config.get('sort'):
+        sort_field, descending = paging.parse_sort(config['sort'])
+        order_by = db.identifier(sort_field) + (
+            u' DESC' if descending else u'')
+    params['limit'] = int(config.get('limit') or 100)
+    return u'SELECT * FROM {0}{1} ORDER BY {2} LIMIT :limit'.format(
+        db.identifier(resource_id), where, order_by)
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        for node in _plan_nodes(child):
+            yield node
+
+
+def explain_view(resource_id, schema, view_type, config):
+    '''
+    Return the planner estimate of the query of a view: its total ``cost``
+    and whether the table is read with a sequential scan (``seq_scan``).
+    '''
+    params = {}
+    sql = _view_query(resource_id, schema, view_type, config, params)
+    plan = list(db.execute(u'EXPLAIN (FORMAT JSON) ' + sql,
+                           params)[0].values())[0]
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    plan = plan[0]['Plan']
+    return {
+        'cost': plan['Total Cost'],
+        'seq_scan': any(node['Node Type'] == 'Seq Scan'
+                        for node in _plan_nodes(plan)),
+    }
+
+
+def advise(resource_id, views, schema=None):
+    '''
+    Return, for each view of a resource, the field lists its queries need
+    indexed and the ones missing from the table, and the GeoJSON fields
+    missing a bounding box index (``bbox_missing``). With a table schema,
+    the plan of the view query is added as ``plan``.
+    :param views: resource views of the resource
+    :type views: list of ResourceView objects
+    '''
+    existing = table_indexes(resource_id)
+    bboxes = geoindex.bbox_indexes(resource_id)
+    report = []
+    for view in views:
+        config = view.config or {}
+        wanted = view_index_fields(view.view_type, config)
+        entry = {
+            'view_id': view.id,
+            'view_type': view.view_type,
+            'title': view.title,
+            'fields': wanted,
+            'missing': missing_indexes(resource_id, wanted, existing),
+            'bbox_missing': [
+                f for f in view_geometry_fields(view.view_type, config)
+                if not bboxes.get(f)],
+        }
+        if schema is not None:
+            try:
+                entry['plan'] = explain_view(
+                    resource_id, schema, view.view_type, config)
+            except toolkit.ValidationError as e:
+                entry['error'] = e.error_dict
+        report.append(entry)
+    return report
+
+
+def index_resource_views(resource_id):
+    '''
+    Create the indexes the dataexplorer views of a resource are missing.
+    Run as a background job when ``ckanext.dataexplorer.auto_index`` is on.
+    '''
+    site_user = toolkit.get_action('get_site_user')(
+        {'ignore_auth': True}, {})
+    wanted = []
+    geometry_fields = []
+    for view in dataexplorer_views([resource_id]):
+        wanted.extend(view_index_fields(view.view_type, view.config or {}))
+        geometry_fields.extend(view_geometry_fields(
+            view.view_type, view.config or {}))
+    try:
+        created = create_indexes(
+            {'ignore_auth': True, 'user': site_user['name']},
+            resource_id, wanted)
+    except (toolkit.ObjectNotFound, toolkit.ValidationError) as e:
+        log.warning('Could not index DataStore table %s: %s',
+                    resource_id, e)
+        return []
+    if geometry_fields:
+        geoindex.index_resource(resource_id, sorted(set(geometry_fields)))
+    return created
+
+
+def enqueue_index(resource_id):
+    toolkit.enqueue_job(index_resource_views, [resource_id],
+                        title=u'dataexplorer index {0}'.format(resource_id))
@@ -0,0 +1,1085 @@
+# encoding: utf-8
+from logging import getLogger
+
+import six
+from sqlalchemy.exc import DataError
+
+from ckan.common import json, config
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import (
+    db, downsample, fragments, fulltext, geo, geoindex, indexes, paging,
+    profile, query, querybuilder, sampling)
+from ckanext.dataexplorer.tableschema import (
+    datastore_fields_to_schema, invalidate_schema, schema_cache,
+    schema_field_to_datastore_field)
+
+log = getLogger(__name__)
+
+AGGREGATES = ['sum', 'avg', 'count', 'min', 'max']
+NUMERIC_TYPES = ['integer', 'number']
+DOWNSAMPLE_GROUP_TYPES = ['integer', 'number', 'date', 'datetime']
+
+
+def _datastore_changed(resource_id, created=False):
+    if not resource_id:
+        return
+    # the trigger keeps the revision of direct SQL writes, such as
+    # xloader's, exact; tables written before it existed are bumped here
+    db.bump_revision(resource_id, trigger=created)
+    invalidate_schema(resource_id)
+    query.invalidate(resource_id)
+    if toolkit.asbool(config.get('ckanext.dataexplorer.profile.on_write')):
+        profile.enqueue_profile(resource_id)
+
+
+def _json_param(data_dict, key, default):
+    '''
+    Return a list or dict parameter, which GET requests send JSON encoded.
+    '''
+    value = data_dict.get(key)
+    if value in (None, ''):
+        return default
+    if isinstance(value, six.string_types):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            if isinstance(default, list):
+                return [value]
+            raise toolkit.ValidationError({key: ['Invalid JSON']})
+    if not isinstance(value, type(default)):
+        raise toolkit.ValidationError(
+            {key: ['Must be a {0}'.format(type(default).__name__)]})
+    return value
+
+
+def _int_param(data_dict, key, default, maximum=None):
+    try:
+        value = int(data_dict.get(key, default))
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise toolkit.ValidationError({key: ['Must be a natural number']})
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+def _resource_schema(context, resource_id):
+    resource = toolkit.get_action('resource_show')(
+        dict(context), {'id': resource_id})
+    if not resource.get('datastore_active'):
+        raise toolkit.ObjectNotFound('Resource has no DataStore table')
+    return resource, datastore_fields_to_schema(resource)
+
+
+@toolkit.chained_action
+def datastore_create(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    _datastore_changed(result.get('resource_id'), created=True)
+    if result.get('resource_id'):
+        # the search vector and bounding box indexes are dropped when
+        # indexes are given
+        fulltext.repair_index(result['resource_id'])
+        geoindex.repair_indexes(result['resource_id'])
+    return result
+
+
+@toolkit.chained_action
+def datastore_upsert(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    _datastore_changed(data_dict.get('resource_id'))
+    return result
+
+
+@toolkit.chained_action
+def datastore_delete(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    _datastore_changed(data_dict.get('resource_id'))
+    return result
+
+
+def _view_saved(view):
+    if (view.get('view_type') in fragments.VIEW_TYPES and
+            toolkit.asbool(config.get('ckanext.dataexplorer.auto_index'))):
+        indexes.enqueue_index(view['resource_id'])
+
+
+@toolkit.chained_action
+def resource_view_create(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    _view_saved(result)
+    return result
+
+
+@toolkit.chained_action
+def resource_view_update(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    _view_saved(result)
+    return result
+
+
+@toolkit.side_effect_free
+def dataexplorer_cache_stats(context, data_dict):
+    '''
+    Return size, hit and miss counters of the dataexplorer caches of the
+    current process.
+    '''
+    toolkit.check_access('dataexplorer_cache_stats', context, data_dict)
+    return {'schema': schema_cache.stats(),
+            'fragments': fragments.fragment_cache.stats(),
+            'queries': query.stats()}
+
+
+@toolkit.side_effect_free
+def dataexplorer_chart_aggregate(context, data_dict):
+    '''
+    Return chart points aggregated in the database: the rows of a DataStore
+    resource grouped by ``group`` with ``aggregate`` applied to every
+    ``series`` field. The response size depends on the number of groups,
+    not on the number of rows.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param group: field to group rows by
+    :type group: string
+    :param series: fields to aggregate (list or JSON encoded list)
+    :type series: list of strings
+    :param aggregate: one of ``sum``, ``avg``, ``count``, ``min``, ``max``
+        (default: ``sum``)
+    :type aggregate: string
+    :param filters: DataStore style filters (dict or JSON encoded dict)
+    :type filters: dict
+    :param limit: maximum number of groups returned (default: 1000)
+    :type limit: int
+
+    :returns: ``fields``, ``records`` and ``total`` as datastore_search
+        does, and ``truncated``, true when more than ``limit`` groups match
+        and only the first ``limit`` ones are returned
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_chart_aggregate', context, data_dict)
+    group = toolkit.get_or_bust(data_dict, 'group')
+    series = _json_param(data_dict, 'series', [])
+    filters = _json_param(data_dict, 'filters', {})
+    aggregate = data_dict.get('aggregate') or 'sum'
+    if aggregate not in AGGREGATES:
+        raise toolkit.ValidationError({'aggregate': [
+            'Must be one of {0}'.format(', '.join(AGGREGATES))]})
+    max_groups = toolkit.asint(config.get(
+        'ckanext.dataexplorer.aggregate.max_groups', 1000))
+    limit = _int_param(data_dict, 'limit', max_groups, max_groups)
+
+    resource, schema = _resource_schema(context, resource_id)
+    db.check_fields([group] + series, schema)
+    types = dict((f['name'], f['type']) for f in schema)
+    if aggregate in ('sum', 'avg'):
+        invalid = [s for s in series if types.get(s) not in NUMERIC_TYPES]
+        if invalid:
+            raise toolkit.ValidationError({'series': [
+                'Not numeric: {0}'.format(', '.join(invalid))]})
+
+    columns = [u'{0} AS {0}'.format(db.identifier(group))]
+    for s in series:
+        columns.append(u'{0}({1}) AS {1}'.format(
+            aggregate.upper(), db.identifier(s)))
+    if not series:
+        columns.append(u'COUNT(*) AS "count"')
+    # one more group than returned tells whether groups were left out
+    params = {'limit': limit + 1}
+    sql = (u'SELECT {columns} FROM {table}{where} '
+           u'GROUP BY 1 ORDER BY 1 LIMIT :limit').format(
+        columns=u', '.join(columns),
+        table=db.identifier(resource_id),
+        where=db.where_clause(filters, schema, params))
+    records = query.run(resource_id, db.resource_revision(resource),
+                        'execute', [sql, params],
+                        lambda: db.execute(sql, params))
+    truncated = len(records) > limit
+    records = records[:limit]
+
+    fields = [schema_field_to_datastore_field(
+        {'name': group, 'type': types[group]})]
+    for s in series:
+        if aggregate in ('min', 'max'):
+            # min and max keep the type of their field
+            fields.append(schema_field_to_datastore_field(
+                {'name': s, 'type': types[s]}))
+        else:
+            fields.append({'id': s, 'type': 'int' if aggregate == 'count'
+                           else 'numeric'})
+    if not series:
+        fields.append({'id': 'count', 'type': 'int'})
+    return {
+        'resource_id': resource_id,
+        'fields': fields,
+        'records': records,
+        'total': len(records),
+        'truncated': truncated,
+    }
+
+
+@toolkit.side_effect_free
+def dataexplorer_chart_downsample(context, data_dict):
+    '''
+    Return a line chart series downsampled in the server. Rows are read in
+    ``group`` order through a server side cursor and reduced to about
+    ``points`` rows with Largest-Triangle-Three-Buckets (shape of the first
+    series) or min/max bucketing (extremes of every series).
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param group: x axis field, a number, date or datetime field
+    :type group: string
+    :param series: y axis numeric fields (list or JSON encoded list)
+    :type series: list of strings
+    :param method: ``lttb`` or ``minmax`` (default: ``lttb``)
+    :type method: string
+    :param points: target number of points (default: 2000)
+    :type points: int
+    :param filters: DataStore style filters (dict or JSON encoded dict)
+    :type filters: dict
+
+    :returns: ``fields``, ``records`` and ``total`` as datastore_search
+        does, plus ``total_rows``, the number of rows before downsampling
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_chart_downsample', context, data_dict)
+    group = toolkit.get_or_bust(data_dict, 'group')
+    series = _json_param(data_dict, 'series', [])
+    if not series:
+        raise toolkit.ValidationError({'series': ['Missing value']})
+    filters = _json_param(data_dict, 'filters', {})
+    method = data_dict.get('method') or 'lttb'
+    if method not in downsample.METHODS:
+        raise toolkit.ValidationError({'method': [
+            'Must be one of {0}'.format(', '.join(downsample.METHODS))]})
+    max_points = toolkit.asint(config.get(
+        'ckanext.dataexplorer.downsample.max_points', 10000))
+    points = _int_param(data_dict, 'points', toolkit.asint(config.get(
+        'ckanext.dataexplorer.downsample.points', 2000)), max_points)
+
+    resource, schema = _resource_schema(context, resource_id)
+    db.check_fields([group] + series, schema)
+    types = dict((f['name'], f['type']) for f in schema)
+    if types[group] not in DOWNSAMPLE_GROUP_TYPES:
+        raise toolkit.ValidationError({'group': [
+            'Must be a number, date or datetime field']})
+    invalid = [s for s in series if types.get(s) not in NUMERIC_TYPES]
+    if invalid:
+        raise toolkit.ValidationError({'series': [
+            'Not numeric: {0}'.format(', '.join(invalid))]})
+
+    not_null = [group, series[0]] if method == 'lttb' else [group]
+    params = {}
+    where = db.where_clause(filters, schema, params, [
+        u'{0} IS NOT NULL'.format(db.identifier(f)) for f in not_null])
+    table = db.identifier(resource_id)
+
+    def read():
+        total_rows = db.execute(
+            u'SELECT COUNT(*) AS "count" FROM {0}{1}'.format(table, where),
+            params)[0]['count']
+        sql = u'SELECT {columns} FROM {table}{where} ORDER BY 1'.format(
+            columns=u', '.join(db.identifier(f) for f in [group] + series),
+            table=table, where=where)
+        rows = db.stream(sql, params)
+
+        if method == 'lttb':
+            sampled = downsample.lttb(
+                ((downsample.as_number(r[0]), float(r[1]), r) for r in rows),
+                total_rows, points)
+        else:
+            sampled = downsample.minmax(
+                ((downsample.as_number(r[0]),
+                  tuple(None if v is None else float(v) for v in r[1:]), r)
+                 for r in rows),
+                total_rows, points)
+        names = [group] + series
+        return total_rows, [
+            dict(zip(names, [db.json_value(v) for v in point[2]]))
+            for point in sampled]
+
+    total_rows, records = query.run(
+        resource_id, db.resource_revision(resource), 'downsample',
+        [group, series, method, points, where, params], read)
+
+    fields = [schema_field_to_datastore_field(
+        {'name': group, 'type': types[group]})]
+    fields.extend({'id': s, 'type': 'numeric'} for s in series)
+    return {
+        'resource_id': resource_id,
+        'fields': fields,
+        'records': records,
+        'total': len(records),
+        'total_rows': total_rows,
+    }
+
+
+def _sample_settings():
+    return {
+        'max_size': toolkit.asint(config.get(
+            'ckanext.dataexplorer.sample.max_size', 10000)),
+        'max_scan': toolkit.asint(config.get(
+            'ckanext.dataexplorer.sample.max_scan', 200000)),
+    }
+
+
+def _sample_rows(resource_id, schema, method, size, seed, filters,
+                 settings):
+    params = {}
+    where = db.where_clause(filters, schema, params)
+    table_rows = db.estimate_count(resource_id)
+    matching = db.estimate_count(resource_id, where, params) \
+        if where else table_rows
+    percent = sampling.sample_percent(
+        method, size, matching, table_rows, settings['max_scan'])
+    tablesample = u''
+    if percent is not None:
+        # reservoir reads random pages of tables too big to stream whole
+        tablesample = u' TABLESAMPLE {0} (:percent) REPEATABLE (:seed)'.format(
+            u'BERNOULLI' if method == 'bernoulli' else u'SYSTEM')
+        params.update(percent=percent, seed=seed)
+    limit = u''
+    if not table_rows:
+        # without statistics the size of the table is unknown, read at
+        # most max_scan rows instead of all of them
+        limit = u' LIMIT :max_scan'
+        params['max_scan'] = settings['max_scan']
+    rows = db.stream(u'SELECT {0} FROM {1}{2}{3}{4}'.format(
+        db.select_columns(schema), db.identifier(resource_id), tablesample,
+        where, limit), params, records=True)
+    records = sorted(sampling.reservoir(rows, size, seed),
+                     key=lambda r: r['_id'])
+    if percent is None and len(records) < size:
+        # every matching row was read
+        matching = len(records)
+    return records, matching, percent
+
+
+@toolkit.side_effect_free
+def dataexplorer_sample(context, data_dict):
+    '''
+    Return a random sample of about ``size`` rows of a DataStore resource,
+    in bounded time whatever the size of the table. ``system`` and
+    ``bernoulli`` read a TABLESAMPLE of the table, ``reservoir`` a uniform
+    sample of the rows matching ``filters``. The same seed returns the same
+    sample until the table changes.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param method: ``system``, ``bernoulli`` or ``reservoir``
+        (default: ``system``)
+    :type method: string
+    :param size: number of rows (default: 1000)
+    :type size: int
+    :param seed: sample seed (default: 1)
+    :type seed: int
+    :param filters: DataStore style filters (dict or JSON encoded dict)
+    :type filters: dict
+
+    :returns: ``fields``, ``records`` and ``total`` as datastore_search
+        does, plus ``total_rows``, the estimated number of rows matching
+        the filters, ``sample_fraction``, the fraction of them in the
+        sample, and ``sample_method``
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_sample', context, data_dict)
+    method = data_dict.get('method') or 'system'
+    if method not in sampling.METHODS:
+        raise toolkit.ValidationError({'method': [
+            'Must be one of {0}'.format(', '.join(sampling.METHODS))]})
+    settings = _sample_settings()
+    size = _int_param(data_dict, 'size', 1000, settings['max_size'])
+    seed = _int_param(data_dict, 'seed', 1)
+    filters = _json_param(data_dict, 'filters', {})
+
+    resource, schema = _resource_schema(context, resource_id)
+    records, matching, percent = query.run(
+        resource_id, db.resource_revision(resource), 'sample',
+        [method, size, seed, filters, settings],
+        lambda: _sample_rows(resource_id, schema, method, size, seed,
+                             filters, settings))
+    return {
+        'resource_id': resource_id,
+        'fields': [{'id': '_id', 'type': 'int'}] + [
+            schema_field_to_datastore_field(f) for f in schema],
+        'records': records,
+        'total': len(records),
+        'total_rows': matching,
+        'sample_fraction': sampling.sample_fraction(len(records), matching),
+        'sample_method': method,
+    }
+
+
+def _map_settings():
+    return {
+        'cluster_max_zoom': toolkit.asint(config.get(
+            'ckanext.dataexplorer.map.cluster_max_zoom', 12)),
+        'cluster_cells': toolkit.asint(config.get(
+            'ckanext.dataexplorer.map.cluster_cells', 8)),
+        'max_features': toolkit.asint(config.get(
+            'ckanext.dataexplorer.map.max_features', 5000)),
+    }
+
+
+def _latlon_map_data(resource_id, schema, lat, lon, bbox, zoom, filters,
+                     limit, settings):
+    params = {'min_lon': bbox[0], 'min_lat': bbox[1],
+              'max_lon': bbox[2], 'max_lat': bbox[3]}
+    conditions = [
+        u'{0} BETWEEN :min_lat AND :max_lat'.format(db.identifier(lat))]
+    if bbox[0] <= bbox[2]:
+        conditions.append(u'{0} BETWEEN :min_lon AND :max_lon'.format(
+            db.identifier(lon)))
+    else:
+        # the box crosses the antimeridian
+        conditions.append(u'({0} >= :min_lon OR {0} <= :max_lon)'.format(
+            db.identifier(lon)))
+    where = db.where_clause(filters, schema, params, conditions)
+    table = db.identifier(resource_id)
+
+    params['limit'] = limit + 1
+    records = db.execute(u'SELECT {0} FROM {1}{2} LIMIT :limit'.format(
+        db.select_columns(schema), table, where), params)
+    truncated = len(records) > limit
+    if not truncated or zoom > settings['cluster_max_zoom']:
+        return records[:limit], False, truncated
+
+    # too many points for this zoom level, return one point per grid cell
+    params['cell'] = geo.cell_size(zoom, settings['cluster_cells'])
+    sql = (u'SELECT AVG({lat}) AS {lat}, AVG({lon}) AS {lon}, '
+           u'COUNT(*) AS point_count FROM {table}{where} '
+           u'GROUP BY floor({lon} / :cell), floor({lat} / :cell) '
+           u'LIMIT :limit').format(
+        lat=db.identifier(lat), lon=db.identifier(lon),
+        table=table, where=where)
+    # one more cell than returned tells whether cells were left out
+    cells = db.execute(sql, params)
+    return cells[:limit], True, len(cells) > limit
+
+
+def _geometry_map_data(resource_id, schema, geom_field, bbox, zoom,
+                       filters, limit, settings):
+    # GeoJSON is stored as text: the bounding box index, when the field
+    # has one, selects the candidate rows and the exact test runs here
+    # while they are streamed
+    params = {}
+    conditions = [u'{0} IS NOT NULL'.format(db.identifier(geom_field))]
+    if geoindex.bbox_indexed(resource_id, geom_field):
+        conditions.append(geoindex.overlaps(geom_field, bbox, params))
+    where = db.where_clause(filters, schema, params, conditions)
+    cursor = db.stream(u'SELECT {0} FROM {1}{2}'.format(
+        db.select_columns(schema), db.identifier(resource_id), where),
+        params, records=True)
+    cluster = zoom <= settings['cluster_max_zoom']
+    size = geo.cell_size(zoom, settings['cluster_cells'])
+    records = []
+    cells = {}
+    for row in cursor:
+        geometry = geo.load_geometry(row[geom_field])
+        box = geometry and geo.geometry_bbox(geometry)
+        if not box or not geo.bbox_intersects(box, bbox):
+            continue
+        if len(records) <= limit:
+            records.append(row)
+        if cluster:
+            lon = (box[0] + box[2]) / 2.0
+            lat = (box[1] + box[3]) / 2.0
+            cell = cells.setdefault(
+                geo.grid_key(lon, lat, size), [0, 0.0, 0.0])
+            cell[0] += 1
+            cell[1] += lon
+            cell[2] += lat
+        elif len(records) > limit:
+            break
+    if len(records) <= limit:
+        return records, False, False
+    if not cluster:
+        return records[:limit], False, True
+    points = [{
+        'point_count': count,
+        geom_field: json.dumps({'type': 'Point', 'coordinates': [
+            sum_lon / count, sum_lat / count]}),
+    } for count, sum_lon, sum_lat in list(cells.values())[:limit]]
+    return points, True, len(cells) > limit
+
+
+@toolkit.side_effect_free
+def dataexplorer_map_data(context, data_dict):
+    '''
+    Return the map rows of a DataStore resource inside a bounding box.
+    When more than ``limit`` rows fall in the box and ``zoom`` is at most
+    ``ckanext.dataexplorer.map.cluster_max_zoom``, the rows are aggregated
+    on a grid matching the zoom level and one point per cell is returned,
+    with the number of rows in ``point_count``.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param latitude_field: numeric latitude field
+    :type latitude_field: string
+    :param longitude_field: numeric longitude field
+    :type longitude_field: string
+    :param geometry_field: GeoJSON field, used when no latitude and
+        longitude fields are given
+    :type geometry_field: string
+    :param bbox: ``min_lon,min_lat,max_lon,max_lat`` (default: the world),
+        ``min_lon`` greater than ``max_lon`` when the box crosses the
+        antimeridian
+    :type bbox: string
+    :param zoom: web map zoom level (default: 0)
+    :type zoom: int
+    :param filters: DataStore style filters (dict or JSON encoded dict)
+    :type filters: dict
+    :param limit: maximum number of rows or clusters (default: 5000)
+    :type limit: int
+    :param format: ``records`` (default) or ``geojson``
+    :type format: string
+
+    :returns: ``fields``, ``records`` and ``total`` as datastore_search
+        does, plus ``clustered`` and ``truncated`` flags, ``truncated``
+        when rows or grid cells were left out to return ``limit``. With
+        ``format=geojson`` a FeatureCollection with the same flags.
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_map_data', context, data_dict)
+    lat = data_dict.get('latitude_field')
+    lon = data_dict.get('longitude_field')
+    geom_field = data_dict.get('geometry_field')
+    if not (lat and lon) and not geom_field:
+        raise toolkit.ValidationError({'latitude_field': [
+            'Give latitude_field and longitude_field or geometry_field']})
+    try:
+        bbox = geo.parse_bbox(data_dict.get('bbox'))
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({'bbox': [
+            'Must be min_lon,min_lat,max_lon,max_lat']})
+    zoom = _int_param(data_dict, 'zoom', 0, 24)
+    filters = _json_param(data_dict, 'filters', {})
+    settings = _map_settings()
+    limit = _int_param(data_dict, 'limit', settings['max_features'],
+                       settings['max_features'])
+    output = data_dict.get('format') or 'records'
+    if output not in ('records', 'geojson'):
+        raise toolkit.ValidationError({'format': [
+            'Must be records or geojson']})
+
+    resource, schema = _resource_schema(context, resource_id)
+    types = dict((f['name'], f['type']) for f in schema)
+    if lat and lon:
+        db.check_fields([lat, lon], schema)
+        invalid = [f for f in (lat, lon) if types[f] not in NUMERIC_TYPES]
+        if invalid:
+            raise toolkit.ValidationError({'latitude_field': [
+                'Not numeric: {0}'.format(', '.join(invalid))]})
+        records, clustered, truncated = query.run(
+            resource_id, db.resource_revision(resource), 'map_latlon',
+            [lat, lon, bbox, zoom, filters, limit, settings],
+            lambda: _latlon_map_data(resource_id, schema, lat, lon, bbox,
+                                     zoom, filters, limit, settings))
+    else:
+        db.check_fields([geom_field], schema)
+        records, clustered, truncated = query.run(
+            resource_id, db.resource_revision(resource), 'map_geometry',
+            [geom_field, bbox, zoom, filters, limit, settings],
+            lambda: _geometry_map_data(resource_id, schema, geom_field, bbox,
+                                       zoom, filters, limit, settings))
+
+    if clustered:
+        fields = [{'id': f, 'type': 'numeric' if f != geom_field else 'text'}
+                  for f in (lat, lon, geom_field) if f]
+        fields.append({'id': 'point_count', 'type': 'int'})
+    else:
+        fields = [{'id': '_id', 'type': 'int'}] + [
+            schema_field_to_datastore_field(f) for f in schema]
+    result = {
+        'resource_id': resource_id,
+        'fields': fields,
+        'records': records,
+        'total': len(records),
+        'clustered': clustered,
+        'truncated': truncated,
+    }
+    if output == 'geojson':
+        result = {
+            'type': 'FeatureCollection',
+            'features': [_feature(r, lat, lon, geom_field) for r in records],
+            'clustered': clustered,
+            'truncated': truncated,
+        }
+    return result
+
+
+def _feature(record, lat, lon, geom_field):
+    properties = dict(record)
+    if lat and lon:
+        geometry = {'type': 'Point', 'coordinates': [
+            properties.pop(lon), properties.pop(lat)]}
+    else:
+        geometry = geo.load_geometry(properties.pop(geom_field))
+    if 'point_count' in properties:
+        properties['cluster'] = True
+    return {'type': 'Feature', 'geometry': geometry,
+            'properties': properties}
+
+
+@toolkit.side_effect_free
+def dataexplorer_profile_show(context, data_dict):
+    '''
+    Return the precomputed column profile of the current revision of a
+    DataStore resource. Profiles are computed by a background job, queued
+    by ``ckan dataexplorer profile`` or, with
+    ``ckanext.dataexplorer.profile.on_write``, after every DataStore write.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+
+    :returns: ``rows``, the per field ``fields`` stats (``type``,
+        ``null_fraction``, ``distinct``, ``min``, ``max``, ``top`` and
+        ``histogram``) and the ``geo`` latitude and longitude candidates
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_profile_show', context, data_dict)
+    resource, schema = _resource_schema(context, resource_id)
+    result = profile.load_profile(resource)
+    if result is None:
+        raise toolkit.ObjectNotFound('Profile not computed yet')
+    return dict(result, resource_id=resource_id)
+
+
+@toolkit.side_effect_free
+def dataexplorer_query(context, data_dict):
+    '''
+    Run a query builder query on a DataStore resource. The structured spec
+    is compiled into parameterised SQL, so no raw SQL reaches the
+    database, and results are cached by compiled query and DataStore table
+    revision until the table is written to.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param fields: fields to return (default: all)
+    :type fields: list of strings
+    :param filters: DataStore style filters (dict or JSON encoded dict)
+    :type filters: dict
+    :param where: conditions ANDed together, each one
+        ``{"field": ..., "op": ..., "value": ...}`` with op one of ``=``,
+        ``!=``, ``<``, ``<=``, ``>``, ``>=``, ``like``, ``not like``,
+        ``ilike``, ``not ilike``, ``in``, ``not in``, ``between``,
+        ``is null``, ``is not null``, or ``{"or": [...]}`` /
+        ``{"and": [...]}`` groups (list or JSON encoded list)
+    :type where: list of dicts
+    :param sort: ``"field desc, other"`` or a list of ``{"field": ...,
+        "order": "asc" or "desc"}`` (default: ``_id``)
+    :type sort: string or list
+    :param limit: maximum number of rows (default: 100)
+    :type limit: int
+    :param offset: rows to skip (default: 0)
+    :type offset: int
+    :param include_total: return the number of matching rows as ``total``
+        (default: true)
+    :type include_total: bool
+
+    :returns: ``fields``, ``records``, ``total`` and
+        ``total_was_estimated`` as datastore_search does
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_query', context, data_dict)
+    spec = {
+        'fields': _json_param(data_dict, 'fields', []),
+        'filters': _json_param(data_dict, 'filters', {}),
+        'where': _json_param(data_dict, 'where', []),
+        'sort': data_dict.get('sort'),
+        'limit': data_dict.get('limit', 100),
+        'offset': data_dict.get('offset', 0),
+    }
+    if isinstance(spec['sort'], six.string_types) and \
+            spec['sort'].startswith('['):
+        spec['sort'] = _json_param(data_dict, 'sort', [])
+    rows_max = toolkit.asint(config.get(
+        'ckan.datastore.search.rows_max', 32000))
+
+    resource, schema = _resource_schema(context, resource_id)
+    sql, params, where, where_params, names = querybuilder.compile_query(
+        resource_id, schema, spec, rows_max)
+    revision = db.resource_revision(resource)
+    records = query.run(
+        resource_id, revision, 'execute', [sql, params],
+        lambda: db.execute(sql, params), query.builder_cache)
+
+    types = dict((f['name'], f) for f in schema)
+    result = {
+        'resource_id': resource_id,
+        'fields': [{'id': '_id', 'type': 'int'}] + [
+            schema_field_to_datastore_field(types[n]) for n in names
+            if n != '_id'],
+        'records': records,
+        'limit': params['limit'],
+        'offset': params['offset'],
+    }
+    if toolkit.asbool(data_dict.get('include_total', True)):
+        result['total'], result['total_was_estimated'] = query.run(
+            resource_id, revision, 'count', [where, where_params],
+            lambda: db.count_rows(resource_id, where, where_params),
+            query.builder_cache)
+    return result
+
+
+@toolkit.side_effect_free
+def dataexplorer_search(context, data_dict):
+    '''
+    Return a page of rows of a DataStore resource using keyset (cursor)
+    paging: the page after or before a cursor is found by seeking on the
+    sort field and ``_id`` instead of skipping ``offset`` rows, so deep
+    pages cost the same as the first one.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param filters: DataStore style filters (dict or JSON encoded dict)
+    :type filters: dict
+    :param sort: ``field``, ``field asc`` or ``field desc`` (default:
+        ``_id``)
+    :type sort: string
+    :param limit: rows per page (default: 100)
+    :type limit: int
+    :param cursor: ``next_cursor`` or ``prev_cursor`` of a previous page,
+        the first page is returned without it
+    :type cursor: string
+    :param include_total: return the number of matching rows as ``total``
+        (default: true for the first page, false for the pages after a
+        cursor, whose total is the one of the first page). It is a planner
+        estimate, flagged by ``total_was_estimated``, for large tables when
+        ``ckanext.dataexplorer.count.strategy`` is ``estimate``
+    :type include_total: bool
+
+    :returns: ``fields``, ``records``, ``total`` and
+        ``total_was_estimated`` as datastore_search does, ``next_cursor``
+        and ``prev_cursor`` (null on the last and first page) and the
+        matching ``_links``
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_search', context, data_dict)
+    filters = _json_param(data_dict, 'filters', {})
+    rows_max = toolkit.asint(config.get(
+        'ckan.datastore.search.rows_max', 32000))
+    limit = _int_param(data_dict, 'limit', 100, rows_max)
+    sort_field, descending = paging.parse_sort(data_dict.get('sort'))
+    cursor = data_dict.get('cursor')
+    cursor = paging.decode_cursor(cursor) if cursor else None
+
+    resource, schema = _resource_schema(context, resource_id)
+    db.check_fields([sort_field], schema)
+    table = db.identifier(resource_id)
+    filter_params = {}
+    where = db.where_clause(filters, schema, filter_params)
+    params = dict(filter_params, limit=limit + 1)
+    seek, order_by = paging.seek(sort_field, descending, cursor, params)
+    page_where = where
+    if seek:
+        page_where += (u' AND ' if where else u' WHERE ') + seek
+    sql = u'SELECT {0} FROM {1}{2} ORDER BY {3} LIMIT :limit'.format(
+        db.select_columns(schema), table, page_where, order_by)
+    revision = db.resource_revision(resource)
+    try:
+        rows = query.run(
+            resource_id, revision, 'stream', [sql, params],
+            lambda: list(db.stream(sql, params, batch_size=limit + 1)))
+    except DataError:
+        if cursor is None:
+            raise
+        # the cursor value does not cast to the type of the sort field
+        raise toolkit.ValidationError({'cursor': ['Invalid cursor']})
+    names = [u'_id'] + [f['name'] for f in schema]
+    rows = [dict(zip(names, row)) for row in rows]
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    backwards = cursor is not None and cursor['d'] == 'prev'
+    if backwards:
+        rows.reverse()
+    next_cursor = prev_cursor = None
+    if rows:
+        if more or backwards:
+            next_cursor = paging.encode_cursor(rows[-1], sort_field, 'next')
+        if cursor is not None and (more or not backwards):
+            prev_cursor = paging.encode_cursor(rows[0], sort_field, 'prev')
+
+    result = {
+        'resource_id': resource_id,
+        'fields': [{'id': '_id', 'type': 'int'}] + [
+            schema_field_to_datastore_field(f) for f in schema],
+        'records': [dict((k, db.json_value(v)) for k, v in row.items())
+                    for row in rows],
+        'sort': u'{0} {1}'.format(sort_field,
+                                  'desc' if descending else 'asc'),
+        'limit': limit,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    }
+    if toolkit.asbool(data_dict.get('include_total', cursor is None)):
+        result['total'], result['total_was_estimated'] = query.run(
+            resource_id, revision, 'count', [where, filter_params],
+            lambda: db.count_rows(resource_id, where, filter_params))
+    paging.insert_links(result, next_cursor, prev_cursor)
+    return result
+
+
+def _search_settings():
+    return {
+        'max_limit': toolkit.asint(config.get(
+            'ckanext.dataexplorer.search.max_limit', 1000)),
+        'rank_limit': toolkit.asint(config.get(
+            'ckanext.dataexplorer.search.rank_limit', 10000)),
+    }
+
+
+def _text_search_rows(resource_id, schema, index, mode, fields, q, filters,
+                      limit, offset, highlight, rank_limit):
+    params = {}
+    condition, rank = fulltext.match(index, mode, fields, q, params)
+    where = db.where_clause(filters, schema, params, [condition])
+    where_params = dict(params)
+    headlines = []
+    if highlight and mode == 'fulltext':
+        headlines = fulltext.headline_columns(fields, params)
+    params.update(limit=limit, offset=offset, rank_limit=rank_limit)
+    table = db.identifier(resource_id)
+    # only the page rows are joined back and highlighted, the rank of the
+    # matches is computed from the search vector alone
+    sql = u'''
+        WITH matches AS (
+            SELECT "_id", {rank} AS "_rank" FROM {table}{where}
+            LIMIT :rank_limit
+        ), page AS (
+            SELECT "_id", "_rank" FROM matches
+            ORDER BY "_rank" DESC, "_id" LIMIT :limit OFFSET :offset
+        )
+        SELECT {columns}, page."_rank"{headlines}
+        FROM page JOIN {table} USING ("_id")
+        ORDER BY page."_rank" DESC, "_id"
+    '''.format(
+        rank=rank, table=table, where=where,
+        columns=db.select_columns(schema),
+        headlines=u''.join(u', {0} AS "_h{1}"'.format(h, i)
+                           for i, h in enumerate(headlines)))
+    records = []
+    for row in db.execute(sql, params):
+        marked = {}
+        for i, name in enumerate(fields):
+            if headlines:
+                value = fulltext.highlight(row.pop('_h{0}'.format(i)))
+            elif highlight:
+                value = fulltext.highlight_substring(row.get(name), q)
+            else:
+                value = None
+            if value is not None:
+                marked[name] = value
+        if highlight:
+            row['_highlight'] = marked
+        records.append(row)
+    return records, where, where_params
+
+
+@toolkit.side_effect_free
+def dataexplorer_text_search(context, data_dict):
+    '''
+    Return a page of the rows of a DataStore resource matching a text
+    search, best matches first, using the search index of the resource
+    (see ``dataexplorer_search_index_create``).
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param q: search text. With ``fulltext``, words, ``"quoted phrases"``,
+        ``or`` and ``-excluded`` words (PostgreSQL 11+)
+    :type q: string
+    :param mode: ``fulltext`` (default) to match words, ``substring`` to
+        match the text anywhere in the fields (needs pg_trgm and at least
+        3 characters)
+    :type mode: string
+    :param fields: indexed fields to search (default: all of them)
+    :type fields: list of strings
+    :param filters: DataStore style filters (dict or JSON encoded dict)
+    :type filters: dict
+    :param limit: rows per page (default: 20)
+    :type limit: int
+    :param offset: rows to skip (default: 0)
+    :type offset: int
+    :param highlight: add ``_highlight``, the HTML of the matching fields
+        with the matches in ``<mark>`` tags, to each record (default: true)
+    :type highlight: bool
+    :param include_total: return the number of matching rows as ``total``
+        (default: true for the first page, false when ``offset`` is set),
+        an estimate for large tables when
+        ``ckanext.dataexplorer.count.strategy`` is ``estimate``
+    :type include_total: bool
+
+    :returns: ``fields``, ``records`` (with their ``_rank``), ``total`` and
+        ``total_was_estimated`` as datastore_search does, and
+        ``rank_limit``: when more rows match, only that many are ranked
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_text_search', context, data_dict)
+    q = (data_dict.get('q') or u'').strip()
+    mode = data_dict.get('mode') or 'fulltext'
+    errors = {}
+    if not q:
+        errors['q'] = ['Missing value']
+    elif mode == 'substring' and len(q) < 3:
+        errors['q'] = ['At least 3 characters for a substring search']
+    if mode not in fulltext.MODES:
+        errors['mode'] = ['Must be one of {0}'.format(
+            ', '.join(fulltext.MODES))]
+    if errors:
+        raise toolkit.ValidationError(errors)
+    settings = _search_settings()
+    fields = _json_param(data_dict, 'fields', [])
+    filters = _json_param(data_dict, 'filters', {})
+    limit = _int_param(data_dict, 'limit', 20, settings['max_limit'])
+    offset = _int_param(data_dict, 'offset', 0)
+    highlight = toolkit.asbool(data_dict.get('highlight', True))
+
+    resource, schema = _resource_schema(context, resource_id)
+    revision = db.resource_revision(resource)
+    index = query.run(resource_id, revision, 'search_index', [],
+                      lambda: fulltext.search_index(resource_id))
+    if not index or not index['indexed']:
+        raise toolkit.ObjectNotFound('Resource has no search index')
+    indexed = [f['name'] for f in index['fields']]
+    fields = fields or indexed
+    unknown = [f for f in fields if f not in indexed]
+    if unknown:
+        raise toolkit.ValidationError({'fields': [
+            u'Not indexed field(s): {0}'.format(u', '.join(unknown))]})
+    if mode == 'substring' and set(fields) - set(index['trigram']):
+        raise toolkit.ValidationError({'mode': [
+            'Substring search needs the pg_trgm extension']})
+
+    records, where, where_params = query.run(
+        resource_id, revision, 'text_search',
+        [mode, fields, q, filters, limit, offset, highlight,
+         settings['rank_limit']],
+        lambda: _text_search_rows(
+            resource_id, schema, index, mode, fields, q, filters, limit,
+            offset, highlight, settings['rank_limit']))
+    result = {
+        'resource_id': resource_id,
+        'fields': [{'id': '_id', 'type': 'int'}] + [
+            schema_field_to_datastore_field(f) for f in schema],
+        'records': records,
+        'q': q,
+        'mode': mode,
+        'limit': limit,
+        'offset': offset,
+        'rank_limit': settings['rank_limit'],
+    }
+    if toolkit.asbool(data_dict.get('include_total', not offset)):
+        result['total'], result['total_was_estimated'] = query.run(
+            resource_id, revision, 'count', [where, where_params],
+            lambda: db.count_rows(resource_id, where, where_params))
+    return result
+
+
+@toolkit.side_effect_free
+def dataexplorer_search_index_show(context, data_dict):
+    '''
+    Return the search index of a DataStore resource.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+
+    :returns: ``language``, the indexed ``fields`` with their ``weight``,
+        ``indexed``, false while the index is being built, and the
+        ``trigram`` indexed fields
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_search_index_show', context,
+                         data_dict)
+    _resource_schema(context, resource_id)
+    index = fulltext.search_index(resource_id)
+    if index is None:
+        raise toolkit.ObjectNotFound('Resource has no search index')
+    return dict(index, resource_id=resource_id)
+
+
+def dataexplorer_search_index_create(context, data_dict):
+    '''
+    Create or replace the search index of a DataStore resource used by
+    ``dataexplorer_text_search``. The index is built by a background job,
+    rows written afterwards are indexed as they are written.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    :param fields: text fields to index (default: all the text fields)
+    :type fields: list of strings
+    :param weights: ``A``, ``B``, ``C`` or ``D`` rank weight of fields,
+        ``A`` ranking highest (default: ``B``)
+    :type weights: dict
+    :param language: text search configuration (default:
+        ``ckan.datastore.default_fts_lang``)
+    :type language: string
+    :param trigram: create the trigram indexes of substring searches
+        (default: true)
+    :type trigram: bool
+
+    :returns: the ``fields``, ``weights`` and ``language`` of the index
+        being built
+    :rtype: dict
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_search_index_create', context,
+                         data_dict)
+    resource, schema = _resource_schema(context, resource_id)
+    fields = _json_param(data_dict, 'fields', []) or \
+        fulltext.text_fields(schema)
+    weights = _json_param(data_dict, 'weights', {})
+    language = data_dict.get('language') or fulltext.default_language()
+    fulltext.validate_index(schema, fields, weights, language)
+    fulltext.enqueue_index(resource_id, fields, weights, language,
+                           toolkit.asbool(data_dict.get('trigram', True)))
+    return {'resource_id': resource_id, 'fields': fields,
+            'weights': weights, 'language': language}
+
+
+def dataexplorer_search_index_delete(context, data_dict):
+    '''
+    Remove the search index of a DataStore resource.
+
+    :param resource_id: id of the DataStore resource
+    :type resource_id: string
+    '''
+    resource_id = toolkit.get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('dataexplorer_search_index_delete', context,
+                         data_dict)
+    _resource_schema(context, resource_id)
+    fulltext.drop_index(resource_id)
+    query.invalidate(resource_id)
+
+
+def get_actions():
+    return {
+        'datastore_create': datastore_create,
+        'datastore_upsert': datastore_upsert,
+        'datastore_delete': datastore_delete,
+        'resource_view_create': resource_view_create,
+        'resource_view_update': resource_view_update,
+        'dataexplorer_cache_stats': dataexplorer_cache_stats,
+        'dataexplorer_chart_aggregate': dataexplorer_chart_aggregate,
+        'dataexplorer_chart_downsample': dataexplorer_chart_downsample,
+        'dataexplorer_map_data': dataexplorer_map_data,
+        'dataexplorer_profile_show': dataexplorer_profile_show,
+        'dataexplorer_query': dataexplorer_query,
+        'dataexplorer_sample': dataexplorer_sample,
+        'dataexplorer_search': dataexplorer_search,
+        'dataexplorer_search_index_create': dataexplorer_search_index_create,
+        'dataexplorer_search_index_delete': dataexplorer_search_index_delete,
+        'dataexplorer_search_index_show': dataexplorer_search_index_show,
+        'dataexplorer_text_search': dataexplorer_text_search,
+    }
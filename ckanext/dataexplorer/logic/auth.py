@@ -0,0 +1,47 @@
+# encoding: utf-8
+import ckan.authz as authz
+import ckan.plugins.toolkit as toolkit
+
+
+@toolkit.auth_allow_anonymous_access
+def datastore_read(context, data_dict):
+    # same rules as datastore_search: read access to the resource
+    return authz.is_authorized(
+        'resource_show', context, {'id': data_dict.get('resource_id')})
+
+
+def datastore_write(context, data_dict):
+    # same rules as datastore_create: update access to the resource
+    return authz.is_authorized(
+        'resource_update', context, {'id': data_dict.get('resource_id')})
+
+
+def dataexplorer_cache_stats(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
+def dataexplorer_metrics(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
+def get_auth_functions():
+    return {
+        'dataexplorer_cache_stats': dataexplorer_cache_stats,
+        'dataexplorer_chart_aggregate': datastore_read,
+        'dataexplorer_chart_downsample': datastore_read,
+        'dataexplorer_export': datastore_read,
+        'dataexplorer_metrics': dataexplorer_metrics,
+        'dataexplorer_map_data': datastore_read,
+        'dataexplorer_metadata': datastore_read,
+        'dataexplorer_preview': datastore_read,
+        'dataexplorer_profile_show': datastore_read,
+        'dataexplorer_query': datastore_read,
+        'dataexplorer_sample': datastore_read,
+        'dataexplorer_search': datastore_read,
+        'dataexplorer_search_index_create': datastore_write,
+        'dataexplorer_search_index_delete': datastore_write,
+        'dataexplorer_search_index_show': datastore_read,
+        'dataexplorer_text_search': datastore_read,
+    }
@@ -0,0 +1,267 @@
+# encoding: utf-8
+'''
+Timing of the phases of view rendering: table schema, datastore_search,
+url_for, get_widget and payload serialization. Every phase is recorded in a
+latency histogram per view type and phase, and payload sizes in a size
+histogram per view type, in the memory of the current process. They are
+exported as Prometheus text, optionally sent as StatsD timers, and the
+phases of a request can be returned in a ``Server-Timing`` header.
+
+Phases may nest (a schema cache miss calls datastore_search), their times
+are not meant to add up to the render time.
+'''
+import functools
+import socket
+import threading
+import time
+from logging import getLogger
+
+from ckan.common import config
+import ckan.plugins.toolkit as toolkit
+
+log = getLogger(__name__)
+
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0]
+SIZE_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+# view type of phases timed outside a view render, such as API calls
+NO_VIEW = 'api'
+
+
+class Histogram(object):
+    '''
+    Cumulative histogram in the Prometheus layout: counts of observations
+    less than or equal to each bucket bound, plus their sum and count.
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.payload = {}
+
+    def observe_latency(self, view_type, phase, seconds):
+        with self.lock:
+            histogram = self.latency.get((view_type, phase))
+            if histogram is None:
+                histogram = self.latency[(view_type, phase)] = Histogram(
+                    LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe_payload(self, view_type, size):
+        with self.lock:
+            histogram = self.payload.get(view_type)
+            if histogram is None:
+                histogram = self.payload[view_type] = Histogram(SIZE_BUCKETS)
+            histogram.observe(size)
+
+    def clear(self):
+        with self.lock:
+            self.latency.clear()
+            self.payload.clear()
+
+
+registry = Registry()
+
+_statsd = {'address': None, 'prefix': 'dataexplorer', 'socket': None}
+
+
+def configure(config):
+    address = config.get('ckanext.dataexplorer.metrics.statsd')
+    _statsd['prefix'] = config.get(
+        'ckanext.dataexplorer.metrics.statsd_prefix', 'dataexplorer')
+    _statsd['address'] = None
+    if address:
+        host, _, port = address.rpartition(':')
+        _statsd['address'] = (host or 'localhost', int(port))
+        _statsd['socket'] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+def _send_statsd(line):
+    try:
+        _statsd['socket'].sendto(
+            u'{0}.{1}'.format(_statsd['prefix'], line).encode('utf-8'),
+            _statsd['address'])
+    except (socket.error, TypeError):
+        pass  # metrics must never fail a request
+
+
+def _request_state():
+    # per request timings and current view type, None outside a request
+    try:
+        state = getattr(toolkit.g, 'dataexplorer_metrics', None)
+        if state is None:
+            state = toolkit.g.dataexplorer_metrics = {
+                'view_type': None, 'phases': []}
+        return state
+    except (RuntimeError, TypeError, AttributeError):
+        return None
+
+
+def record(phase, seconds, view_type=None):
+    '''
+    Record the duration of a phase, under the view type being rendered
+    unless one is given.
+    '''
+    state = _request_state()
+    if view_type is None:
+        view_type = (state or {}).get('view_type') or NO_VIEW
+    registry.observe_latency(view_type, phase, seconds)
+    if state is not None:
+        state['phases'].append((view_type, phase, seconds))
+    if _statsd['address']:
+        _send_statsd(u'{0}.{1}:{2:.3f}|ms'.format(
+            view_type, phase, seconds * 1000))
+
+
+def record_payload(view_type, size):
+    '''
+    Record the size in bytes of the serialized payload of a view.
+    '''
+    registry.observe_payload(view_type or NO_VIEW, size)
+    if _statsd['address']:
+        _send_statsd(u'{0}.payload_bytes:{1}|h'.format(
+            view_type or NO_VIEW, size))
+
+
+class timer(object):
+    '''
+    Context manager recording the duration of a phase.
+    '''
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.phase, time.time() - self.start)
+
+
+def timed(phase):
+    '''
+    Decorator recording the duration of every call of a function as
+    ``phase``.
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_view(fn):
+    '''
+    Decorator of ``setup_template_variables`` recording the phases it runs
+    under the type of the view rendered, and the whole call as ``render``.
+    '''
+    @functools.wraps(fn)
+    def wrapper(self, context, data_dict):
+        view_type = data_dict['resource_view'].get('view_type') or NO_VIEW
+        state = _request_state()
+        outer = state and state['view_type']
+        if state is not None:
+            state['view_type'] = view_type
+        start = time.time()
+        try:
+            return fn(self, context, data_dict)
+        finally:
+            record('render', time.time() - start, view_type)
+            if state is not None:
+                state['view_type'] = outer
+    return wrapper
+
+
+def _labels(**labels):
+    return u','.join(u'{0}="{1}"'.format(
+        k, v.replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
+        for k, v in sorted(labels.items()))
+
+
+def _histogram_lines(name, labels, histogram):
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        yield u'{0}_bucket{{{1}}} {2}'.format(
+            name, _labels(le=u'{0:g}'.format(bound), **labels), count)
+    yield u'{0}_bucket{{{1}}} {2}'.format(
+        name, _labels(le=u'+Inf', **labels), histogram.count)
+    yield u'{0}_sum{{{1}}} {2:.6f}'.format(
+        name, _labels(**labels), histogram.sum)
+    yield u'{0}_count{{{1}}} {2}'.format(
+        name, _labels(**labels), histogram.count)
+
+
+def prometheus_text():
+    '''
+    Return the histograms of the current process in the Prometheus text
+    exposition format.
+    '''
+    lines = [
+        u'# HELP dataexplorer_phase_seconds Duration of view rendering '
+        u'phases',
+        u'# TYPE dataexplorer_phase_seconds histogram',
+    ]
+    with registry.lock:
+        for (view_type, phase), histogram in sorted(
+                registry.latency.items()):
+            lines.extend(_histogram_lines(
+                u'dataexplorer_phase_seconds',
+                {'view_type': view_type, 'phase': phase}, histogram))
+        lines.extend([
+            u'# HELP dataexplorer_payload_bytes Size of the serialized '
+            u'view payloads',
+            u'# TYPE dataexplorer_payload_bytes histogram',
+        ])
+        for view_type, histogram in sorted(registry.payload.items()):
+            lines.extend(_histogram_lines(
+                u'dataexplorer_payload_bytes', {'view_type': view_type},
+                histogram))
+    return u'\n'.join(lines) + u'\n'
+
+
+def server_timing():
+    '''
+    Return the ``Server-Timing`` header value of the phases timed in the
+    current request, summed by view type and phase, or None.
+    '''
+    state = _request_state()
+    if not state or not state['phases']:
+        return None
+    totals = {}
+    for view_type, phase, seconds in state['phases']:
+        key = u'{0}.{1}'.format(view_type, phase)
+        totals[key] = totals.get(key, 0.0) + seconds
+    return u', '.join(u'{0};dur={1:.1f}'.format(key, seconds * 1000)
+                      for key, seconds in sorted(totals.items()))
+
+
+def set_debug_header(response):
+    '''
+    ``after_request`` hook adding the ``Server-Timing`` header when
+    ``ckanext.dataexplorer.metrics.debug_header`` is on.
+    '''
+    if toolkit.asbool(config.get(
+            'ckanext.dataexplorer.metrics.debug_header')):
+        value = server_timing()
+        if value:
+            response.headers['Server-Timing'] = value
+    return response
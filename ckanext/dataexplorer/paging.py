@@ -0,0 +1,134 @@
+# encoding: utf-8
+'''
+Keyset (cursor) paging for DataStore tables. Pages are read with a WHERE
+condition seeking past the last row of the previous page on the sort field
+and ``_id``, so every page costs the same whatever its depth.
+'''
+import base64
+import datetime
+import decimal
+
+import six
+from six.moves.urllib.parse import urlencode, urlparse, urlunparse, parse_qsl
+
+from ckan.common import json
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db
+
+
+def parse_sort(sort):
+    '''
+    Return ``(field, descending)`` for a ``"field"``, ``"field asc"`` or
+    ``"field desc"`` sort string. Rows are sorted by ``_id`` by default.
+    '''
+    parts = (sort or u'_id').strip().rsplit(u' ', 1)
+    if len(parts) == 2 and parts[1].lower() in (u'asc', u'desc'):
+        return parts[0].strip().strip(u'"'), parts[1].lower() == u'desc'
+    return (sort or u'_id').strip().strip(u'"'), False
+
+
+def _cursor_value(value):
+    if isinstance(value, decimal.Decimal):
+        # keep the exact value, floats could skip or repeat rows
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date,
+                          datetime.time)):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(row, sort_field, direction):
+    '''
+    Return an opaque cursor pointing before (``prev``) or after (``next``)
+    a row, made from its raw sort field and ``_id`` values.
+    '''
+    data = {u'v': _cursor_value(row[sort_field]), u'id': row[u'_id'],
+            u'd': direction}
+    return base64.urlsafe_b64encode(
+        json.dumps(data).encode(u'utf-8')).decode(u'ascii').rstrip(u'=')
+
+
+def decode_cursor(cursor):
+    '''
+    Return the ``v``, ``id`` and ``d`` values of a cursor made by
+    ``encode_cursor``, raise a ValidationError for anything else.
+    '''
+    try:
+        padded = cursor + u'=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(
+            padded.encode(u'ascii')).decode(u'utf-8'))
+        if not isinstance(data, dict) or set(data) != {u'v', u'id', u'd'}:
+            raise ValueError(data)
+        if data[u'd'] not in (u'next', u'prev'):
+            raise ValueError(data[u'd'])
+        if isinstance(data[u'id'], bool) or \
+                not isinstance(data[u'id'], six.integer_types):
+            raise ValueError(data[u'id'])
+        if isinstance(data[u'v'], (list, dict)):
+            raise ValueError(data[u'v'])
+        return data
+    except (ValueError, TypeError, KeyError, UnicodeError):
+        raise toolkit.ValidationError({u'cursor': [u'Invalid cursor']})
+
+
+def seek(sort_field, descending, cursor, params):
+    '''
+    Return the condition and ORDER BY clause reading the page a cursor
+    points to. Rows are ordered by the sort field, nulls last, then
+    ``_id``; ``prev`` pages are read backwards and must be reversed.
+    '''
+    field = db.identifier(sort_field)
+    forward = cursor is None or cursor[u'd'] == u'next'
+    # next pages of a descending sort and prev pages of an ascending one
+    # are read in decreasing order
+    decreasing = descending == forward
+    op = u'<' if decreasing else u'>'
+    order = u'DESC' if decreasing else u'ASC'
+    nulls = u'NULLS LAST' if forward else u'NULLS FIRST'
+    if sort_field == u'_id':
+        order_by = u'"_id" {0}'.format(order)
+    else:
+        order_by = u'{0} {1} {2}, "_id" {1}'.format(field, order, nulls)
+    if cursor is None:
+        return None, order_by
+
+    params[u'cursor_id'] = cursor[u'id']
+    if sort_field == u'_id':
+        return u'"_id" {0} :cursor_id'.format(op), order_by
+    params[u'cursor_value'] = cursor[u'v']
+    if cursor[u'v'] is None:
+        if forward:
+            condition = u'{0} IS NULL AND "_id" {1} :cursor_id'
+        else:
+            condition = (u'({0} IS NOT NULL OR '
+                         u'({0} IS NULL AND "_id" {1} :cursor_id))')
+    else:
+        condition = u'({0}, "_id") {1} (:cursor_value, :cursor_id)'
+        if forward:
+            condition = u'(' + condition + u' OR {0} IS NULL)'
+    return condition.format(field, op), order_by
+
+
+def insert_links(result, next_cursor, prev_cursor):
+    '''
+    Add ``_links`` with the start, next and prev page URLs of the current
+    API request, as datastore_search does for offsets.
+    '''
+    result[u'_links'] = {}
+    try:
+        url = toolkit.request.environ[u'CKAN_CURRENT_URL']
+    except (KeyError, TypeError, RuntimeError):
+        return  # no links required for local actions
+    parsed = list(urlparse(url))
+    arguments = dict(parse_qsl(parsed[4]))
+    arguments.pop(u'cursor', None)
+    for name, cursor in ((u'start', None), (u'next', next_cursor),
+                         (u'prev', prev_cursor)):
+        if name != u'start' and not cursor:
+            continue
+        page = dict(arguments)
+        if cursor:
+            page[u'cursor'] = cursor
+        parsed[4] = urlencode(page)
+        result[u'_links'][name] = urlunparse(parsed)
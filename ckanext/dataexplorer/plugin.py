@@ -1,84 +1,346 @@
 
 from six import text_type
+from six.moves.urllib.parse import urlencode
 from logging import getLogger
 
+from sqlalchemy.exc import SQLAlchemyError
+
 from ckan.common import json, config
 import ckan.plugins as p
 import ckan.plugins.toolkit as toolkit
-from ckan.lib.helpers import url_for
+import ckan.lib.helpers as h
+
+from ckanext.dataexplorer import (
+    assets, cli, columnar, db, export, fragments, fulltext, metrics, preview,
+    query, sampling, views)
+from ckanext.dataexplorer.fragments import view_payload
+from ckanext.dataexplorer.profile import load_profile, profiled_fields
+from ckanext.dataexplorer.logic import action, auth
+from ckanext.dataexplorer.tableschema import (
+    datastore_fields_to_schema, each_datastore_field_to_schema_type,
+    request_schema, request_schema_by_id, schema_cache)
+
 log = getLogger(__name__)
 ignore_empty = p.toolkit.get_validator('ignore_empty')
 natural_number_validator = p.toolkit.get_validator('natural_number_validator')
 Invalid = p.toolkit.Invalid
+url_for = metrics.timed('url_for')(h.url_for)
+
+
+def columnar_wire():
+    '''
+    Return the extension of the column oriented data pages offered to the
+    views: ``json`` when ``ckanext.dataexplorer.wire_format`` is
+    ``columns``, ``arrow`` when it is ``arrow`` (``json`` without pyarrow),
+    None when it is ``records``, the datastore_search format.
+    '''
+    wire_format = config.get('ckanext.dataexplorer.wire_format', 'records')
+    if wire_format == 'records' or not p.plugin_loaded('dataexplorer'):
+        return None
+    if wire_format == 'arrow' and columnar.arrow_available():
+        return 'arrow'
+    return 'json'
+
 
+def columnar_api_url(resource, **params):
+    '''
+    Return the URL of the column oriented data endpoint of a resource in the
+    format of ``columnar_wire``, None when the views only use
+    datastore_search.
+    :param resource: resource dict
+    :type resource: dict
+    :param params: datastore_search style query parameters
+    :type params: dict
+    '''
+    wire = columnar_wire()
+    if not wire:
+        return None
+    params = dict((k, v) for k, v in params.items() if v is not None)
+    return '{0}{1}'.format(
+        url_for('/dataexplorer/data/{0}.{1}'.format(resource['id'], wire),
+                _external=True),
+        '?' + urlencode(params) if params else '')
 
-def each_datastore_field_to_schema_type(dstore_type):
-    # Adopted from https://github.com/frictionlessdata/datapackage-pipelines-ckan-driver/blob/master/tableschema_ckan_datastore/mapper.py
-    '''
-    For a given datastore type, return the corresponding schema type.
-    datastore int and float may have a trailing digit, which is stripped.
-    datastore arrays begin with an '_'.
-    '''
-    dstore_type = dstore_type.rstrip('0123456789')
-    if dstore_type.startswith('_'):
-        dstore_type = 'array'
-    DATASTORE_TYPE_MAPPING = {
-        'int': ('integer', None),
-        'float': ('number', None),
-        'smallint': ('integer', None),
-        'bigint': ('integer', None),
-        'integer': ('integer', None),
-        'numeric': ('number', None),
-        'money': ('number', None),
-        'timestamp': ('datetime', 'any'),
-        'date': ('date', 'any'),
-        'time': ('time', 'any'),
-        'interval': ('duration', None),
-        'text': ('string', None),
-        'varchar': ('string', None),
-        'char': ('string', None),
-        'uuid': ('string', 'uuid'),
-        'boolean': ('boolean', None),
-        'bool': ('boolean', None),
-        'json': ('object', None),
-        'jsonb': ('object', None),
-        'array': ('array', None)
+
+def columnar_info(resource, **params):
+    '''
+    Return the ``columnar`` description of a view for the widget: the
+    ``api`` URL of the column oriented data endpoint and its ``format``, or
+    None when ``ckanext.dataexplorer.wire_format`` is ``records``. The
+    ``api`` of the resource stays on datastore_search, widgets reading
+    column oriented pages use this one instead.
+    :param resource: resource dict
+    :type resource: dict
+    :param params: datastore_search style query parameters
+    :type params: dict
+    '''
+    url = columnar_api_url(resource, **params)
+    if not url:
+        return None
+    return {'api': url, 'format': columnar_wire()}
+
+
+def table_api_url(resource, filters=None):
+    '''
+    Return the datastore_search URL the table widget pages through with
+    offsets. Totals of large tables are estimated when
+    ``ckanext.dataexplorer.count.strategy`` is ``estimate``.
+    :param resource: resource dict
+    :type resource: dict
+    :param filters: view filters
+    :type filters: dict
+    '''
+    params = {}
+    if filters is not None:
+        params['filters'] = json.dumps(filters)
+    if config.get('ckanext.dataexplorer.count.strategy') == 'estimate':
+        # datastore_search estimates the total of large unfiltered tables
+        # and flags it with total_was_estimated
+        params['total_estimation_threshold'] = config.get(
+            'ckanext.dataexplorer.count.estimate_threshold', 100000)
+    return url_for('api.action', ver=3, logic_function='datastore_search',
+                   resource_id=resource['id'], _external=True, **params)
+
+
+def keyset_info(resource, filters=None):
+    '''
+    Return the ``keyset`` description of a table view for the widget: the
+    ``api`` URL of dataexplorer_search, paging with cursors, when
+    ``ckanext.dataexplorer.table.paging`` is ``keyset``, None otherwise.
+    The ``api`` of the resource stays on datastore_search.
+    :param resource: resource dict
+    :type resource: dict
+    :param filters: view filters
+    :type filters: dict
+    '''
+    if (config.get('ckanext.dataexplorer.table.paging') != 'keyset' or
+            not p.plugin_loaded('dataexplorer')):
+        return None
+    params = {}
+    if filters is not None:
+        params['filters'] = json.dumps(filters)
+    return {'api': url_for('api.action', ver=3,
+                           logic_function='dataexplorer_search',
+                           resource_id=resource['id'], _external=True,
+                           **params)}
+
+
+def query_api_url(resource):
+    '''
+    Return the URL of the dataexplorer_query action for the query builder,
+    or None without the ``dataexplorer`` plugin (the query builder then
+    falls back to datastore_search_sql).
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    if not p.plugin_loaded('dataexplorer'):
+        return None
+    return url_for('api.action', ver=3, logic_function='dataexplorer_query',
+                   resource_id=resource['id'], _external=True)
+
+
+def sample_api_url(resource, method, size, seed=None, filters=None):
+    '''
+    Return the URL of the dataexplorer_sample action returning a random
+    sample of ``size`` rows of a resource, or None without the
+    ``dataexplorer`` plugin.
+    :param resource: resource dict
+    :type resource: dict
+    :param method: one of ``sampling.METHODS``
+    :type method: string
+    '''
+    if not p.plugin_loaded('dataexplorer'):
+        return None
+    return url_for('api.action', ver=3, logic_function='dataexplorer_sample',
+                   resource_id=resource['id'], method=method, size=size,
+                   seed=seed or None, filters=json.dumps(filters or {}),
+                   _external=True)
+
+
+def view_profile(resource):
+    '''
+    Return the stored column profile of a resource, or None when it has not
+    been computed yet or the DataStore cannot be read.
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    try:
+        return load_profile(resource)
+    except SQLAlchemyError:
+        log.warning('Could not read the revision of %s', resource['id'],
+                    exc_info=True)
+        return None
+
+
+def is_form_request():
+    '''
+    Return whether the current request renders the new or edit view form,
+    the only page listing field options.
+    '''
+    try:
+        endpoint = toolkit.request.endpoint or ''
+    except (TypeError, RuntimeError):
+        return False  # outside of a request
+    return endpoint.split('.')[-1] == 'edit_view'
+
+
+def sample_info(resource, schema, method, size, filters=None, seed=None):
+    '''
+    Return the ``sample`` description of a sampled view for the widget: the
+    ``api`` URL of the dataexplorer_sample action, its method, size and the
+    estimated fraction of the matching rows it holds (None when the table
+    has no statistics). The ``api`` of the resource stays on
+    datastore_search.
+    '''
+    params = {}
+    try:
+        matching = db.estimate_count(
+            resource['id'], db.where_clause(filters or {}, schema, params),
+            params)
+    except (SQLAlchemyError, toolkit.ValidationError):
+        log.warning('Could not estimate the rows of %s', resource['id'],
+                    exc_info=True)
+        matching = None
+    return {
+        'api': sample_api_url(resource, method, size, seed, filters),
+        'method': method,
+        'size': size,
+        'fraction': sampling.sample_fraction(size, matching)
+        if matching else None,
     }
+
+
+def text_search_info(resource, filters=None):
+    '''
+    Return the ``search`` description of a table view for the widget: the
+    URL of the dataexplorer_text_search action, the indexed fields and the
+    search modes they support, or None when the resource has no search
+    index.
+    :param resource: resource dict
+    :type resource: dict
+    :param filters: view filters
+    :type filters: dict
+    '''
+    if not p.plugin_loaded('dataexplorer'):
+        return None
     try:
-        return DATASTORE_TYPE_MAPPING[dstore_type]
-    except KeyError:
-        log.warn('Unsupported DataStore type \'{}\'. Using \'string\'.'
-                 .format(dstore_type))
-        return ('string', None)
+        index = fulltext.search_index(resource['id'])
+    except SQLAlchemyError:
+        log.warning('Could not read the search index of %s',
+                    resource['id'], exc_info=True)
+        return None
+    if not index or not index['indexed']:
+        return None
+    fields = [f['name'] for f in index['fields']]
+    modes = ['fulltext']
+    if set(fields) <= set(index['trigram']):
+        modes.append('substring')
+    return {
+        'api': url_for('api.action', ver=3,
+                       logic_function='dataexplorer_text_search',
+                       resource_id=resource['id'],
+                       filters=json.dumps(filters or {}), _external=True),
+        'fields': fields,
+        'modes': modes,
+    }
 
 
-def datastore_fields_to_schema(resource):
+def export_urls(resource, filters=None):
     '''
-    Return a table schema from a DataStore field types.
+    Return the streaming export URLs of a resource by format, with the view
+    filters applied. Parquet is only offered when pyarrow is installed.
     :param resource: resource dict
     :type resource: dict
+    :param filters: view filters
+    :type filters: dict
     '''
-    data = {'resource_id': resource['id'], 'limit': 0}
-
-    fields = toolkit.get_action('datastore_search')({}, data)['fields']
-    ts_fields = []
-    for f in fields:
-        if f['id'] == '_id':
-            continue
-        datastore_type = f['type']
-        datastore_id = f['id']
-        ts_type, ts_format = each_datastore_field_to_schema_type(
-            datastore_type)
-        ts_field = {
-            'name': datastore_id,
-            'type': ts_type
-        }
-        if ts_format is not None:
-            ts_field['format'] = ts_format
-        ts_fields.append(ts_field)
-    return ts_fields
+    if not p.plugin_loaded('dataexplorer'):
+        return {}
+    query = urlencode({'filters': json.dumps(filters)}) if filters else ''
+    return dict(
+        (output, '{0}{1}'.format(
+            url_for('/dataexplorer/export/{0}.{1}'.format(
+                resource['id'], output), _external=True),
+            '?' + query if query else ''))
+        for output in export.FORMATS
+        if output != 'parquet' or export.parquet_available())
 
 
+def inline_rows(resource, filters=None):
+    '''
+    Return the first rows of a resource to embed in the datapackage under
+    ``prefetch``, so the widget can paint without a first API request. At
+    most ``ckanext.dataexplorer.inline_rows`` rows are returned, cut to fit
+    in ``ckanext.dataexplorer.inline_bytes`` bytes of JSON. Returns an
+    empty list when inlining is disabled. They are not sent as ``data``,
+    which makes the widget treat the resource as inline data without an
+    API, a total or a pager.
+    :param resource: resource dict
+    :type resource: dict
+    :param filters: view filters
+    :type filters: dict
+    '''
+    limit = toolkit.asint(config.get('ckanext.dataexplorer.inline_rows', 0))
+    if not limit:
+        return []
+    records = toolkit.get_action('datastore_search')({}, {
+        'resource_id': resource['id'],
+        'filters': filters or {},
+        'limit': limit,
+        'include_total': False,
+    })['records']
+    return _fit_records(records)
+
+
+def _fit_records(records):
+    # cut records to ckanext.dataexplorer.inline_bytes bytes of JSON
+    budget = toolkit.asint(config.get(
+        'ckanext.dataexplorer.inline_bytes', 100000))
+    size = 0
+    for i, record in enumerate(records):
+        size += len(json.dumps(record)) + 1
+        if size > budget:
+            return records[:i]
+    return records
+
+
+def add_preview(resource):
+    '''
+    Add the inferred table ``schema``, the first rows as ``data`` (cut to
+    ``ckanext.dataexplorer.inline_bytes``) and the ``preview`` URL of the
+    whole sample to a CSV, TSV, XLS or XLSX resource that is not in the
+    DataStore, so the widget does not download and parse the file.
+    Previews are built by a background job, queued on the first render;
+    resources without a preview yet are left as they are.
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    if resource.get('datastore_active') or not preview.preview_format(
+            resource):
+        return
+    try:
+        sample = preview.load_preview(resource)
+    except preview.PreviewError as e:
+        log.info('No preview for resource %s: %s', resource['id'], e)
+        return
+    except (IOError, OSError):
+        log.warning('Could not read the preview of %s', resource['id'],
+                    exc_info=True)
+        return
+    if sample is None:
+        preview.enqueue_preview(resource['id'])
+        return
+    resource.update({
+        'schema': {'fields': sample['schema']},
+        'data': _fit_records(preview.preview_records(sample)),
+    })
+    if p.plugin_loaded('dataexplorer'):
+        resource['preview'] = url_for(
+            '/dataexplorer/preview/{0}.json'.format(resource['id']),
+            _external=True)
+
+
+@metrics.timed('get_widget')
 def get_widget(view_dict, view_type, spec={}):
     '''
     Return a widges dict for a given view types.
@@ -108,19 +370,45 @@ def get_widget(view_dict, view_type, spec={}):
     return widgets
 
 
-def valid_fields_as_options(schema, valid_field_types = [] ):
+def valid_fields_as_options(schema, valid_field_types = [], profile=None,
+                            suggested=[]):
     '''
     Return a list of all datastore schema fields types for a given resource, as long as
-    the field type is in valid_field_types.
+    the field type is in valid_field_types. With a column profile, fields
+    without any value are left out and the suggested fields come first.
 
     :param schema: schema dict
     :type schema: dict
     :param valid_field_types: field types to include in returned list
     :type valid_field_types: list of strings
+    :param profile: column profile of the resource
+    :type profile: dict
+    :param suggested: field names to list first
+    :type suggested: list of strings
     '''
 
-    return [{'value': f['name'], 'text': f['name']} for f in schema
-            if f['type'] in valid_field_types or valid_field_types == [] ] 
+    fields = [f for f in schema
+              if f['type'] in valid_field_types or valid_field_types == []]
+    if profile:
+        stats = profile['fields']
+        fields = [f for f in fields
+                  if stats.get(f['name'], {}).get('null_fraction') != 1]
+    fields.sort(key=lambda f: f['name'] not in suggested)
+    return [{'value': f['name'], 'text': f['name']} for f in fields]
+
+
+def in_schema_fields(key, data, errors, context):
+    '''
+    Validator that checks that the input value is a field of the DataStore
+    table of the view resource. The schema comes from the request schema
+    context, so the renderer and the validators of a request share it.
+    '''
+    try:
+        schema = request_schema_by_id(data.get(('resource_id',)))
+    except (toolkit.ObjectNotFound, toolkit.ValidationError):
+        raise Invalid('Resource has no DataStore table')
+    if data[key] not in [f['name'] for f in schema]:
+        raise Invalid('"{0}" is not a valid parameter'.format(data[key]))
 
 
 def in_list(list_possible_values):
@@ -143,10 +431,27 @@ class DataExplorerViewBase(p.SingletonPlugin):
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.IResourceView, inherit=True)
     p.implements(p.ITemplateHelpers, inherit=True)
-    
+
+    sample_methods = [{'value': '', 'text': 'None (first rows)'},
+                      {'value': 'system',
+                       'text': 'Random pages (TABLESAMPLE SYSTEM)'},
+                      {'value': 'bernoulli',
+                       'text': 'Random rows (TABLESAMPLE BERNOULLI)'},
+                      {'value': 'reservoir',
+                       'text': 'Uniform over filtered rows (reservoir)'}]
+
+    def list_sample_methods(self):
+        return [t['value'] for t in self.sample_methods]
+
     #IConfigurable
     def configure(self, config):
         toolkit.add_resource('fanstatic', 'dataexplorer')
+        schema_cache.configure(
+            maxsize=toolkit.asint(config.get(
+                'ckanext.dataexplorer.schema_cache.size', 1000)),
+            ttl=toolkit.asint(config.get(
+                'ckanext.dataexplorer.schema_cache.ttl', 300)))
+        fragments.configure(config)
 
     # IConfigurer
     def update_config(self, config_):
@@ -166,6 +471,51 @@ class DataExplorerViewBase(p.SingletonPlugin):
         return 'dataexplorer.html'
 
 
+class DataExplorerPlugin(p.SingletonPlugin):
+    '''
+        Server side API shared by the dataexplorer views.
+    '''
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
+    p.implements(p.IBlueprint)
+    p.implements(p.IClick)
+    p.implements(p.IConfigurable)
+    p.implements(p.IMiddleware, inherit=True)
+
+    # IActions
+    def get_actions(self):
+        return action.get_actions()
+
+    # IAuthFunctions
+    def get_auth_functions(self):
+        return auth.get_auth_functions()
+
+    # IBlueprint
+    def get_blueprint(self):
+        return views.get_blueprints()
+
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
+
+    # IConfigurable
+    def configure(self, config):
+        query.configure(config)
+        metrics.configure(config)
+
+    # IMiddleware
+    def make_middleware(self, app, config):
+        if hasattr(app, 'before_request'):
+            # 304 for unchanged view pages, ETag on rendered ones
+            app.before_request(fragments.not_modified)
+            app.after_request(fragments.set_etag)
+            app.after_request(metrics.set_debug_header)
+            # precompressed, immutable bundles
+            app.before_request(assets.serve_precompressed)
+            app.after_request(assets.set_cache_headers)
+        return app
+
+
 class DataExplorerView(DataExplorerViewBase):
     '''
         This extension resources views using a v2 dataexplorer.
@@ -179,6 +529,7 @@ class DataExplorerView(DataExplorerViewBase):
                 'default_title': p.toolkit._('Data Explorer'),
                 }
 
+    @metrics.timed_view
     def setup_template_variables(self, context, data_dict):
         view_type = [('table', 'Table'), ('simple', 'Chart'),
                      ('tabularmap', 'Map')]
@@ -191,19 +542,44 @@ class DataExplorerView(DataExplorerViewBase):
         })
         
         if data_dict['resource'].get('datastore_active'):
-            schema = datastore_fields_to_schema(data_dict['resource'])
+            schema = request_schema(
+                data_dict['resource'], data_dict.get('package'))
             data_dict['resource'].update({
               'schema': {'fields': schema},
-              'api': url_for('api.action', ver=3, logic_function='datastore_search', resource_id=data_dict['resource']['id'], _external=True),
+              'api': table_api_url(data_dict['resource']),
+              'export': export_urls(data_dict['resource']),
+              'query': query_api_url(data_dict['resource']),
             })
+            wire = columnar_info(data_dict['resource'])
+            if wire:
+                data_dict['resource']['columnar'] = wire
+            keyset = keyset_info(data_dict['resource'])
+            if keyset:
+                data_dict['resource']['keyset'] = keyset
 
         datapackage = {'resources': [data_dict['resource']]}
 
+        def build():
+            if data_dict['resource'].get('datastore_active'):
+                data_dict['resource']['schema']['fields'] = profiled_fields(
+                    schema, view_profile(data_dict['resource']))
+                rows = inline_rows(data_dict['resource'])
+                if rows:
+                    data_dict['resource']['prefetch'] = {'records': rows}
+                search = text_search_info(data_dict['resource'])
+                if search:
+                    data_dict['resource']['search'] = search
+            else:
+                add_preview(data_dict['resource'])
+            return {'widgets': widgets, 'datapackage': datapackage}
+
         # TODO: Add view filter
         return {
             'resource_view': data_dict['resource_view'],
             'widgets': widgets,
-            'datapackage':  datapackage
+            'datapackage':  datapackage,
+            'payload': view_payload(data_dict['resource_view'],
+                                    data_dict['resource'], build)
         }
 
     def can_view(self, data_dict):
@@ -234,27 +610,58 @@ class DataExplorerTableView(DataExplorerViewBase):
             'default_title': p.toolkit._('Table'),
         }
 
+    @metrics.timed_view
     def setup_template_variables(self, context, data_dict):
 
         view_type = view_type = [('table', 'Table')]
 
         widgets = get_widget(data_dict['resource_view'], view_type)
-        schema = datastore_fields_to_schema(data_dict['resource'])
         filters = data_dict['resource_view'].get('filters', {})
 
         data_dict['resource'].update({
-            'schema': {'fields': schema},
             'title': data_dict['resource']['name'],
             'path': data_dict['resource']['url'],
-            'api': url_for('api.action', ver=3, logic_function='datastore_search', resource_id=data_dict['resource']['id'], filters=json.dumps(filters), _external=True),
         })
 
+        if data_dict['resource'].get('datastore_active'):
+            schema = request_schema(
+                data_dict['resource'], data_dict.get('package'))
+            data_dict['resource'].update({
+                'schema': {'fields': schema},
+                'api': table_api_url(data_dict['resource'], filters),
+                'export': export_urls(data_dict['resource'], filters),
+                'query': query_api_url(data_dict['resource']),
+            })
+            wire = columnar_info(data_dict['resource'],
+                                 filters=json.dumps(filters))
+            if wire:
+                data_dict['resource']['columnar'] = wire
+            keyset = keyset_info(data_dict['resource'], filters)
+            if keyset:
+                data_dict['resource']['keyset'] = keyset
+
         datapackage = {'resources': [data_dict['resource']]}
 
+        def build():
+            if not data_dict['resource'].get('datastore_active'):
+                add_preview(data_dict['resource'])
+                return {'widgets': widgets, 'datapackage': datapackage}
+            data_dict['resource']['schema']['fields'] = profiled_fields(
+                schema, view_profile(data_dict['resource']))
+            rows = inline_rows(data_dict['resource'], filters)
+            if rows:
+                data_dict['resource']['prefetch'] = {'records': rows}
+            search = text_search_info(data_dict['resource'], filters)
+            if search:
+                data_dict['resource']['search'] = search
+            return {'widgets': widgets, 'datapackage': datapackage}
+
         return {
             'resource_view': data_dict['resource_view'],
             'widgets': widgets,
-            'datapackage':  datapackage
+            'datapackage':  datapackage,
+            'payload': view_payload(data_dict['resource_view'],
+                                    data_dict['resource'], build)
         }
 
     def can_view(self, data_dict):
@@ -277,22 +684,43 @@ class DataExplorerChartView(DataExplorerViewBase):
     chart_types = [{'value': 'bar', 'text': 'Bar'},
                    {'value': 'line', 'text': 'Line'}]
 
-    datastore_schema = []
+    aggregates = [{'value': '', 'text': 'None (raw rows)'},
+                  {'value': 'sum', 'text': 'Sum'},
+                  {'value': 'avg', 'text': 'Average'},
+                  {'value': 'count', 'text': 'Count'},
+                  {'value': 'min', 'text': 'Minimum'},
+                  {'value': 'max', 'text': 'Maximum'}]
+
+    downsample_methods = [{'value': '', 'text': 'None'},
+                          {'value': 'lttb',
+                           'text': 'Largest-Triangle-Three-Buckets'},
+                          {'value': 'minmax', 'text': 'Min / max buckets'}]
+
     datastore_field_types = ['number', 'integer', 'datetime', 'date', 'time']
+    downsample_group_types = ['number', 'integer', 'datetime', 'date']
 
     def list_chart_types(self):
         return [t['value'] for t in self.chart_types]
 
-    def list_schema_fields(self):
-        return [t['name'] for t in self.datastore_schema]
+    def list_aggregates(self):
+        return [t['value'] for t in self.aggregates]
+
+    def list_downsample_methods(self):
+        return [t['value'] for t in self.downsample_methods]
 
     def info(self):
         schema = {
             'offset': [ignore_empty, natural_number_validator],
             'limit': [ignore_empty, natural_number_validator],
             'chart_type': [ignore_empty, in_list(self.list_chart_types)],
-            'group': [ignore_empty, in_list(self.list_schema_fields)],
-            'chart_series': [ignore_empty]
+            'group': [ignore_empty, in_schema_fields],
+            'chart_series': [ignore_empty],
+            'aggregate': [ignore_empty, in_list(self.list_aggregates)],
+            'downsample': [ignore_empty,
+                           in_list(self.list_downsample_methods)],
+            'downsample_points': [ignore_empty, natural_number_validator],
+            'sample': [ignore_empty, in_list(self.list_sample_methods)],
+            'sample_seed': [ignore_empty, natural_number_validator],
         }
 
         return {
@@ -305,6 +733,7 @@ class DataExplorerChartView(DataExplorerViewBase):
             'default_title': p.toolkit._('Chart'),
         }
 
+    @metrics.timed_view
     def setup_template_variables(self, context, data_dict):
 
         view_type = view_type = [('simple', 'Chart')]
@@ -326,31 +755,95 @@ class DataExplorerChartView(DataExplorerViewBase):
         filters = data_dict['resource_view'].get('filters', {})
         limit = data_dict['resource_view'].get('limit', 100)
         offset = data_dict['resource_view'].get('offset', 0)
-
-        self.datastore_schema = datastore_fields_to_schema(
-            data_dict['resource'])
+        aggregate = data_dict['resource_view'].get('aggregate', False)
+        downsample = data_dict['resource_view'].get('downsample', False)
+        downsample_points = data_dict['resource_view'].get(
+            'downsample_points', config.get(
+                'ckanext.dataexplorer.downsample.points', 2000))
+        sample = data_dict['resource_view'].get('sample')
+        sample_seed = data_dict['resource_view'].get('sample_seed')
+        sampled = False
+        aggregated = downsampled = None
+
+        schema = request_schema(
+            data_dict['resource'], data_dict.get('package'))
+        group_type = dict((f['name'], f['type'])
+                          for f in schema).get(group)
+
+        if (downsample and chart_type == 'line' and spec.get('series') and
+                group_type in self.downsample_group_types and
+                p.plugin_loaded('dataexplorer')):
+            # stream the whole series through the server and only send
+            # about downsample_points points to the browser
+            downsampled = {
+                'api': url_for('api.action', ver=3, logic_function='dataexplorer_chart_downsample', resource_id=data_dict['resource']['id'],
+                               group=group, series=json.dumps(spec['series']), method=downsample, points=downsample_points,
+                               filters=json.dumps(filters), _external=True),
+                'method': downsample,
+                'points': p.toolkit.asint(downsample_points),
+            }
+        elif aggregate and group and p.plugin_loaded('dataexplorer'):
+            # group and aggregate in the database, only the chart points
+            # are sent to the browser
+            aggregated = {
+                'api': url_for('api.action', ver=3, logic_function='dataexplorer_chart_aggregate', resource_id=data_dict['resource']['id'],
+                               group=group, series=json.dumps(spec.get('series', [])), aggregate=aggregate,
+                               filters=json.dumps(filters), _external=True),
+                'function': aggregate,
+            }
+        elif sample and p.plugin_loaded('dataexplorer'):
+            # a random sample of limit rows instead of the first ones
+            sampled = True
+        api = url_for('api.action', ver=3, logic_function='datastore_search', resource_id=data_dict['resource']['id'],
+                      filters=json.dumps(filters), limit=limit, offset=offset, _external=True)
+        wire = columnar_info(data_dict['resource'], filters=json.dumps(filters), limit=limit, offset=offset)
 
         data_dict['resource'].update({
-            'schema': {'fields': self.datastore_schema},
+            'schema': {'fields': schema},
             'title': data_dict['resource']['name'],
             'path': data_dict['resource']['url'],
-            'api': url_for('api.action', ver=3, logic_function='datastore_search', resource_id=data_dict['resource']['id'],
-                           filters=json.dumps(filters), limit=limit, offset=offset, _external=True),
+            'api': api,
         })
+        if wire:
+            data_dict['resource']['columnar'] = wire
+        # the api stays on datastore_search for the widget, which reads the
+        # aggregated or downsampled points from these
+        if aggregated:
+            data_dict['resource']['aggregate'] = aggregated
+        if downsampled:
+            data_dict['resource']['downsample'] = downsampled
 
         datapackage = {'resources': [data_dict['resource']]}
+        # the profile only trims the field options of the form, views read
+        # it when their payload is built
+        profile = view_profile(data_dict['resource']) \
+            if is_form_request() else None
         groups = valid_fields_as_options(
-            self.datastore_schema)
+            schema, profile=profile)
         chart_series = valid_fields_as_options(
-            self.datastore_schema, self.datastore_field_types)
+            schema, self.datastore_field_types, profile)
+
+        def build():
+            data_dict['resource']['schema']['fields'] = profiled_fields(
+                schema, view_profile(data_dict['resource']))
+            if sampled:
+                data_dict['resource']['sample'] = sample_info(
+                    data_dict['resource'], schema, sample, limit, filters,
+                    sample_seed)
+            return {'widgets': widgets, 'datapackage': datapackage}
 
         return {
             'resource_view': data_dict['resource_view'],
             'widgets': widgets,
             'datapackage':  datapackage,
+            'payload': view_payload(
+                data_dict['resource_view'], data_dict['resource'], build),
             'chart_types':  self.chart_types,
             'chart_series': chart_series,
             'groups': groups,
+            'aggregates': self.aggregates,
+            'downsample_methods': self.downsample_methods,
+            'sample_methods': self.sample_methods,
         }
 
     def can_view(self, data_dict):
@@ -377,7 +870,6 @@ class DataExplorerMapView(DataExplorerViewBase):
                         'text': 'Latitude / Longitude fields'},
                        {'value': 'geometry', 'text': 'Geometry'}]
 
-    datastore_schema = []
     datastore_field_latlon_types = ['number']
 
     datastore_field_geojson_types = ['string']
@@ -385,22 +877,18 @@ class DataExplorerMapView(DataExplorerViewBase):
     def list_map_field_types(self):
         return [t['value'] for t in self.map_field_types]
 
-    def list_schema_fields(self):
-        return [t['name'] for t in self.datastore_schema]
-
     def info(self):
         schema = {
             'offset': [ignore_empty, natural_number_validator],
             'limit': [ignore_empty, natural_number_validator],
             'map_field_type': [ignore_empty,
                                in_list(self.list_map_field_types)],
-            'latitude_field': [ignore_empty,
-                               in_list(self.list_schema_fields)],
-            'longitude_field': [ignore_empty,
-                                in_list(self.list_schema_fields)],
-            'geometry_field': [ignore_empty,
-                               in_list(self.list_schema_fields)],
-            'info_box': [ignore_empty]
+            'latitude_field': [ignore_empty, in_schema_fields],
+            'longitude_field': [ignore_empty, in_schema_fields],
+            'geometry_field': [ignore_empty, in_schema_fields],
+            'info_box': [ignore_empty],
+            'sample': [ignore_empty, in_list(self.list_sample_methods)],
+            'sample_seed': [ignore_empty, natural_number_validator],
         }
 
         return {
@@ -413,6 +901,7 @@ class DataExplorerMapView(DataExplorerViewBase):
             'schema': schema
         }
 
+    @metrics.timed_view
     def setup_template_variables(self, context, data_dict):
 
         view_type = [('tabularmap', 'Map')]
@@ -424,13 +913,17 @@ class DataExplorerMapView(DataExplorerViewBase):
         map_type = data_dict['resource_view'].get('map_field_type', False)
         lon_field = data_dict['resource_view'].get('longitude_field', False)
         lat_field = data_dict['resource_view'].get('latitude_field', False)
-        geom_field = data_dict['resource_view'].get('geojson_field', False)
+        geom_field = data_dict['resource_view'].get(
+            'geometry_field', data_dict['resource_view'].get(
+                'geojson_field', False))
         infobox = data_dict['resource_view'].get('info_box', False)
+        sample = data_dict['resource_view'].get('sample')
+        sample_seed = data_dict['resource_view'].get('sample_seed')
 
         if map_type == 'lat_long':
             spec.update({'lonField': lon_field, 'latField': lat_field})
 
-        if map_type == 'geojson':
+        if map_type in ('geometry', 'geojson'):
             spec.update({'geomField': geom_field})
 
         if infobox:
@@ -438,29 +931,83 @@ class DataExplorerMapView(DataExplorerViewBase):
 
         widgets = get_widget(data_dict['resource_view'], view_type, spec)
 
-        self.datastore_schema = datastore_fields_to_schema(
-            data_dict['resource'])
+        schema = request_schema(
+            data_dict['resource'], data_dict.get('package'))
+
+        # a random sample of limit rows over the whole map
+        sampled = sample and p.plugin_loaded('dataexplorer')
+        map_data = None
+        if (not sampled and map_type == 'lat_long' and lat_field and
+                lon_field and p.plugin_loaded('dataexplorer')):
+            # rows filtered by bounding box, clustered when there are more
+            # than limit of them
+            map_data = {'api': url_for('api.action', ver=3, logic_function='dataexplorer_map_data', resource_id=data_dict['resource']['id'],
+                                       latitude_field=lat_field, longitude_field=lon_field, filters=json.dumps(filters),
+                                       limit=data_dict['resource_view'].get('limit') or None, _external=True)}
+        api = url_for('api.action', ver=3, logic_function='datastore_search', resource_id=data_dict['resource']['id'], filters=json.dumps(filters), limit=limit, offset=offset, _external=True)
+        wire = columnar_info(data_dict['resource'], filters=json.dumps(filters), limit=limit, offset=offset)
 
         data_dict['resource'].update({
-            'schema': {'fields': self.datastore_schema},
+            'schema': {'fields': schema},
             'title': data_dict['resource']['name'],
             'path': data_dict['resource']['url'],
-            'api': url_for('api.action', ver=3, logic_function='datastore_search', resource_id=data_dict['resource']['id'], filters=json.dumps(filters), limit=limit, offset=offset, _external=True),
+            'api': api,
         })
+        if wire:
+            data_dict['resource']['columnar'] = wire
+        if map_data:
+            # the api stays on datastore_search for the widget, which reads
+            # the bounding box rows and clusters from this one
+            data_dict['resource']['map'] = map_data
+
+        if (map_type in ('geometry', 'geojson') and geom_field and
+                p.plugin_loaded('dataexplorer')):
+            # XYZ template of simplified, cached GeoJSON tiles
+            data_dict['resource']['tiles'] = '{0}/{{z}}/{{x}}/{{y}}.geojson?{1}'.format(
+                url_for('/dataexplorer/tiles/' + data_dict['resource']['id'], _external=True),
+                urlencode({'geometry_field': geom_field, 'filters': json.dumps(filters)}))
 
         datapackage = {'resources': [data_dict['resource']]}
+        # the profile only trims and orders the field options of the form,
+        # views read it when their payload is built
+        profile = view_profile(data_dict['resource']) \
+            if is_form_request() else None
+        candidates = (profile or {}).get(
+            'geo', {'latitude': [], 'longitude': []})
         map_latlon_fields = valid_fields_as_options(
-            self.datastore_schema, self.datastore_field_latlon_types)
+            schema, self.datastore_field_latlon_types, profile)
+        map_latitude_fields = valid_fields_as_options(
+            schema, self.datastore_field_latlon_types, profile,
+            candidates['latitude'])
+        map_longitude_fields = valid_fields_as_options(
+            schema, self.datastore_field_latlon_types, profile,
+            candidates['longitude'])
         map_geojson_fields = valid_fields_as_options(
-            self.datastore_schema, self.datastore_field_geojson_types)
+            schema, self.datastore_field_geojson_types, profile)
+
+        def build():
+            data_dict['resource']['schema']['fields'] = profiled_fields(
+                schema, view_profile(data_dict['resource']))
+            if sampled:
+                data_dict['resource']['sample'] = sample_info(
+                    data_dict['resource'], schema, sample, limit, filters,
+                    sample_seed)
+            return {'widgets': widgets, 'datapackage': datapackage}
 
         return {
             'resource_view': data_dict['resource_view'],
             'widgets': widgets,
             'datapackage':  datapackage,
+            'payload': view_payload(
+                data_dict['resource_view'], data_dict['resource'], build),
             'map_field_types': self.map_field_types,
             'map_latlon_fields': map_latlon_fields,
-            'map_geometry_fields': map_geojson_fields
+            'map_latitude_fields': map_latitude_fields,
+            'map_longitude_fields': map_longitude_fields,
+            'suggested_latitude_field': (candidates['latitude'] or [''])[0],
+            'suggested_longitude_field': (candidates['longitude'] or [''])[0],
+            'map_geometry_fields': map_geojson_fields,
+            'sample_methods': self.sample_methods,
         }
 
     def can_view(self, data_dict):
@@ -494,6 +1041,7 @@ class DataExplorerWebView(DataExplorerViewBase):
             'default_title': p.toolkit._('Web'),
         }
 
+    @metrics.timed_view
     def setup_template_variables(self, context, data_dict):
         view_type = [('web', 'Web')]
 
@@ -515,7 +1063,10 @@ class DataExplorerWebView(DataExplorerViewBase):
         return {
             'resource': data_dict['resource'],
             'widgets': widgets,
-            'datapackage':  datapackage
+            'datapackage':  datapackage,
+            'payload': view_payload(
+                data_dict['resource_view'], data_dict['resource'],
+                lambda: {'widgets': widgets, 'datapackage': datapackage})
         }
 
     def form_template(self, context, data_dict):
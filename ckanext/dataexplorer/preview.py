@@ -0,0 +1,485 @@
+# encoding: utf-8
+'''
+Previews of CSV, TSV, XLS and XLSX resources that are not in the DataStore.
+The first rows of the file are streamed from the upload or the resource URL,
+a table schema is inferred in the format of ``datastore_fields_to_schema``
+and the parsed sample is cached on disk as gzipped columnar JSON, keyed by
+URL and last modification, so the widget never downloads the whole file.
+
+Previews are built by a background job, never while a page renders, and
+remote files are only fetched from public addresses, so resource URLs can
+not be used to reach the internal network of the site.
+'''
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import ipaddress
+import os
+import re
+import shutil
+import socket
+import tempfile
+import time
+from logging import getLogger
+
+import requests
+import six
+from six.moves.urllib.parse import urljoin, urlparse
+
+from ckan.common import json, config
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer.cache import cache_directory
+
+log = getLogger(__name__)
+
+FORMATS = ['csv', 'tsv', 'xls', 'xlsx']
+SNIFF_BYTES = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+INTEGER = re.compile(r'^[-+]?\d+$')
+NUMBER = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+BOOLEANS = {'true': True, 'false': False}
+MAX_REDIRECTS = 5
+# seconds before a file that could not be previewed is tried again
+ERROR_TTL = 3600
+
+
+class PreviewError(Exception):
+    pass
+
+
+def preview_format(resource):
+    '''
+    Return the preview format of a resource, or None when it has none.
+    '''
+    resource_format = (resource.get('format') or '').lower().lstrip('.')
+    return resource_format if resource_format in FORMATS else None
+
+
+def _settings():
+    return {
+        'rows': toolkit.asint(config.get(
+            'ckanext.dataexplorer.preview.rows', 1000)),
+        'max_bytes': toolkit.asint(config.get(
+            'ckanext.dataexplorer.preview.max_bytes', 50 * 1024 * 1024)),
+        'timeout': toolkit.asint(config.get(
+            'ckanext.dataexplorer.preview.timeout', 30)),
+        'allowed_hosts': set(toolkit.aslist(config.get(
+            'ckanext.dataexplorer.preview.allowed_hosts', ''))),
+    }
+
+
+def _upload_path(resource):
+    if resource.get('url_type') != 'upload':
+        return None
+    from ckan.lib.uploader import get_resource_uploader
+    try:
+        path = get_resource_uploader(resource).get_path(resource['id'])
+    except (AttributeError, TypeError):
+        # uploaders storing files elsewhere than on disk
+        return None
+    return path if path and os.path.exists(path) else None
+
+
+def check_url(url, allowed_hosts=()):
+    '''
+    Raise PreviewError unless ``url`` is an http or https URL of a host
+    whose addresses are all public: loopback, private, link-local and
+    reserved networks are refused. Hosts in ``allowed_hosts`` may resolve
+    to any address.
+    '''
+    parts = urlparse(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise PreviewError(u'Unsupported URL {0}'.format(url))
+    if parts.hostname in allowed_hosts:
+        return
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or (
+            443 if parts.scheme == 'https' else 80), 0, socket.SOCK_STREAM)
+    except (socket.error, UnicodeError) as e:
+        raise PreviewError(u'Could not resolve {0}: {1}'.format(
+            parts.hostname, e))
+    for info in infos:
+        # IPv6 addresses may carry a zone, fe80::1%eth0
+        address = ipaddress.ip_address(
+            six.text_type(info[4][0]).split(u'%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise PreviewError(u'{0} is not a public address'.format(
+                parts.hostname))
+
+
+def _open(resource, settings):
+    '''
+    Return a binary file object reading the resource file: the upload on
+    disk, or the resource URL streamed and cut at ``max_bytes``. Every URL
+    of a redirect chain is checked with ``check_url``.
+    '''
+    path = _upload_path(resource)
+    if path:
+        return io.open(path, 'rb')
+    url = resource['url']
+    try:
+        for i in range(MAX_REDIRECTS + 1):
+            check_url(url, settings['allowed_hosts'])
+            response = requests.get(url, stream=True, allow_redirects=False,
+                                    timeout=settings['timeout'])
+            if not response.is_redirect:
+                break
+            response.close()
+            url = urljoin(url, response.headers['location'])
+        else:
+            raise PreviewError(u'Too many redirects from {0}'.format(
+                resource['url']))
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise PreviewError(u'Could not fetch {0}: {1}'.format(
+            resource['url'], e))
+    response.raw.decode_content = True
+    return _LimitedReader(response, settings['max_bytes'])
+
+
+class _LimitedReader(io.RawIOBase):
+
+    def __init__(self, response, limit):
+        self.response = response
+        self.chunks = response.iter_content(CHUNK_SIZE)
+        self.remaining = limit
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer and self.remaining > 0:
+            self.buffer = next(self.chunks, b'')[:self.remaining]
+            self.remaining -= len(self.buffer)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.response.close()
+        super(_LimitedReader, self).close()
+
+
+def _csv_rows(f, resource_format, limit):
+    buffered = io.BufferedReader(f, SNIFF_BYTES)
+    sample = buffered.peek(SNIFF_BYTES).decode('utf-8', 'replace')
+    try:
+        dialect = csv.Sniffer().sniff(
+            sample, delimiters='\t' if resource_format == 'tsv' else ',;\t|')
+    except csv.Error:
+        dialect = csv.excel_tab if resource_format == 'tsv' else csv.excel
+    text = io.TextIOWrapper(buffered, encoding='utf-8-sig', errors='replace',
+                            newline='')
+    for i, row in enumerate(csv.reader(text, dialect)):
+        if i > limit:
+            break
+        yield row
+
+
+def _seekable(f):
+    '''
+    Return a seekable copy of a file object, spooled to disk when large.
+    '''
+    if f.seekable():
+        return f
+    copy = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    shutil.copyfileobj(f, copy, CHUNK_SIZE)
+    f.close()
+    copy.seek(0)
+    return copy
+
+
+def _xlsx_rows(f, limit):
+    try:
+        import openpyxl
+    except ImportError:
+        raise PreviewError(u'XLSX previews need openpyxl')
+    workbook = openpyxl.load_workbook(_seekable(f), read_only=True,
+                                      data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        for i, row in enumerate(sheet.iter_rows(values_only=True)):
+            if i > limit:
+                break
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+def _xls_rows(f, limit):
+    try:
+        import xlrd
+    except ImportError:
+        raise PreviewError(u'XLS previews need xlrd')
+    book = xlrd.open_workbook(file_contents=_seekable(f).read(),
+                              on_demand=True)
+    sheet = book.sheet_by_index(0)
+    for i in range(min(sheet.nrows, limit + 1)):
+        row = []
+        for cell in sheet.row(i):
+            if cell.ctype == xlrd.XL_CELL_DATE:
+                row.append(xlrd.xldate.xldate_as_datetime(
+                    cell.value, book.datemode))
+            else:
+                row.append(cell.value)
+        yield row
+
+
+def _header(row, width):
+    names = []
+    for i in range(width):
+        value = row[i] if i < len(row) else None
+        name = six.text_type(value).strip() if value not in (None, '') \
+            else u'column_{0}'.format(i + 1)
+        while name in names:
+            name += u'_'
+        names.append(name)
+    return names
+
+
+def _parse_date(value):
+    for fmt, kind in (('%Y-%m-%d', 'date'), ('%Y-%m-%dT%H:%M:%S', 'datetime'),
+                      ('%Y-%m-%d %H:%M:%S', 'datetime')):
+        try:
+            return datetime.datetime.strptime(value, fmt), kind
+        except ValueError:
+            continue
+    return None, None
+
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, six.integer_types):
+        return 'integer'
+    if isinstance(value, float):
+        return 'integer' if value.is_integer() else 'number'
+    if isinstance(value, datetime.datetime):
+        return 'date' if value.time() == datetime.time() else 'datetime'
+    if isinstance(value, datetime.date):
+        return 'date'
+    value = six.text_type(value).strip()
+    if INTEGER.match(value):
+        return 'integer'
+    if NUMBER.match(value):
+        return 'number'
+    if value.lower() in BOOLEANS:
+        return 'boolean'
+    return _parse_date(value)[1] or 'string'
+
+
+def infer_type(values):
+    '''
+    Return the table schema type of a column from its sampled values.
+    '''
+    types = set(_value_type(v) for v in values if v not in (None, u''))
+    if not types:
+        return 'string'
+    if len(types) == 1:
+        return types.pop()
+    if types <= set(['integer', 'number']):
+        return 'number'
+    if types <= set(['date', 'datetime']):
+        return 'datetime'
+    return 'string'
+
+
+def _cast(value, field_type):
+    if value in (None, u''):
+        return None
+    if field_type == 'integer':
+        return int(float(value))
+    if field_type == 'number':
+        return float(value)
+    if field_type == 'boolean':
+        return value if isinstance(value, bool) else \
+            BOOLEANS[six.text_type(value).strip().lower()]
+    if field_type in ('date', 'datetime'):
+        if not isinstance(value, datetime.date):
+            value = _parse_date(six.text_type(value).strip())[0]
+        if field_type == 'date' and isinstance(value, datetime.datetime):
+            value = value.date()
+        return value.isoformat()
+    return six.text_type(value)
+
+
+def build_preview(resource, settings):
+    '''
+    Return ``{"schema": [...], "columns": [[...], ...]}`` for the first
+    ``rows`` rows of a resource file, the first row being the header.
+    '''
+    resource_format = preview_format(resource)
+    f = _open(resource, settings)
+    try:
+        if resource_format in ('csv', 'tsv'):
+            rows = list(_csv_rows(f, resource_format, settings['rows']))
+        elif resource_format == 'xlsx':
+            rows = list(_xlsx_rows(f, settings['rows']))
+        else:
+            rows = list(_xls_rows(f, settings['rows']))
+    finally:
+        f.close()
+    if not rows:
+        raise PreviewError(u'Empty file')
+
+    width = max(len(r) for r in rows)
+    names = _header(rows[0], width)
+    body = [list(r) + [None] * (width - len(r)) for r in rows[1:]]
+    columns = [list(c) for c in zip(*body)] or [[] for n in names]
+    schema = []
+    for i, name in enumerate(names):
+        field_type = infer_type(columns[i])
+        schema.append({'name': name, 'type': field_type})
+        columns[i] = [_cast(v, field_type) for v in columns[i]]
+    return {'schema': schema, 'columns': columns}
+
+
+def _preview_path(resource, settings):
+    key = hashlib.sha1(json.dumps([
+        resource.get('url'),
+        resource.get('last_modified') or resource.get('metadata_modified'),
+        settings['rows'],
+    ]).encode('utf-8')).hexdigest()
+    return os.path.join(cache_directory('previews', resource['id']),
+                        key + '.json.gz')
+
+
+def _error_path(path):
+    # marker of a file version that can not be previewed
+    return path[:-len('.json.gz')] + '.error'
+
+
+def load_preview(resource):
+    '''
+    Return the stored preview of the current version of a resource file,
+    or None when it has not been built yet. Raises PreviewError when the
+    file can not be previewed.
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    if not preview_format(resource):
+        raise PreviewError(u'Unsupported format')
+    path = _preview_path(resource, _settings())
+    try:
+        with gzip.open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        pass
+    if _failed(path):
+        with io.open(_error_path(path), encoding='utf-8') as f:
+            raise PreviewError(f.read())
+    return None
+
+
+def _failed(path):
+    try:
+        return os.path.getmtime(_error_path(path)) > time.time() - ERROR_TTL
+    except OSError:
+        return False
+
+
+def preview_state(resource):
+    '''
+    Return ``ready`` when the preview of the current version of a resource
+    file is stored, ``failed`` when the file can not be previewed and None
+    when it has not been built yet.
+    '''
+    path = _preview_path(resource, _settings())
+    if os.path.exists(path):
+        return 'ready'
+    if _failed(path):
+        return 'failed'
+    return None
+
+
+def _store(path, data):
+    # write next to the older versions, then remove the ones older than
+    # this one; concurrent jobs may be writing or removing files as well
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    written = os.path.getmtime(path)
+    for name in os.listdir(directory):
+        other = os.path.join(directory, name)
+        if other == path or name.endswith('.tmp'):
+            continue
+        try:
+            if os.path.getmtime(other) < written:
+                os.remove(other)
+        except OSError:
+            pass  # removed by another job
+
+
+def _gzip_json(obj):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+    return buf.getvalue()
+
+
+def update_preview(resource):
+    '''
+    Build and store the preview of the current version of a resource file,
+    unless it is already stored, and return it. Files that can not be
+    previewed are recorded as such and raise PreviewError.
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    sample = load_preview(resource)
+    if sample is not None:
+        return sample
+    settings = _settings()
+    path = _preview_path(resource, settings)
+    try:
+        sample = build_preview(resource, settings)
+    except Exception as e:
+        # uploaded files are parsed by csv, openpyxl and xlrd, whatever
+        # they raise on a broken file means there is no preview
+        _store(_error_path(path), six.text_type(e).encode('utf-8'))
+        if isinstance(e, PreviewError):
+            raise
+        raise PreviewError(six.text_type(e))
+    _store(path, _gzip_json(sample))
+    return sample
+
+
+def preview_resource(resource_id):
+    '''
+    Background job building the preview of a resource file.
+    '''
+    resource = toolkit.get_action('resource_show')(
+        {'ignore_auth': True}, {'id': resource_id})
+    if resource.get('datastore_active') or not preview_format(resource):
+        return None
+    try:
+        return update_preview(resource)
+    except PreviewError as e:
+        log.info('No preview for resource %s: %s', resource_id, e)
+        return None
+
+
+def enqueue_preview(resource_id):
+    toolkit.enqueue_job(preview_resource, [resource_id],
+                        title=u'dataexplorer preview {0}'.format(resource_id))
+
+
+def preview_records(preview):
+    '''
+    Return the rows of a preview as datastore_search style records.
+    '''
+    names = [f['name'] for f in preview['schema']]
+    return [dict(zip(names, row)) for row in zip(*preview['columns'])]
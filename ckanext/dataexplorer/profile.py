@@ -0,0 +1,280 @@
+# encoding: utf-8
+'''
+Column profiles of DataStore resources: row and null counts, min/max,
+approximate distinct counts (HyperLogLog), top values and histograms.
+Profiles are computed by a background job and stored on disk per resource
+revision, so the views never scan a table to suggest fields or ranges.
+'''
+import hashlib
+import io
+import math
+import os
+import re
+import struct
+import tempfile
+from logging import getLogger
+
+import six
+
+from ckan.common import json, config
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db
+from ckanext.dataexplorer.cache import cache_directory
+from ckanext.dataexplorer.tableschema import datastore_fields_to_schema
+
+log = getLogger(__name__)
+
+NUMERIC_TYPES = ['integer', 'number']
+RANGE_TYPES = NUMERIC_TYPES + ['date', 'datetime', 'time']
+TOP_K_TYPES = ['string', 'integer', 'boolean', 'date']
+LATITUDE_NAME = re.compile(r'(^|_|\b)lat(itude)?($|_|\b)', re.I)
+LONGITUDE_NAME = re.compile(r'(^|_|\b)(lon|lng|long|longitude)($|_|\b)',
+                            re.I)
+
+
+class HyperLogLog(object):
+    '''
+    HyperLogLog distinct counter with ``2 ** precision`` registers, about
+    ``1.04 / sqrt(2 ** precision)`` relative error.
+    '''
+
+    def __init__(self, precision=12):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        digest = hashlib.sha1(
+            six.text_type(value).encode('utf-8')).digest()
+        x = struct.unpack('>Q', digest[:8])[0]
+        index = x >> (64 - self.p)
+        rest = (x << self.p) & 0xFFFFFFFFFFFFFFFF
+        rank = 1
+        while rank <= 64 - self.p and not rest & (1 << 63):
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / sum(
+            2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # small range correction
+            estimate = self.m * math.log(float(self.m) / zeros)
+        return int(round(estimate))
+
+
+class TopK(object):
+    '''
+    Space-Saving heavy hitters: keeps ``capacity`` counters and reports the
+    most frequent values with an upper bound of their count.
+    '''
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, value):
+        if value in self.counts:
+            self.counts[value] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = 1
+        else:
+            smallest = min(self.counts, key=self.counts.get)
+            self.counts[value] = self.counts.pop(smallest) + 1
+
+    def top(self, k):
+        return sorted(self.counts.items(), key=lambda i: -i[1])[:k]
+
+
+class Histogram(object):
+    '''
+    Equal width histogram between a known minimum and maximum.
+    '''
+
+    def __init__(self, minimum, maximum, bins=20):
+        self.minimum = minimum
+        self.width = (maximum - minimum) / float(bins) or 1.0
+        self.counts = [0] * bins
+
+    def add(self, value):
+        index = int((value - self.minimum) / self.width)
+        self.counts[min(max(index, 0), len(self.counts) - 1)] += 1
+
+    def as_dict(self):
+        return {'edges': [self.minimum + i * self.width
+                          for i in range(len(self.counts) + 1)],
+                'counts': self.counts}
+
+
+def _ranges(resource_id, schema):
+    columns = [u'COUNT(*) AS "rows"']
+    for i, f in enumerate(schema):
+        name = db.identifier(f['name'])
+        columns.append(u'COUNT({0}) AS "n{1}"'.format(name, i))
+        if f['type'] in RANGE_TYPES:
+            columns.append(u'MIN({0}) AS "min{1}", MAX({0}) AS "max{1}"'
+                           .format(name, i))
+    return db.execute(u'SELECT {0} FROM {1}'.format(
+        u', '.join(columns), db.identifier(resource_id)))[0]
+
+
+def _geo_candidates(fields):
+    latitude = []
+    longitude = []
+    for name, stats in fields.items():
+        if stats['type'] not in NUMERIC_TYPES or stats.get('min') is None:
+            continue
+        if -90 <= stats['min'] and stats['max'] <= 90 and \
+                LATITUDE_NAME.search(name):
+            latitude.append(name)
+        elif -180 <= stats['min'] and stats['max'] <= 180 and \
+                LONGITUDE_NAME.search(name):
+            longitude.append(name)
+    return {'latitude': sorted(latitude), 'longitude': sorted(longitude)}
+
+
+def compute_profile(resource_id, schema):
+    '''
+    Return the profile of a DataStore table: one aggregate query for counts
+    and ranges, then one streamed pass for the sketches.
+    :param resource_id: resource id
+    :type resource_id: string
+    :param schema: table schema fields
+    :type schema: list of dicts
+    '''
+    top_k = toolkit.asint(config.get('ckanext.dataexplorer.profile.top_k',
+                                     10))
+    bins = toolkit.asint(config.get('ckanext.dataexplorer.profile.bins', 20))
+    ranges = _ranges(resource_id, schema)
+    rows = ranges['rows']
+    sketches = []
+    fields = {}
+    for i, f in enumerate(schema):
+        stats = {'type': f['type'],
+                 'null_fraction': (1 - float(ranges['n%d' % i]) / rows)
+                 if rows else 0.0}
+        histogram = None
+        if f['type'] in RANGE_TYPES:
+            stats['min'] = db.json_value(ranges['min%d' % i])
+            stats['max'] = db.json_value(ranges['max%d' % i])
+            if f['type'] in NUMERIC_TYPES and stats['min'] is not None:
+                histogram = Histogram(float(stats['min']),
+                                      float(stats['max']), bins)
+        fields[f['name']] = stats
+        sketches.append((HyperLogLog(),
+                         TopK(top_k * 10) if f['type'] in TOP_K_TYPES
+                         else None, histogram))
+
+    cursor = db.stream(u'SELECT {0} FROM {1}'.format(
+        u', '.join(db.identifier(f['name']) for f in schema),
+        db.identifier(resource_id)))
+    for row in cursor:
+        for value, (hll, top, histogram) in zip(row, sketches):
+            if value is None:
+                continue
+            hll.add(value)
+            if top is not None:
+                top.add(db.json_value(value))
+            if histogram is not None:
+                histogram.add(float(value))
+
+    for f, (hll, top, histogram) in zip(schema, sketches):
+        stats = fields[f['name']]
+        stats['distinct'] = min(hll.count(), rows)
+        if top is not None:
+            stats['top'] = [{'value': v, 'count': c}
+                            for v, c in top.top(top_k)]
+        if histogram is not None:
+            stats['histogram'] = histogram.as_dict()
+    return {'rows': rows, 'fields': fields, 'geo': _geo_candidates(fields)}
+
+
+def _profile_path(resource, revision=None):
+    return os.path.join(cache_directory('profiles', resource['id']),
+                        '{0}.json'.format(revision or
+                                          db.revision_key(resource)))
+
+
+def profile_exists(resource, revision=None):
+    '''
+    Return whether the profile of the current revision of a resource has
+    been computed.
+    :param resource: resource dict
+    :type resource: dict
+    :param revision: ``db.revision_key`` of the resource, when known
+    :type revision: string
+    '''
+    return os.path.isfile(_profile_path(resource, revision))
+
+
+def load_profile(resource):
+    '''
+    Return the stored profile of the current revision of a resource, or
+    None when it has not been computed yet.
+    :param resource: resource dict
+    :type resource: dict
+    '''
+    try:
+        with io.open(_profile_path(resource), encoding='utf-8') as f:
+            return json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def profiled_fields(schema, profile):
+    '''
+    Return the schema fields with the ``stats`` of their column profile
+    (null fraction, distinct count, range and top values), which the
+    explorer uses for suggested filters and axis ranges. Histograms are
+    left out, ``dataexplorer_profile_show`` returns them.
+
+    :param schema: schema dict
+    :type schema: dict
+    :param profile: column profile of the resource
+    :type profile: dict
+    '''
+    if not profile:
+        return schema
+    fields = []
+    for f in schema:
+        stats = dict(profile['fields'].get(f['name'], {}))
+        stats.pop('type', None)
+        stats.pop('histogram', None)
+        fields.append(dict(f, stats=stats) if stats else f)
+    return fields
+
+
+def profile_resource(resource_id):
+    '''
+    Compute and store the profile of a DataStore resource, unless the
+    current revision already has one. Older revisions are removed.
+    '''
+    resource = toolkit.get_action('resource_show')(
+        {'ignore_auth': True}, {'id': resource_id})
+    if not resource.get('datastore_active'):
+        return None
+    path = _profile_path(resource)
+    if os.path.exists(path):
+        return load_profile(resource)
+    profile = compute_profile(resource_id,
+                              datastore_fields_to_schema(resource))
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with io.open(fd, 'w', encoding='utf-8') as f:
+        f.write(six.text_type(json.dumps(profile)))
+    os.rename(tmp, path)
+    for name in os.listdir(directory):
+        if os.path.join(directory, name) != path:
+            os.remove(os.path.join(directory, name))
+    log.info('Profiled DataStore resource %s', resource_id)
+    return profile
+
+
+def enqueue_profile(resource_id):
+    toolkit.enqueue_job(profile_resource, [resource_id],
+                        title=u'dataexplorer profile {0}'.format(resource_id))
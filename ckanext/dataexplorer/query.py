@@ -0,0 +1,64 @@
+# encoding: utf-8
+'''
+Shared query layer of the dataexplorer data paths. Identical queries running
+at the same time are coalesced into one (single-flight) and their results
+are kept for a few seconds, so the widgets of a view, and the users opening
+the same popular view, do not each hit the DataStore database.
+'''
+from ckan.common import json
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer.cache import LRUCache, SingleFlight
+
+result_cache = LRUCache(maxsize=500, ttl=5)
+# query builder results, keyed by the DataStore table revision shared by all
+# the processes, so they can be kept longer
+builder_cache = LRUCache(maxsize=1000, ttl=600)
+flights = SingleFlight()
+
+
+def configure(config):
+    result_cache.configure(
+        maxsize=toolkit.asint(config.get(
+            'ckanext.dataexplorer.query_cache.size', 500)),
+        ttl=toolkit.asint(config.get(
+            'ckanext.dataexplorer.query_cache.ttl', 5)))
+    builder_cache.configure(
+        maxsize=toolkit.asint(config.get(
+            'ckanext.dataexplorer.query_builder_cache.size', 1000)),
+        ttl=toolkit.asint(config.get(
+            'ckanext.dataexplorer.query_builder_cache.ttl', 600)))
+
+
+def query_key(resource_id, revision, name, params):
+    return (resource_id, revision, name,
+            json.dumps(params, sort_keys=True, default=str))
+
+
+def run(resource_id, revision, name, params, fn, cache=result_cache):
+    '''
+    Return the result of ``fn()``, the query ``name`` with ``params`` on a
+    resource revision, from the result cache or from an identical call in
+    flight when there is one. Results are shared and must not be modified.
+    :param revision: resource revision, as returned by
+        ``db.resource_revision``
+    :param params: JSON serializable query parameters
+    :type params: dict
+    :param cache: result cache, ``result_cache`` or ``builder_cache``
+    '''
+    key = query_key(resource_id, revision, name, params)
+    result = cache.get(key)
+    if result is None:
+        result = flights.do(key, fn)
+        cache.set(key, result)
+    return result
+
+
+def invalidate(resource_id):
+    result_cache.invalidate(lambda key: key[0] == resource_id)
+    builder_cache.invalidate(lambda key: key[0] == resource_id)
+
+
+def stats():
+    return dict(result_cache.stats(), builder=builder_cache.stats(),
+                **flights.stats())
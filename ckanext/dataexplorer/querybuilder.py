@@ -0,0 +1,166 @@
+# encoding: utf-8
+'''
+Compiles the structured filter spec of the query builder into parameterised
+SQL against a DataStore table, so the browser never sends raw SQL.
+
+A spec is a dict with optional ``fields``, ``filters`` (DataStore style, as
+in the view config), ``where``, ``sort``, ``limit`` and ``offset``. ``where`` is a list of conditions, ANDed together, each one
+``{"field": ..., "op": ..., "value": ...}`` or ``{"or": [...]}`` /
+``{"and": [...]}`` for nested groups.
+'''
+import six
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db, paging
+
+COMPARISONS = {
+    '=': u'=',
+    '!=': u'<>',
+    '<': u'<',
+    '<=': u'<=',
+    '>': u'>',
+    '>=': u'>=',
+    'like': u'LIKE',
+    'not like': u'NOT LIKE',
+    'ilike': u'ILIKE',
+    'not ilike': u'NOT ILIKE',
+}
+TEXT_MATCHES = ['like', 'not like', 'ilike', 'not ilike']
+OPERATORS = sorted(COMPARISONS) + [
+    'in', 'not in', 'between', 'is null', 'is not null']
+MAX_DEPTH = 10
+
+
+def _invalid(key, message):
+    return toolkit.ValidationError({key: [message]})
+
+
+def _bind(params, value):
+    if isinstance(value, (dict, list)):
+        raise _invalid('where', u'Values must be scalars')
+    name = u'q{0}'.format(len(params))
+    params[name] = value
+    return u':' + name
+
+
+def _condition(condition, names, params, depth=0):
+    if not isinstance(condition, dict) or depth > MAX_DEPTH:
+        raise _invalid('where', u'Invalid condition')
+    for group in ('and', 'or'):
+        if group in condition:
+            members = condition[group]
+            if not isinstance(members, list) or not members:
+                raise _invalid('where', u'Empty {0} group'.format(group))
+            return u'(' + u' {0} '.format(group.upper()).join(
+                _condition(c, names, params, depth + 1)
+                for c in members) + u')'
+
+    field = condition.get('field')
+    op = (condition.get('op') or '=').lower()
+    value = condition.get('value')
+    if field not in names:
+        raise _invalid('where', u'Unknown field: {0}'.format(field))
+    if op not in OPERATORS:
+        raise _invalid('where', u'Unknown operator: {0}'.format(op))
+    column = db.identifier(field)
+    if op in ('is null', 'is not null'):
+        return u'{0} {1}'.format(column, op.upper())
+    if op in ('in', 'not in'):
+        if not isinstance(value, list) or not value:
+            raise _invalid('where', u'{0} needs a list of values'.format(op))
+        return u'{0} {1} ({2})'.format(column, op.upper(), u', '.join(
+            _bind(params, v) for v in value))
+    if op == 'between':
+        if not isinstance(value, list) or len(value) != 2:
+            raise _invalid('where', u'between needs two values')
+        return u'{0} BETWEEN {1} AND {2}'.format(
+            column, _bind(params, value[0]), _bind(params, value[1]))
+    if op in TEXT_MATCHES:
+        if not isinstance(value, six.string_types):
+            raise _invalid('where', u'{0} needs a text pattern'.format(op))
+        column += u'::text'
+    return u'{0} {1} {2}'.format(column, COMPARISONS[op],
+                                 _bind(params, value))
+
+
+def conditions(where, schema, params):
+    '''
+    Return the SQL conditions of a list of query builder conditions, adding
+    bound values to ``params``.
+    :param where: query builder conditions
+    :type where: list of dicts
+    :param schema: table schema fields
+    :type schema: list of dicts
+    '''
+    if not where:
+        return []
+    if not isinstance(where, list):
+        raise _invalid('where', u'Must be a list of conditions')
+    names = set(f['name'] for f in schema) | set([u'_id'])
+    return [_condition(c, names, params) for c in where]
+
+
+def where_sql(filters, where, schema, params):
+    '''
+    Return the WHERE clause of DataStore style ``filters`` and query
+    builder ``where`` conditions, or an empty string.
+    '''
+    return db.where_clause(filters, schema, params,
+                           conditions(where, schema, params))
+
+
+def _order_by(sort, schema):
+    if not sort:
+        return u'"_id"'
+    if not isinstance(sort, list):
+        sort = [s for s in six.text_type(sort).split(u',') if s.strip()]
+    parts = []
+    for s in sort:
+        if isinstance(s, dict):
+            field = s.get('field')
+            descending = (s.get('order') or 'asc').lower() == 'desc'
+        else:
+            field, descending = paging.parse_sort(s)
+        db.check_fields([field], schema)
+        parts.append(u'{0} {1}'.format(
+            db.identifier(field), u'DESC' if descending else u'ASC'))
+    return u', '.join(parts + [u'"_id"'])
+
+
+def compile_query(resource_id, schema, spec, rows_max):
+    '''
+    Return ``(sql, params, where, where_params, fields)`` for a query
+    builder spec: the SQL of the page of rows and its bound parameters, its
+    WHERE clause and parameters (for counting) and the selected fields.
+    :param spec: query builder spec
+    :type spec: dict
+    :param rows_max: maximum ``limit``
+    :type rows_max: int
+    '''
+    fields = spec.get('fields') or [f['name'] for f in schema]
+    if not isinstance(fields, list):
+        raise _invalid('fields', u'Must be a list')
+    db.check_fields(fields, schema)
+    if u'_id' not in fields:
+        fields = [u'_id'] + fields
+    try:
+        limit = min(int(spec.get('limit', 100)), rows_max)
+        offset = int(spec.get('offset', 0))
+    except (TypeError, ValueError):
+        limit = offset = -1
+    if limit < 0 or offset < 0:
+        raise _invalid('limit', u'limit and offset must be natural numbers')
+
+    if not isinstance(spec.get('filters') or {}, dict):
+        raise _invalid('filters', u'Must be a dict')
+
+    params = {}
+    where = where_sql(spec.get('filters'), spec.get('where'), schema, params)
+    sql = (u'SELECT {0} FROM {1}{2} ORDER BY {3} '
+           u'LIMIT :limit OFFSET :offset').format(
+        u', '.join(db.identifier(f) for f in fields),
+        db.identifier(resource_id), where,
+        _order_by(spec.get('sort'), schema))
+    return (sql, dict(params, limit=limit, offset=offset), where, params,
+            fields)
@@ -0,0 +1,69 @@
+# encoding: utf-8
+'''
+Fixed size random samples of DataStore tables for chart and map views.
+
+``system`` and ``bernoulli`` read a PostgreSQL ``TABLESAMPLE`` of the table
+sized from the planner row estimate, ``system`` reading random pages (fast,
+rows of a page come together) and ``bernoulli`` random rows of every page.
+``reservoir`` streams the matching rows through a reservoir, which gives a
+uniform sample of filtered queries whatever the filters select. All methods
+take a seed, so the same view shows the same sample until the data changes,
+and read at most about ``max_scan`` rows.
+'''
+import random
+
+METHODS = ['system', 'bernoulli', 'reservoir']
+
+# rows read by TABLESAMPLE for each row of the sample, so the sample is
+# still full when the sampled pages hold fewer rows than estimated
+OVERSAMPLE = 1.5
+
+
+def reservoir(rows, size, seed):
+    '''
+    Return ``size`` rows picked uniformly from an iterable of rows of
+    unknown length, keeping only ``size`` rows in memory.
+    '''
+    rng = random.Random(seed)
+    sample = []
+    for index, row in enumerate(rows):
+        if index < size:
+            sample.append(row)
+            continue
+        pick = rng.randint(0, index)
+        if pick < size:
+            sample[pick] = row
+    return sample
+
+
+def sample_percent(method, size, matching, table_rows, max_scan):
+    '''
+    Return the TABLESAMPLE percentage of a table to read for a sample of
+    ``size`` rows, or None when the rows can be read whole.
+    :param matching: estimated number of rows matching the filters
+    :type matching: int or None
+    :param table_rows: estimated number of rows of the table
+    :type table_rows: int or None
+    :param max_scan: maximum number of rows to read
+    :type max_scan: int
+    '''
+    if not table_rows:
+        return None
+    if method == 'reservoir':
+        wanted = max_scan
+    else:
+        wanted = min(size * OVERSAMPLE / max(matching or 1, 1) * table_rows,
+                     max_scan)
+    if wanted >= table_rows:
+        return None
+    return 100.0 * wanted / table_rows
+
+
+def sample_fraction(size, matching):
+    '''
+    Return the fraction of the matching rows a sample of ``size`` rows
+    holds, 1 when all of them fit.
+    '''
+    if not matching or size >= matching:
+        return 1.0
+    return float(size) / matching
@@ -0,0 +1,224 @@
+# encoding: utf-8
+from logging import getLogger
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import db, metrics
+from ckanext.dataexplorer.cache import LRUCache
+
+log = getLogger(__name__)
+
+schema_cache = LRUCache()
+
+
+def each_datastore_field_to_schema_type(dstore_type):
+    # Adopted from https://github.com/frictionlessdata/datapackage-pipelines-ckan-driver/blob/master/tableschema_ckan_datastore/mapper.py
+    '''
+    For a given datastore type, return the corresponding schema type.
+    datastore int and float may have a trailing digit, which is stripped.
+    datastore arrays begin with an '_'.
+    '''
+    dstore_type = dstore_type.rstrip('0123456789')
+    if dstore_type.startswith('_'):
+        dstore_type = 'array'
+    DATASTORE_TYPE_MAPPING = {
+        'int': ('integer', None),
+        'float': ('number', None),
+        'smallint': ('integer', None),
+        'bigint': ('integer', None),
+        'integer': ('integer', None),
+        'numeric': ('number', None),
+        'money': ('number', None),
+        'timestamp': ('datetime', 'any'),
+        'date': ('date', 'any'),
+        'time': ('time', 'any'),
+        'interval': ('duration', None),
+        'text': ('string', None),
+        'varchar': ('string', None),
+        'char': ('string', None),
+        'uuid': ('string', 'uuid'),
+        'boolean': ('boolean', None),
+        'bool': ('boolean', None),
+        'json': ('object', None),
+        'jsonb': ('object', None),
+        'array': ('array', None)
+    }
+    try:
+        return DATASTORE_TYPE_MAPPING[dstore_type]
+    except KeyError:
+        log.warn('Unsupported DataStore type \'{}\'. Using \'string\'.'
+                 .format(dstore_type))
+        return ('string', None)
+
+
+def _schema_field(datastore_id, datastore_type):
+    ts_type, ts_format = each_datastore_field_to_schema_type(datastore_type)
+    ts_field = {
+        'name': datastore_id,
+        'type': ts_type
+    }
+    if ts_format is not None:
+        ts_field['format'] = ts_format
+    return ts_field
+
+
+def prefetch_schemas(resources):
+    '''
+    Load into ``schema_cache`` the table schemas of all the DataStore
+    resources given that are not cached yet, with a single catalog query
+    instead of one datastore_search per resource.
+    :param resources: resource dicts, such as the resources of a package
+    :type resources: list of dicts
+    '''
+    resources = [r for r in resources if r.get('datastore_active')]
+    if not resources:
+        return
+    revisions = db.table_revisions([r['id'] for r in resources])
+    missing = {}
+    for r in resources:
+        key = (r['id'], db.resource_revision(r, revisions[r['id']]))
+        if schema_cache.get(key) is None:
+            missing[key] = r['id']
+    if not missing:
+        return
+    rows = db.execute(u'''
+        SELECT c.relname AS resource_id, a.attname AS name,
+            t.typname AS type
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_type t ON t.oid = a.atttypid
+        WHERE n.nspname = 'public' AND c.relname = ANY(:resource_ids)
+            AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY c.relname, a.attnum
+    ''', {'resource_ids': list(set(missing.values()))})
+    fields = {}
+    for row in rows:
+        # datastore_search leaves out _id, _full_text and other _ columns
+        if not row['name'].startswith('_'):
+            fields.setdefault(row['resource_id'], []).append(
+                _schema_field(row['name'], row['type']))
+    for key, resource_id in missing.items():
+        if resource_id in fields:
+            schema_cache.set(key, fields[resource_id])
+
+
+@metrics.timed('schema')
+def datastore_fields_to_schema(resource, package=None):
+    '''
+    Return a table schema from a DataStore field types. Schemas are kept in
+    ``schema_cache`` keyed by resource id and ``db.resource_revision``, the
+    same in every process. When a package dict
+    is given, a cache miss loads the schemas of all its DataStore resources
+    at once, so the other views of a dataset page find them cached.
+    :param resource: resource dict
+    :type resource: dict
+    :param package: package dict of the resource
+    :type package: dict
+    '''
+    key = (resource['id'], db.resource_revision(resource))
+    ts_fields = schema_cache.get(key)
+    if ts_fields is not None:
+        return ts_fields
+
+    if package and resource.get('datastore_active'):
+        resources = [r for r in package.get('resources', [])
+                     if r['id'] != resource['id']]
+        try:
+            prefetch_schemas([resource] + resources)
+        except SQLAlchemyError:
+            log.warning('Could not prefetch the table schemas of %s',
+                        package.get('id'), exc_info=True)
+        ts_fields = schema_cache.get(key)
+        if ts_fields is not None:
+            return ts_fields
+
+    data = {'resource_id': resource['id'], 'limit': 0}
+
+    fields = toolkit.get_action('datastore_search')({}, data)['fields']
+    ts_fields = [_schema_field(f['id'], f['type']) for f in fields
+                 if f['id'] != '_id']
+    schema_cache.set(key, ts_fields)
+    return ts_fields
+
+
+def schema_context():
+    '''
+    Return the request scoped dict of table schemas by resource id, kept in
+    ``toolkit.g`` so every plugin, renderer and validator of the request
+    shares it and concurrent requests never see each other's. Outside a
+    request a new empty dict is returned.
+    '''
+    try:
+        context = getattr(toolkit.g, 'dataexplorer_schemas', None)
+        if context is None:
+            context = toolkit.g.dataexplorer_schemas = {}
+        return context
+    except (RuntimeError, TypeError, AttributeError):
+        return {}
+
+
+def request_schema(resource, package=None):
+    '''
+    Return the table schema of a resource, resolved once per request.
+    :param resource: resource dict
+    :type resource: dict
+    :param package: package dict of the resource
+    :type package: dict
+    '''
+    context = schema_context()
+    schema = context.get(resource['id'])
+    if schema is None:
+        schema = context[resource['id']] = datastore_fields_to_schema(
+            resource, package)
+    return schema
+
+
+def request_schema_by_id(resource_id):
+    '''
+    Return the table schema of a resource id, resolved once per request.
+    Raises ObjectNotFound for unknown resources.
+    '''
+    context = schema_context()
+    schema = context.get(resource_id)
+    if schema is None:
+        resource = toolkit.get_action('resource_show')(
+            {'ignore_auth': True}, {'id': resource_id})
+        schema = request_schema(resource)
+    return schema
+
+
+def invalidate_schema(resource_id):
+    '''
+    Drop the cached table schemas of a resource.
+    :param resource_id: resource id
+    :type resource_id: string
+    '''
+    schema_cache.invalidate(lambda key: key[0] == resource_id)
+    schema_context().pop(resource_id, None)
+
+
+SCHEMA_TO_DATASTORE_TYPE = {
+    'integer': 'int',
+    'number': 'numeric',
+    'datetime': 'timestamp',
+    'date': 'date',
+    'time': 'time',
+    'duration': 'interval',
+    'string': 'text',
+    'boolean': 'bool',
+    'object': 'json',
+    'array': '_text',
+}
+
+
+def schema_field_to_datastore_field(field):
+    '''
+    Return a datastore_search style field dict for a table schema field.
+    :param field: table schema field
+    :type field: dict
+    '''
+    return {'id': field['name'],
+            'type': SCHEMA_TO_DATASTORE_TYPE.get(field['type'], 'text')}
@@ -0,0 +1,241 @@
+# encoding: utf-8
+'''
+Rendering benchmarks of the dataexplorer views against a DataStore stand-in.
+
+``FakeDatastore`` answers ``datastore_search`` for a synthetic table of any
+number of columns and rows without a database: records are generated for
+the requested page only and the row count only shows in ``total``, so a
+10M rows resource costs the same to fake as a 1k rows one and the
+measurements are those of the plugin code. Every call is counted as a
+DataStore round trip.
+
+Results are compared with ``baselines.json``, keyed by case name. The
+payload bytes and round trips of every case are recorded there; render
+latencies depend on the machine, record them on the CI runner with
+``DATAEXPLORER_BENCH_UPDATE=1``.
+'''
+import datetime
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+COLUMNS = [10, 100, 2000]
+ROWS = [1000, 100000, 10000000]
+
+VIEWS = {
+    'dataexplorer_view': {},
+    'dataexplorer_table_view': {'filters': {}},
+    'dataexplorer_chart_view': {
+        'chart_type': 'bar', 'group': 'field_1', 'chart_series': ['field_2'],
+        'limit': 100},
+    'dataexplorer_map_view': {
+        'map_field_type': 'lat_long', 'latitude_field': 'field_1',
+        'longitude_field': 'field_2', 'limit': 100},
+    'dataexplorer_web_view': {'page_url': 'https://example.com/'},
+}
+
+# datastore_search types of the generated columns, in turn
+TYPES = ['numeric', 'int4', 'text', 'timestamp', 'bool']
+
+
+class FakeDatastore(object):
+    '''
+    ``datastore_search`` stand-in for one synthetic table.
+    '''
+
+    def __init__(self, resource_id, columns, rows):
+        self.resource_id = resource_id
+        self.rows = rows
+        self.fields = [{'id': '_id', 'type': 'int'}] + [
+            {'id': 'field_{0}'.format(i), 'type': TYPES[i % len(TYPES)]}
+            for i in range(columns)]
+        # counted per thread, so concurrent renders only see their own
+        self.local = threading.local()
+        # pages are generated once, to keep their cost out of the renders
+        self.pages = {}
+
+    @property
+    def round_trips(self):
+        return getattr(self.local, 'round_trips', 0)
+
+    def _value(self, field_type, row):
+        if field_type == 'numeric':
+            return row * 1.5
+        if field_type == 'int4':
+            return row
+        if field_type == 'timestamp':
+            return (datetime.datetime(2020, 1, 1) +
+                    datetime.timedelta(minutes=row)).isoformat()
+        if field_type == 'bool':
+            return row % 2 == 0
+        return u'value {0}'.format(row)
+
+    def datastore_search(self, context, data_dict):
+        self.local.round_trips = self.round_trips + 1
+        offset = int(data_dict.get('offset', 0))
+        limit = int(data_dict.get('limit', 100))
+        if (offset, limit) not in self.pages:
+            self.pages[(offset, limit)] = [
+                dict((f['id'], self._value(f['type'], row)
+                      if f['id'] != '_id' else row + 1) for f in self.fields)
+                for row in range(offset, min(offset + limit, self.rows))]
+        records = [dict(r) for r in self.pages[(offset, limit)]]
+        return {
+            'resource_id': data_dict.get('resource_id'),
+            'fields': self.fields,
+            'records': records,
+            'total': self.rows,
+        }
+
+
+def resource_dict(resource_id):
+    return {
+        'id': resource_id,
+        'name': 'Benchmark resource',
+        'url': 'https://example.com/data.csv',
+        'format': 'CSV',
+        'datastore_active': True,
+        'metadata_modified': '2020-01-01T00:00:00',
+    }
+
+
+def view_dict(view_type, resource_id):
+    view = dict(VIEWS[view_type])
+    view.update({'id': 'view-' + view_type, 'view_type': view_type,
+                 'resource_id': resource_id, 'title': view_type})
+    return view
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summary(latencies):
+    return {
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+class Renderer(object):
+    '''
+    Renders one view of a resource in its own request context, the way
+    CKAN does for the view page, and reports the latency, payload size and
+    DataStore round trips of the render.
+    '''
+
+    def __init__(self, flask_app, plugin, view_type, fake, cold):
+        self.flask_app = flask_app
+        self.plugin = plugin
+        self.view_type = view_type
+        self.fake = fake
+        self.cold = cold
+
+    def __call__(self, _=None):
+        from ckanext.dataexplorer import fragments
+        from ckanext.dataexplorer.tableschema import schema_cache
+
+        if self.cold:
+            schema_cache.clear()
+            fragments.fragment_cache.clear()
+        data_dict = {
+            'resource': resource_dict(self.fake.resource_id),
+            'resource_view': view_dict(
+                self.view_type, self.fake.resource_id),
+        }
+        with self.flask_app.test_request_context():
+            before = self.fake.round_trips
+            start = time.time()
+            result = self.plugin.setup_template_variables({}, data_dict)
+            latency = time.time() - start
+        return latency, len(result['payload']), \
+            self.fake.round_trips - before
+
+
+def run_serial(renderer, iterations):
+    return [renderer() for i in range(iterations)]
+
+
+def run_threads(renderer, iterations, workers):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(renderer, range(iterations)))
+
+
+_process_renderer = None
+
+
+def _render_in_process(i):
+    return _process_renderer(i)
+
+
+def _forget_connections():
+    # the pooled connections inherited on fork share their socket with the
+    # parent: open new ones, leaving the parent's alone
+    import ckan.model as model
+    from ckanext.dataexplorer import db
+
+    for engine in (model.meta.engine, db.get_read_engine(),
+                   db.get_write_engine()):
+        engine.dispose(close=False)
+
+
+def run_processes(renderer, iterations, workers):
+    '''
+    Render in forked worker processes, like a multi-process WSGI server.
+    The renderer is inherited on fork, not pickled.
+    '''
+    global _process_renderer
+    _process_renderer = renderer
+    pool = multiprocessing.get_context('fork').Pool(
+        workers, initializer=_forget_connections)
+    try:
+        return pool.map(_render_in_process, range(iterations))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_baselines():
+    try:
+        with open(BASELINES) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_baseline(case, result):
+    baselines = load_baselines()
+    baselines[case] = result
+    with open(BASELINES, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def regressions(case, result, tolerance):
+    '''
+    Return the regressions of a result against its baseline: latencies
+    more than ``tolerance`` slower, larger payloads and more round trips.
+    A case without a baseline is a regression, so a new case or a lost
+    baseline can not pass unchecked.
+    '''
+    baseline = load_baselines().get(case)
+    if not baseline:
+        return ['no baseline, record it with DATAEXPLORER_BENCH_UPDATE=1']
+    found = []
+    for key in ('p50_ms', 'p99_ms'):
+        if key in baseline and \
+                result[key] > baseline[key] * (1 + tolerance):
+            found.append('{0} {1} > {2} (+{3:.0%})'.format(
+                key, result[key], baseline[key], tolerance))
+    for key in ('payload_bytes', 'round_trips'):
+        if key in baseline and result[key] > baseline[key]:
+            found.append('{0} {1} > {2}'.format(
+                key, result[key], baseline[key]))
+    return found
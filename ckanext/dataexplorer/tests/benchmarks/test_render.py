@@ -0,0 +1,105 @@
+# encoding: utf-8
+'''
+Render benchmarks of every dataexplorer view class. They are skipped unless
+``DATAEXPLORER_BENCH=1``:
+
+    DATAEXPLORER_BENCH=1 pytest --ckan-ini=test.ini \
+        ckanext/dataexplorer/tests/benchmarks
+
+A case fails when it regresses against ``baselines.json`` by more than
+``DATAEXPLORER_BENCH_TOLERANCE`` (default: 0.5, 50% slower) or sends more
+payload bytes or DataStore round trips. ``DATAEXPLORER_BENCH_UPDATE=1``
+records the results as the new baselines instead.
+'''
+import os
+
+import pytest
+
+import ckan.plugins as p
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import plugin
+from ckanext.dataexplorer.tests.benchmarks import harness
+
+ITERATIONS = int(os.environ.get('DATAEXPLORER_BENCH_ITERATIONS', 20))
+WORKERS = int(os.environ.get('DATAEXPLORER_BENCH_WORKERS', 4))
+TOLERANCE = float(os.environ.get('DATAEXPLORER_BENCH_TOLERANCE', 0.5))
+UPDATE = os.environ.get('DATAEXPLORER_BENCH_UPDATE') == '1'
+
+pytestmark = [
+    pytest.mark.skipif(os.environ.get('DATAEXPLORER_BENCH') != '1',
+                       reason='set DATAEXPLORER_BENCH=1 to run benchmarks'),
+    pytest.mark.ckan_config(
+        'ckan.plugins', 'datastore dataexplorer ' +
+        ' '.join(sorted(harness.VIEWS))),
+    pytest.mark.ckan_config('ckanext.dataexplorer.inline_rows', '100'),
+    pytest.mark.usefixtures('with_plugins'),
+]
+
+
+@pytest.fixture
+def fake_datastore(monkeypatch):
+    fakes = {}
+    get_action = toolkit.get_action
+
+    def fake_get_action(name):
+        if name != 'datastore_search':
+            return get_action(name)
+
+        def datastore_search(context, data_dict):
+            return fakes[data_dict['resource_id']].datastore_search(
+                context, data_dict)
+        return datastore_search
+
+    def make(columns, rows):
+        resource_id = 'bench-{0}-{1}'.format(columns, rows)
+        fakes[resource_id] = harness.FakeDatastore(
+            resource_id, columns, rows)
+        return fakes[resource_id]
+
+    monkeypatch.setattr(toolkit, 'get_action', fake_get_action)
+    # profiles live in the cache directory, keyed by DataStore revision
+    monkeypatch.setattr(plugin, 'load_profile', lambda resource: None)
+    # search indexes are read from the DataStore table catalog
+    monkeypatch.setattr(plugin, 'text_search_info',
+                        lambda resource, filters=None: None)
+    return make
+
+
+def _check(case, results):
+    latencies = [r[0] for r in results]
+    result = harness.summary(latencies)
+    result.update({
+        'payload_bytes': max(r[1] for r in results),
+        'round_trips': max(r[2] for r in results),
+    })
+    if UPDATE:
+        harness.save_baseline(case, result)
+        return
+    found = harness.regressions(case, result, TOLERANCE)
+    assert not found, '{0}: {1}'.format(case, '; '.join(found))
+
+
+@pytest.mark.parametrize('rows', harness.ROWS)
+@pytest.mark.parametrize('columns', harness.COLUMNS)
+@pytest.mark.parametrize('cold', [True, False], ids=['cold', 'warm'])
+@pytest.mark.parametrize('view_type', sorted(harness.VIEWS))
+def test_render(app, fake_datastore, view_type, cold, columns, rows):
+    renderer = harness.Renderer(
+        app.flask_app, p.get_plugin(view_type), view_type,
+        fake_datastore(columns, rows), cold)
+    _check('{0}:{1}:{2}x{3}'.format(
+        view_type, 'cold' if cold else 'warm', columns, rows),
+        harness.run_serial(renderer, ITERATIONS))
+
+
+@pytest.mark.parametrize('pool', ['threads', 'processes'])
+@pytest.mark.parametrize('view_type', sorted(harness.VIEWS))
+def test_concurrent_render(app, fake_datastore, view_type, pool):
+    renderer = harness.Renderer(
+        app.flask_app, p.get_plugin(view_type), view_type,
+        fake_datastore(100, 100000), True)
+    run = harness.run_threads if pool == 'threads' else \
+        harness.run_processes
+    _check('{0}:{1}:100x100000'.format(view_type, pool),
+           run(renderer, ITERATIONS * WORKERS, WORKERS))
@@ -0,0 +1,2 @@
+# encoding: utf-8
+from ckanext.datastore.tests.conftest import clean_datastore  # noqa: F401
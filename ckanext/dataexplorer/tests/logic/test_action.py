@@ -0,0 +1,338 @@
+# encoding: utf-8
+import pytest
+import sqlalchemy as sa
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.common import json
+from ckanext.datastore.backend.postgres import get_write_engine
+
+from ckanext.dataexplorer import db, query
+
+
+def _datastore_resource(records=None):
+    resource = factories.Resource()
+    helpers.call_action(
+        'datastore_create', resource_id=resource['id'], force=True,
+        fields=[{'id': 'name', 'type': 'text'}, {'id': 'n', 'type': 'int'}],
+        records=records or [{'name': 'a', 'n': 1}, {'name': 'b', 'n': 2}])
+    return resource
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestDataexplorerQuery(object):
+
+    def _resource(self):
+        return _datastore_resource([{'name': 'a', 'n': 1},
+                                    {'name': 'b', 'n': 2},
+                                    {'name': 'c', 'n': 3},
+                                    {'name': None, 'n': 4}])
+
+    def test_query(self):
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_query', resource_id=resource['id'],
+            fields=['name'], sort='n desc', limit=2,
+            where=json.dumps([{'or': [
+                {'field': 'n', 'op': '<=', 'value': 2},
+                {'field': 'name', 'op': 'is null'}]}]))
+        assert [r['name'] for r in result['records']] == [None, 'b']
+        assert [f['id'] for f in result['fields']] == ['_id', 'name']
+        assert result['total'] == 3
+        assert not result['total_was_estimated']
+
+    def test_values_are_not_sql(self):
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_query', resource_id=resource['id'],
+            where=[{'field': 'name', 'value': "a' OR 'x' = 'x"}])
+        assert result['records'] == []
+        assert result['total'] == 0
+
+    def test_writes_are_seen(self):
+        resource = self._resource()
+        where = [{'field': 'n', 'op': '>', 'value': 2}]
+        first = helpers.call_action('dataexplorer_query',
+                                    resource_id=resource['id'], where=where)
+        assert first['total'] == 2
+        helpers.call_action(
+            'datastore_upsert', resource_id=resource['id'], force=True,
+            method='insert', records=[{'name': 'e', 'n': 5}])
+        second = helpers.call_action('dataexplorer_query',
+                                     resource_id=resource['id'], where=where)
+        assert [r['name'] for r in second['records']] == ['c', None, 'e']
+        assert second['total'] == 3
+
+    def test_writes_of_other_processes_are_seen(self):
+        resource = self._resource()
+        where = [{'field': 'n', 'op': '>', 'value': 2}]
+        first = helpers.call_action('dataexplorer_query',
+                                    resource_id=resource['id'], where=where)
+        assert [r['name'] for r in first['records']] == ['c', None]
+        # a write that does not invalidate the caches of this process
+        with get_write_engine().begin() as connection:
+            connection.execute(sa.text(
+                u"UPDATE {0} SET name = 'z' WHERE n = 3".format(
+                    db.identifier(resource['id']))))
+        second = helpers.call_action('dataexplorer_query',
+                                     resource_id=resource['id'], where=where)
+        assert [r['name'] for r in second['records']] == ['z', None]
+
+    def test_invalid_spec(self):
+        resource = self._resource()
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                'dataexplorer_query', resource_id=resource['id'],
+                where=[{'field': 'missing', 'value': 1}])
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestChartAggregate(object):
+
+    def _resource(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'region', 'type': 'text'},
+                    {'id': 'amount', 'type': 'int'},
+                    {'id': 'label', 'type': 'text'}],
+            records=[{'region': 'north', 'amount': 1, 'label': 'b'},
+                     {'region': 'north', 'amount': 2, 'label': 'a'},
+                     {'region': 'south', 'amount': 5, 'label': 'c'},
+                     {'region': 'west', 'amount': None, 'label': None}])
+        return resource
+
+    @pytest.mark.parametrize('aggregate, amounts, type_', [
+        ('sum', [3, 5, None], 'numeric'),
+        ('count', [2, 1, 0], 'int'),
+        ('min', [1, 5, None], 'int'),
+        ('max', [2, 5, None], 'int'),
+    ])
+    def test_aggregate(self, aggregate, amounts, type_):
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_chart_aggregate', resource_id=resource['id'],
+            group='region', series='["amount"]', aggregate=aggregate)
+        assert [r['region'] for r in result['records']] == [
+            'north', 'south', 'west']
+        assert [r['amount'] for r in result['records']] == amounts
+        assert result['total'] == 3
+        assert not result['truncated']
+        assert result['fields'] == [{'id': 'region', 'type': 'text'},
+                                    {'id': 'amount', 'type': type_}]
+
+    def test_count_rows_without_series(self):
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_chart_aggregate', resource_id=resource['id'],
+            group='region', aggregate='count')
+        assert result['records'] == [{'region': 'north', 'count': 2},
+                                     {'region': 'south', 'count': 1},
+                                     {'region': 'west', 'count': 1}]
+
+    def test_filters_and_limit(self):
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_chart_aggregate', resource_id=resource['id'],
+            group='region', series=['amount'], limit=1,
+            filters='{"region": ["south", "west"]}')
+        assert result['records'] == [{'region': 'south', 'amount': 5}]
+        assert result['truncated']
+
+    def test_min_max_of_text(self):
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_chart_aggregate', resource_id=resource['id'],
+            group='region', series=['label'], aggregate='min')
+        assert [r['label'] for r in result['records']] == ['a', 'c', None]
+        assert result['fields'][1] == {'id': 'label', 'type': 'text'}
+
+    @pytest.mark.parametrize('data_dict', [
+        {'group': 'region', 'series': ['label'], 'aggregate': 'sum'},
+        {'group': 'region', 'series': ['amount'], 'aggregate': 'median'},
+        {'group': 'missing', 'series': ['amount']},
+        {'group': 'region', 'series': ['amount'], 'limit': -1},
+    ])
+    def test_invalid(self, data_dict):
+        resource = self._resource()
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('dataexplorer_chart_aggregate',
+                                resource_id=resource['id'], **data_dict)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestChartDownsample(object):
+
+    def _resource(self, rows=500):
+        resource = factories.Resource()
+        records = [{'x': i, 'y': 0, 'day': '2020-01-01'}
+                   for i in range(rows)]
+        records[min(200, rows - 1)]['y'] = 100
+        records.append({'x': rows, 'y': None, 'day': None})
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'x', 'type': 'int'},
+                    {'id': 'y', 'type': 'float'},
+                    {'id': 'day', 'type': 'date'}],
+            records=records)
+        return resource
+
+    @pytest.mark.parametrize('method', ['lttb', 'minmax'])
+    def test_downsample(self, method):
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_chart_downsample', resource_id=resource['id'],
+            group='x', series='["y"]', method=method, points=40)
+        assert result['total_rows'] == (500 if method == 'lttb' else 501)
+        assert 0 < result['total'] <= 60
+        xs = [r['x'] for r in result['records']]
+        assert xs == sorted(xs)
+        assert xs[0] == 0
+        assert {'x': 200, 'y': 100} in result['records']
+        assert [f['id'] for f in result['fields']] == ['x', 'y']
+
+    def test_points_capped(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.dataexplorer.downsample.max_points', 10)
+        resource = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_chart_downsample', resource_id=resource['id'],
+            group='x', series=['y'], points=1000)
+        assert result['total'] == 10
+
+    @pytest.mark.parametrize('data_dict', [
+        {'group': 'x', 'series': ['y'], 'method': 'mean'},
+        {'group': 'x', 'series': ['day']},
+        {'group': 'x', 'series': []},
+        {'group': 'missing', 'series': ['y']},
+    ])
+    def test_invalid(self, data_dict):
+        resource = self._resource(10)
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('dataexplorer_chart_downsample',
+                                resource_id=resource['id'], **data_dict)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestMapData(object):
+
+    def _resource(self, points):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'lat', 'type': 'numeric'},
+                    {'id': 'lon', 'type': 'numeric'}],
+            records=[{'lat': lat, 'lon': lon} for lon, lat in points])
+        return resource
+
+    def _map_data(self, resource, **data_dict):
+        return helpers.call_action(
+            'dataexplorer_map_data', resource_id=resource['id'],
+            latitude_field='lat', longitude_field='lon', **data_dict)
+
+    def test_points(self):
+        resource = self._resource([(1, 1), (2, 2), (50, 50)])
+        result = self._map_data(resource, bbox='0,0,10,10')
+        assert sorted(r['lon'] for r in result['records']) == [1, 2]
+        assert not result['clustered']
+        assert not result['truncated']
+
+    def test_clustered(self):
+        resource = self._resource([(1, 1), (1.1, 1.1), (100, 50)])
+        result = self._map_data(resource, limit=2)
+        assert result['clustered']
+        assert not result['truncated']
+        assert sorted(r['point_count'] for r in result['records']) == [1, 2]
+
+    def test_clusters_truncated(self):
+        resource = self._resource([(-100, 0), (0, 0), (100, 0)])
+        result = self._map_data(resource, limit=2)
+        assert result['clustered']
+        assert result['truncated']
+        assert len(result['records']) == 2
+
+    def test_across_the_antimeridian(self):
+        resource = self._resource([(175, 0), (-175, 0), (0, 0)])
+        result = self._map_data(resource, bbox='170,-10,-170,10')
+        assert sorted(r['lon'] for r in result['records']) == [-175, 175]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestSample(object):
+
+    def _resource(self, rows):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'},
+                    {'id': 'n', 'type': 'int'}],
+            records=[{'name': 'even' if i % 2 else 'odd', 'n': i}
+                     for i in range(rows)])
+        with get_write_engine().begin() as connection:
+            connection.execute(sa.text(u'ANALYZE {0}'.format(
+                db.identifier(resource['id']))))
+        return resource
+
+    def test_small_table_read_whole(self):
+        resource = self._resource(50)
+        result = helpers.call_action(
+            'dataexplorer_sample', resource_id=resource['id'], size=20,
+            method='reservoir', filters={'name': 'odd'})
+        assert result['total'] == 20
+        assert result['total_rows'] == 25
+        assert result['sample_fraction'] == 0.8
+        assert all(r['name'] == 'odd' for r in result['records'])
+        ids = [r['_id'] for r in result['records']]
+        assert ids == sorted(set(ids))
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.sample.max_scan', '1000')
+    @pytest.mark.parametrize('method', ['system', 'bernoulli', 'reservoir'])
+    def test_tablesample_is_repeatable(self, method):
+        resource = self._resource(20000)
+        result = helpers.call_action(
+            'dataexplorer_sample', resource_id=resource['id'], size=100,
+            method=method, seed=7)
+        assert 0 < result['total'] <= 100
+        assert result['total_rows'] == 20000
+        assert result['sample_method'] == method
+        query.invalidate(resource['id'])
+        again = helpers.call_action(
+            'dataexplorer_sample', resource_id=resource['id'], size=100,
+            method=method, seed=7)
+        assert again['records'] == result['records']
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.sample.max_scan', '100')
+    def test_scan_capped_without_statistics(self, monkeypatch):
+        resource = self._resource(500)
+        monkeypatch.setattr(db, 'estimate_count',
+                            lambda resource_id, where=u'', params=None: None)
+        result = helpers.call_action(
+            'dataexplorer_sample', resource_id=resource['id'], size=10,
+            method='reservoir')
+        assert result['total'] == 10
+        assert result['total_rows'] is None
+        assert max(r['_id'] for r in result['records']) <= 100
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.sample.max_size', '10')
+    def test_size_capped(self):
+        resource = self._resource(50)
+        result = helpers.call_action(
+            'dataexplorer_sample', resource_id=resource['id'], size=1000)
+        assert result['total'] == 10
+
+    def test_invalid_method(self):
+        resource = self._resource(10)
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('dataexplorer_sample',
+                                resource_id=resource['id'], method='random')
@@ -0,0 +1,65 @@
+# encoding: utf-8
+import pytest
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer.logic import auth
+
+READ = sorted(name for name, fn in auth.get_auth_functions().items()
+              if fn is auth.datastore_read)
+WRITE = ['dataexplorer_search_index_create',
+         'dataexplorer_search_index_delete']
+SYSADMIN = ['dataexplorer_cache_stats', 'dataexplorer_metrics']
+
+
+def _context(user=None):
+    return {'model': model, 'user': user['name'] if user else ''}
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestAuth(object):
+
+    @pytest.mark.parametrize('name', READ)
+    def test_anonymous_can_read_public_resources(self, name):
+        resource = factories.Resource()
+        assert helpers.call_auth(name, _context(),
+                                 resource_id=resource['id'])
+
+    @pytest.mark.parametrize('name', WRITE)
+    def test_anonymous_can_not_write(self, name):
+        resource = factories.Resource()
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth(name, _context(), resource_id=resource['id'])
+
+    @pytest.mark.parametrize('name', WRITE)
+    def test_users_without_update_rights_can_not_write(
+            self, name, ckan_config, monkeypatch):
+        resource = factories.Resource()
+        monkeypatch.setitem(ckan_config, 'ckan.auth.create_unowned_dataset',
+                            False)
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth(name, _context(factories.User()),
+                              resource_id=resource['id'])
+
+    @pytest.mark.parametrize('name', WRITE + SYSADMIN)
+    def test_sysadmins(self, name):
+        resource = factories.Resource()
+        assert helpers.call_auth(name, _context(factories.Sysadmin()),
+                                 resource_id=resource['id'])
+
+    @pytest.mark.parametrize('name', SYSADMIN)
+    def test_sysadmin_only(self, name):
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth(name, _context(factories.User()))
+
+    def test_actions_check_access(self):
+        resource = factories.Resource()
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'dataexplorer_search_index_delete',
+                context={'ignore_auth': False, 'user': ''},
+                resource_id=resource['id'])
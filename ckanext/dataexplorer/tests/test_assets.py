@@ -0,0 +1,53 @@
+# encoding: utf-8
+import pytest
+from flask import Response
+
+from ckanext.dataexplorer import assets
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('a8a9905a_dataexplorer.js', True),
+    ('a8a9905a_dataexplorer.js.gz', True),
+    ('js/main.6dcb79ac.chunk.js', True),
+    ('runtime~main.a8a9905a.js', True),
+    ('dataexplorer-custom.css', False),
+    ('dataexplorer.js', False),
+    ('deadbeef.txt/main.js', False),
+    ('main.abc.chunk.js', False),
+])
+def test_fingerprinted(name, expected):
+    assert assets.fingerprinted(name) is expected
+
+
+@pytest.mark.parametrize('path, immutable', [
+    ('/webassets/dataexplorer/a8a9905a_dataexplorer.js', True),
+    ('/webassets/dataexplorer/dataexplorer-custom.css', False),
+    ('/webassets/other/a8a9905a_other.js', False),
+])
+def test_set_cache_headers(test_request_context, path, immutable):
+    with test_request_context(path):
+        response = assets.set_cache_headers(Response(u'', 200))
+    assert ('immutable' in response.headers.get('Cache-Control', '')) is \
+        immutable
+
+
+def test_precompressed(test_request_context, tmp_path, ckan_config,
+                       monkeypatch):
+    monkeypatch.setitem(ckan_config, 'ckan.webassets.path', str(tmp_path))
+    (tmp_path / 'dataexplorer').mkdir()
+    for name in ['a8a9905a_dataexplorer.js', 'custom.js']:
+        (tmp_path / 'dataexplorer' / name).write_text(u'var a;')
+    assets.compress_assets()
+    with test_request_context('/webassets/dataexplorer/a8a9905a_'
+                              'dataexplorer.js',
+                              headers={'Accept-Encoding': 'gzip'}):
+        response = assets.serve_precompressed()
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' in response.headers['Cache-Control']
+        response.close()
+    with test_request_context('/webassets/dataexplorer/custom.js',
+                              headers={'Accept-Encoding': 'gzip'}):
+        response = assets.serve_precompressed()
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' not in response.headers.get('Cache-Control', '')
+        response.close()
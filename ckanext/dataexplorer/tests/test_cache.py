@@ -0,0 +1,212 @@
+# encoding: utf-8
+import os
+import threading
+import time
+
+import pytest
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer import cache
+from ckanext.dataexplorer.logic import action
+from ckanext.dataexplorer.tableschema import (
+    datastore_fields_to_schema, schema_cache)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    return clock
+
+
+def test_lru_evicts_least_recently_used():
+    lru = cache.LRUCache(maxsize=2, ttl=0)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert lru.stats() == {'size': 2, 'maxsize': 2, 'ttl': 0, 'hits': 3,
+                           'misses': 1}
+
+
+def test_lru_entries_expire(clock):
+    lru = cache.LRUCache(maxsize=10, ttl=60)
+    lru.set('a', 1)
+    clock.now += 59
+    assert lru.get('a') == 1
+    clock.now += 2
+    assert lru.get('a', 'gone') == 'gone'
+    assert lru.stats()['size'] == 0
+
+
+def test_lru_falsy_values_are_hits():
+    lru = cache.LRUCache()
+    lru.set('empty', [])
+    assert lru.get('empty', 'missing') == []
+
+
+def test_lru_disabled_and_configure():
+    lru = cache.LRUCache(maxsize=0)
+    lru.set('a', 1)
+    assert lru.get('a') is None
+    lru.configure(maxsize=5)
+    lru.set('a', 1)
+    assert lru.get('a') == 1
+    lru.configure(ttl=10)
+    assert lru.get('a') is None
+    assert lru.stats()['maxsize'] == 5
+
+
+def test_lru_invalidate():
+    lru = cache.LRUCache()
+    lru.set(('r1', 1), 'a')
+    lru.set(('r1', 2), 'b')
+    lru.set(('r2', 1), 'c')
+    lru.invalidate(lambda key: key[0] == 'r1')
+    assert lru.get(('r1', 1)) is None
+    assert lru.get(('r1', 2)) is None
+    assert lru.get(('r2', 1)) == 'c'
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = cache.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'rows': 1}
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(flights.do('key', slow)))
+        for i in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while flights.stats()['coalesced'] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert len(results) == 5
+    assert all(r is results[0] for r in results)
+    assert flights.stats() == {'in_flight': 0, 'calls': 1, 'coalesced': 4}
+    # the next call runs again
+    assert flights.do('key', lambda: 2) == 2
+
+
+def test_single_flight_shares_errors():
+    flights = cache.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ValueError('boom')
+
+    errors = []
+
+    def call():
+        try:
+            flights.do('key', failing)
+        except ValueError as e:
+            errors.append(e)
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    while flights.stats()['coalesced'] < 1:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert len(errors) == 2
+    assert flights.stats()['in_flight'] == 0
+
+
+def test_file_cache(ckan_config, monkeypatch, tmp_path):
+    monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.cache_dir',
+                        str(tmp_path))
+    files = cache.make_cache('fragments', 'file', ttl=60)
+    assert files.get('abc') is None
+    files.set('abc', u'{"a": "é"}')
+    assert files.get('abc') == u'{"a": "é"}'
+    # another process sees it
+    assert cache.FileCache('fragments', 60).get('abc') == u'{"a": "é"}'
+    path = tmp_path / 'fragments' / 'abc'
+    os.utime(str(path), (time.time() - 120, time.time() - 120))
+    assert files.get('abc', 'expired') == 'expired'
+    assert files.stats() == {'ttl': 60, 'hits': 1, 'misses': 2}
+
+
+def test_make_cache():
+    assert isinstance(cache.make_cache('x', 'memory', maxsize=3),
+                      cache.LRUCache)
+    assert isinstance(cache.make_cache('x', 'redis'), cache.RedisCache)
+    disabled = cache.make_cache('x', 'none')
+    disabled.set('a', 1)
+    assert disabled.get('a') is None
+    with pytest.raises(ValueError):
+        cache.make_cache('x', 'memcached')
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestSchemaCache(object):
+
+    def test_schema_cached_until_table_changes(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'a', 'type': 'text'}])
+        schema_cache.clear()
+        first = datastore_fields_to_schema({'id': resource['id']})
+        assert [f['name'] for f in first] == ['a']
+        assert datastore_fields_to_schema({'id': resource['id']}) == first
+        assert schema_cache.stats()['hits'] == 1
+
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'a', 'type': 'text'}, {'id': 'b', 'type': 'int'}])
+        assert [f['name'] for f in datastore_fields_to_schema(
+            {'id': resource['id']})] == ['a', 'b']
+
+    def test_schema_changed_by_another_process(self, monkeypatch):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'a', 'type': 'text'}])
+        resource = helpers.call_action('resource_show', id=resource['id'])
+        assert [f['name'] for f in datastore_fields_to_schema(
+            resource)] == ['a']
+        # the schema cache of another process is not invalidated
+        monkeypatch.setattr(action, 'invalidate_schema',
+                            lambda resource_id: None)
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'a', 'type': 'text'}, {'id': 'b', 'type': 'int'}])
+        assert [f['name'] for f in datastore_fields_to_schema(
+            resource)] == ['a', 'b']
@@ -0,0 +1,193 @@
+# encoding: utf-8
+import pytest
+
+import ckan.plugins as p
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer import columnar, plugin
+
+PLUGINS = 'datastore dataexplorer'
+VIEWS = ['dataexplorer_view', 'dataexplorer_table_view',
+         'dataexplorer_chart_view', 'dataexplorer_map_view']
+
+
+def test_columns_json():
+    page = {'resource_id': 'r1', 'names': ['_id', 'name', 'n'],
+            'types': ['integer', 'string', 'number'],
+            'rows': [(1, u'a', 1.5), (2, u'b', None)],
+            'limit': 2, 'offset': 0, 'total': 5,
+            'total_was_estimated': False}
+    result = columnar.json.loads(columnar.columns_json(page))['result']
+    assert result['columns'] == [[1, 2], [u'a', u'b'], [1.5, None]]
+    assert [f['id'] for f in result['fields']] == ['_id', 'name', 'n']
+    assert result['total'] == 5
+    assert result['total_was_estimated'] is False
+
+
+def test_columns_json_empty_page():
+    page = {'resource_id': 'r1', 'names': ['_id', 'name'],
+            'types': ['integer', 'string'], 'rows': [], 'limit': 10,
+            'offset': 20}
+    result = columnar.json.loads(columnar.columns_json(page))['result']
+    assert result['columns'] == [[], []]
+    assert 'total' not in result
+
+
+@pytest.mark.ckan_config('ckan.plugins', PLUGINS)
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+class TestTableApiUrl(object):
+
+    resource = {'id': 'r1'}
+
+    def test_records(self):
+        url = plugin.table_api_url(self.resource, {'a': ['1']})
+        assert '/api/3/action/datastore_search?' in url
+        assert 'total_estimation_threshold' not in url
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.wire_format', 'columns')
+    def test_columns(self):
+        url = plugin.table_api_url(self.resource, {'a': ['1']})
+        assert '/api/3/action/datastore_search?' in url
+        info = plugin.columnar_info(self.resource, filters='{}', limit=5)
+        assert info['format'] == 'json'
+        assert '/dataexplorer/data/r1.json?' in info['api']
+        assert 'limit=5' in info['api']
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.wire_format', 'arrow')
+    def test_arrow_falls_back_to_json(self, monkeypatch):
+        monkeypatch.setattr(columnar, 'arrow_available', lambda: False)
+        assert plugin.columnar_wire() == 'json'
+        monkeypatch.setattr(columnar, 'arrow_available', lambda: True)
+        assert plugin.columnar_info(self.resource)['api'].endswith(
+            '/dataexplorer/data/r1.arrow')
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.wire_format', 'columns')
+    @pytest.mark.ckan_config('ckanext.dataexplorer.table.paging', 'keyset')
+    def test_keyset_paging_keeps_datastore_search(self):
+        url = plugin.table_api_url(self.resource)
+        assert '/api/3/action/datastore_search?' in url
+        info = plugin.keyset_info(self.resource, {'a': ['1']})
+        assert '/api/3/action/dataexplorer_search?' in info['api']
+        assert 'filters=' in info['api']
+
+    def test_keyset_info_offset_paging(self):
+        assert plugin.keyset_info(self.resource) is None
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.count.strategy',
+                             'estimate')
+    def test_estimated_count(self):
+        url = plugin.table_api_url(self.resource)
+        assert 'total_estimation_threshold=100000' in url
+
+    def test_columnar_api_url_records(self):
+        assert plugin.columnar_api_url(self.resource) is None
+        assert plugin.columnar_info(self.resource) is None
+
+
+@pytest.mark.ckan_config('ckan.plugins', PLUGINS + ' ' + ' '.join(VIEWS))
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestViewResources(object):
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.wire_format', 'columns')
+    @pytest.mark.parametrize('view_type', VIEWS)
+    def test_api_stays_on_datastore_search(self, view_type):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'}], records=[{'name': 'a'}])
+        resource = helpers.call_action('resource_show', id=resource['id'])
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type=view_type, title=view_type)
+        variables = p.get_plugin(view_type).setup_template_variables(
+            {}, {'resource': resource, 'resource_view': view})
+        embedded = variables['datapackage']['resources'][0]
+        assert '/api/3/action/datastore_search?' in embedded['api']
+        assert embedded['columnar']['format'] == 'json'
+        assert '/dataexplorer/data/{0}.json'.format(resource['id']) in \
+            embedded['columnar']['api']
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.table.paging', 'keyset')
+    @pytest.mark.parametrize('view_type', VIEWS[:2])
+    def test_keyset_paging(self, view_type):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'}], records=[{'name': 'a'}])
+        resource = helpers.call_action('resource_show', id=resource['id'])
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type=view_type, title=view_type)
+        variables = p.get_plugin(view_type).setup_template_variables(
+            {}, {'resource': resource, 'resource_view': view})
+        embedded = variables['datapackage']['resources'][0]
+        assert '/api/3/action/datastore_search?' in embedded['api']
+        assert '/api/3/action/dataexplorer_search?' in \
+            embedded['keyset']['api']
+
+
+@pytest.mark.ckan_config('ckan.plugins', PLUGINS)
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestDataPage(object):
+
+    def _resource(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'},
+                    {'id': 'n', 'type': 'numeric'}],
+            records=[{'name': 'a', 'n': 1}, {'name': 'b', 'n': 2.5},
+                     {'name': 'c', 'n': None}, {'name': 'b', 'n': 4}])
+        return resource['id']
+
+    def test_matches_datastore_search(self, app):
+        resource_id = self._resource()
+        search = helpers.call_action(
+            'datastore_search', resource_id=resource_id,
+            filters={'name': 'b'}, sort='n desc')
+        result = app.get('/dataexplorer/data/{0}.json'.format(resource_id),
+                         query_string={'filters': '{"name": "b"}',
+                                       'sort': 'n desc'}).json['result']
+        assert result['total'] == search['total'] == 2
+        columns = dict((f['id'], c) for f, c in
+                       zip(result['fields'], result['columns']))
+        for i, record in enumerate(search['records']):
+            assert columns['_id'][i] == record['_id']
+            assert columns['name'][i] == record['name']
+            assert float(columns['n'][i]) == float(record['n'])
+
+    def test_limit_offset_without_total(self, app):
+        resource_id = self._resource()
+        result = app.get('/dataexplorer/data/{0}.json'.format(resource_id),
+                         query_string={'limit': 2, 'offset': 1,
+                                       'include_total': 'false'}
+                         ).json['result']
+        assert result['columns'][0] == [2, 3]
+        assert 'total' not in result
+
+    def test_invalid_request(self, app):
+        resource_id = self._resource()
+        app.get('/dataexplorer/data/{0}.json'.format(resource_id),
+                query_string={'sort': 'missing'}, status=400)
+        app.get('/dataexplorer/data/{0}.json'.format(resource_id),
+                query_string={'limit': '-1'}, status=400)
+        app.get('/dataexplorer/data/{0}.csv'.format(resource_id),
+                status=404)
+
+    @pytest.mark.skipif(columnar.arrow_available(),
+                        reason='pyarrow is installed')
+    def test_arrow_unavailable(self, app):
+        resource_id = self._resource()
+        app.get('/dataexplorer/data/{0}.arrow'.format(resource_id),
+                status=400)
+
+    def test_arrow(self, app):
+        pa = pytest.importorskip('pyarrow')
+        resource_id = self._resource()
+        res = app.get('/dataexplorer/data/{0}.arrow'.format(resource_id))
+        table = pa.ipc.open_stream(res.data).read_all()
+        assert table.column('name').to_pylist() == ['a', 'b', 'c', 'b']
+        assert table.schema.metadata[b'total'] == b'4'
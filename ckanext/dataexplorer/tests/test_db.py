@@ -0,0 +1,126 @@
+# encoding: utf-8
+import pytest
+import sqlalchemy as sa
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckanext.datastore.backend.postgres import get_write_engine
+
+from ckanext.dataexplorer import db
+from ckanext.dataexplorer.plugin import table_api_url
+
+
+def _resource(rows):
+    resource = factories.Resource()
+    helpers.call_action(
+        'datastore_create', resource_id=resource['id'], force=True,
+        fields=[{'id': 'n', 'type': 'int'}],
+        records=[{'n': i} for i in range(rows)])
+    with get_write_engine().begin() as connection:
+        connection.execute(sa.text(u'ANALYZE {0}'.format(
+            db.identifier(resource['id']))))
+    return resource
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestCountRows(object):
+
+    @pytest.fixture
+    def estimate(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config,
+                            'ckanext.dataexplorer.count.strategy', 'estimate')
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.dataexplorer.count.estimate_threshold',
+            '100')
+
+    def test_exact_by_default(self):
+        resource = _resource(300)
+        assert db.count_rows(resource['id']) == (300, False)
+
+    @pytest.mark.usefixtures('estimate')
+    def test_estimate_of_large_tables(self):
+        resource = _resource(300)
+        assert db.count_rows(resource['id']) == (300, True)
+        params = {'n': 250}
+        total, estimated = db.count_rows(
+            resource['id'], u' WHERE "n" < :n', params)
+        assert estimated
+        assert 0 < total <= 300
+
+    @pytest.mark.usefixtures('estimate')
+    def test_small_tables_are_counted(self):
+        resource = _resource(300)
+        params = {'n': 5}
+        assert db.count_rows(resource['id'], u' WHERE "n" < :n',
+                             params) == (5, False)
+        assert db.count_rows(_resource(50)['id']) == (50, False)
+
+    @pytest.mark.usefixtures('estimate')
+    def test_tables_without_statistics_are_counted(self, monkeypatch):
+        resource = _resource(300)
+        monkeypatch.setattr(db, 'estimate_count', lambda *args: None)
+        assert db.count_rows(resource['id']) == (300, False)
+
+    @pytest.mark.usefixtures('estimate')
+    def test_search_flags_estimated_totals(self):
+        resource = _resource(300)
+        result = helpers.call_action('dataexplorer_search',
+                                     resource_id=resource['id'], limit=10)
+        assert result['total'] == 300
+        assert result['total_was_estimated']
+
+    @pytest.mark.usefixtures('estimate')
+    def test_table_api_url(self):
+        resource = _resource(1)
+        assert 'total_estimation_threshold=100' in table_api_url(resource)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestTableRevision(object):
+
+    def _insert(self, resource_id):
+        with get_write_engine().begin() as connection:
+            connection.execute(sa.text(u'INSERT INTO {0} (n) VALUES (1)'
+                                       .format(db.identifier(resource_id))))
+
+    def test_unknown_table(self):
+        assert db.table_revision('missing') == 0
+
+    def test_api_writes(self):
+        resource = _resource(2)
+        revision = db.table_revision(resource['id'])
+        assert revision > 0
+        helpers.call_action(
+            'datastore_upsert', resource_id=resource['id'], force=True,
+            method='insert', records=[{'n': 5}])
+        assert db.table_revision(resource['id']) > revision
+
+    def test_direct_sql_writes(self):
+        resource = _resource(2)
+        revision = db.table_revision(resource['id'])
+        self._insert(resource['id'])
+        assert db.table_revision(resource['id']) == revision + 1
+
+    def test_recreated_table(self):
+        resource = _resource(2)
+        self._insert(resource['id'])
+        revision = db.table_revision(resource['id'])
+        helpers.call_action('datastore_delete', resource_id=resource['id'],
+                            force=True)
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'n', 'type': 'int'}], records=[{'n': 1}])
+        assert db.table_revision(resource['id']) > revision
+
+    def test_cached_results_see_direct_writes(self):
+        resource = _resource(2)
+        search = {'resource_id': resource['id'], 'limit': 10}
+        assert helpers.call_action('dataexplorer_search', **search)[
+            'total'] == 2
+        self._insert(resource['id'])
+        assert helpers.call_action('dataexplorer_search', **search)[
+            'total'] == 3
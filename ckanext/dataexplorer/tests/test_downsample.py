@@ -0,0 +1,70 @@
+# encoding: utf-8
+import datetime
+import math
+
+import pytest
+
+from ckanext.dataexplorer import downsample
+
+
+def _series(total):
+    return [(float(i), math.sin(i / 10.0), {'_id': i + 1})
+            for i in range(total)]
+
+
+def test_as_number():
+    assert downsample.as_number(3) == 3.0
+    assert downsample.as_number('2.5') == 2.5
+    assert downsample.as_number(datetime.date(1970, 1, 2)) == 86400.0
+    assert downsample.as_number(
+        datetime.datetime(1970, 1, 1, 0, 1, 0, 500000)) == 60.5
+
+
+@pytest.mark.parametrize('total, threshold', [
+    (1000, 100), (1001, 3), (10, 9), (250, 17)])
+def test_lttb_size_and_order(total, threshold):
+    points = _series(total)
+    result = list(downsample.lttb(iter(points), total, threshold))
+    assert len(result) == threshold
+    assert result[0] is points[0]
+    assert result[-1] is points[-1]
+    xs = [p[0] for p in result]
+    assert xs == sorted(set(xs))
+
+
+@pytest.mark.parametrize('threshold', [2, 1000, 2000])
+def test_lttb_keeps_everything_below_threshold(threshold):
+    points = _series(1000)
+    assert list(downsample.lttb(iter(points), 1000, threshold)) == points
+
+
+def test_lttb_keeps_spikes():
+    points = [(float(i), 0.0, None) for i in range(1000)]
+    points[500] = (500.0, 100.0, None)
+    points[750] = (750.0, -100.0, None)
+    result = list(downsample.lttb(iter(points), 1000, 20))
+    assert points[500] in result
+    assert points[750] in result
+
+
+def test_minmax_keeps_bucket_extremes_of_every_series():
+    points = [(float(i), (0.0, 1.0), None) for i in range(1000)]
+    points[123] = (123.0, (50.0, 1.0), None)
+    points[456] = (456.0, (0.0, -50.0), None)
+    points[789] = (789.0, (None, 1.0), None)
+    result = list(downsample.minmax(iter(points), 1000, 40))
+    assert points[123] in result
+    assert points[456] in result
+    assert result[0] is points[0]
+    assert result[-1] is points[-1]
+    # first, last, min and max of every series in each bucket
+    assert len(result) <= (40 // 4 + 2) * 6
+    xs = [p[0] for p in result]
+    assert xs == sorted(set(xs))
+
+
+def test_minmax_keeps_everything_below_threshold():
+    points = [(float(i), (float(i),), None) for i in range(10)]
+    assert list(downsample.minmax(iter(points), 10, 40)) == points
+    # at least three buckets
+    assert list(downsample.minmax(iter(points[:5]), 5, 4)) == points[:5]
@@ -0,0 +1,99 @@
+# encoding: utf-8
+import gzip
+
+import pytest
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.common import json
+
+from ckanext.dataexplorer import export
+
+
+def test_csv_chunks():
+    chunks = list(export.csv_chunks(
+        ['name', 'tags'], [(u'é', ['a', 'b']), (None, None)]))
+    assert b''.join(chunks).decode('utf-8') == (
+        u'name,tags\r\né,"[""a"", ""b""]"\r\n,\r\n')
+
+
+def test_ndjson_chunks():
+    chunks = list(export.ndjson_chunks(['name', 'n'], [(u'é', 1), (None, 2)]))
+    assert [json.loads(line) for line in b''.join(chunks).splitlines()] == [
+        {'name': u'é', 'n': 1}, {'name': None, 'n': 2}]
+
+
+def test_batches():
+    assert list(export._batches(range(5), size=2)) == [[0, 1], [2, 3], [4]]
+    assert list(export._batches([], size=2)) == []
+
+
+def test_gzip_chunks():
+    chunks = [b'a' * 1000, b'', b'b' * 1000]
+    assert gzip.decompress(b''.join(export.gzip_chunks(iter(chunks)))) == \
+        b''.join(chunks)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestExport(object):
+
+    def _resource(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'},
+                    {'id': 'n', 'type': 'int'}],
+            records=[{'name': 'a', 'n': 3}, {'name': 'b', 'n': 1},
+                     {'name': 'a', 'n': 2}])
+        return resource
+
+    def _url(self, resource, output):
+        return '/dataexplorer/export/{0}.{1}'.format(resource['id'], output)
+
+    def test_csv(self, app):
+        resource = self._resource()
+        res = app.get(self._url(resource, 'csv'), query_string={
+            'fields': 'n', 'sort': 'n desc',
+            'filters': json.dumps({'name': 'a'})})
+        assert res.status_code == 200
+        assert res.headers['Content-Type'] == 'text/csv; charset=utf-8'
+        assert res.headers['Content-Disposition'] == \
+            'attachment; filename="{0}.csv"'.format(resource['id'])
+        assert res.body == 'n\r\n3\r\n2\r\n'
+
+    def test_ndjson_gzipped(self, app):
+        resource = self._resource()
+        res = app.get(self._url(resource, 'ndjson'),
+                      query_string={'sort': 'n', 'limit': '2'},
+                      headers={'Accept-Encoding': 'gzip, deflate'})
+        assert res.status_code == 200
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert res.headers['Vary'] == 'Accept-Encoding'
+        lines = gzip.decompress(res.get_data()).splitlines()
+        assert [json.loads(line) for line in lines] == [
+            {'name': 'b', 'n': 1}, {'name': 'a', 'n': 2}]
+
+    def test_streamed(self, app):
+        resource = self._resource()
+        res = app.get(self._url(resource, 'csv'))
+        assert res.is_streamed
+        assert res.body.startswith('name,n\r\n')
+
+    @pytest.mark.parametrize('output, params, status', [
+        ('xml', {}, 404),
+        ('csv', {'fields': 'missing'}, 400),
+        ('csv', {'limit': '-1'}, 400),
+    ])
+    def test_invalid(self, app, output, params, status):
+        resource = self._resource()
+        res = app.get(self._url(resource, output), query_string=params,
+                      status=status)
+        assert res.status_code == status
+
+    def test_parquet_unavailable(self, app, monkeypatch):
+        monkeypatch.setattr(export, 'parquet_available', lambda: False)
+        resource = self._resource()
+        res = app.get(self._url(resource, 'parquet'), status=400)
+        assert res.status_code == 400
@@ -0,0 +1,226 @@
+# encoding: utf-8
+import pytest
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer import fragments, fulltext
+
+RESOURCE = {'id': 'r1', 'metadata_modified': '2020-01-01T00:00:00',
+            'datastore_active': True}
+VIEW = {'id': 'v1', 'view_type': 'dataexplorer_table_view'}
+
+
+@pytest.fixture
+def state(monkeypatch):
+    state = {'revision': 'rev1', 'profile': False, 'lang': 'en',
+             'assets': 'a1'}
+    monkeypatch.setattr(fragments.db, 'revision_key',
+                        lambda resource: state['revision'])
+    monkeypatch.setattr(fragments.profile, 'profile_exists',
+                        lambda resource, revision=None: state['profile'])
+    monkeypatch.setattr(fragments.h, 'lang', lambda: state['lang'])
+    monkeypatch.setattr(fragments.assets, 'asset_version',
+                        lambda: state['assets'])
+    return state
+
+
+def test_fragment_key_is_stable(state):
+    assert fragments.fragment_key(VIEW, RESOURCE) == \
+        fragments.fragment_key(dict(VIEW), dict(RESOURCE))
+
+
+@pytest.mark.parametrize('name, value', [
+    ('revision', 'rev2'),
+    ('profile', True),
+    ('lang', 'fr'),
+    ('assets', 'a2'),
+])
+def test_fragment_key_changes_with_state(state, name, value):
+    key = fragments.fragment_key(VIEW, RESOURCE)
+    state[name] = value
+    assert fragments.fragment_key(VIEW, RESOURCE) != key
+
+
+@pytest.mark.parametrize('option, value', [
+    ('ckanext.dataexplorer.wire_format', 'columns'),
+    ('ckanext.dataexplorer.table.paging', 'keyset'),
+    ('ckanext.dataexplorer.count.strategy', 'estimate'),
+    ('ckanext.dataexplorer.payload', 'compact'),
+    ('ckanext.dataexplorer.inline_rows', '100'),
+])
+def test_fragment_key_changes_with_config(state, ckan_config, monkeypatch,
+                                          option, value):
+    key = fragments.fragment_key(VIEW, RESOURCE)
+    monkeypatch.setitem(ckan_config, option, value)
+    assert fragments.fragment_key(VIEW, RESOURCE) != key
+
+
+def test_fragment_key_changes_with_view_and_resource(state):
+    key = fragments.fragment_key(VIEW, RESOURCE)
+    assert fragments.fragment_key(dict(VIEW, filters={'a': ['1']}),
+                                  RESOURCE) != key
+    assert fragments.fragment_key(VIEW, dict(
+        RESOURCE, metadata_modified='2020-01-02T00:00:00')) != key
+
+
+def test_fragment_key_without_datastore(state):
+    resource = dict(RESOURCE, datastore_active=False)
+    key = fragments.fragment_key(VIEW, resource)
+    state['revision'] = 'rev2'
+    assert fragments.fragment_key(VIEW, resource) == key
+
+
+def test_view_payload_is_cached(state):
+    calls = []
+
+    def build():
+        calls.append(1)
+        return {'widgets': [{'name': 'Table'}],
+                'datapackage': {'resources': [dict(RESOURCE)]}}
+
+    view = dict(VIEW, id='v-cached')
+    first = fragments.view_payload(view, RESOURCE, build)
+    assert fragments.view_payload(view, RESOURCE, build) == first
+    assert len(calls) == 1
+    state['revision'] = 'rev2'
+    fragments.view_payload(view, RESOURCE, build)
+    assert len(calls) == 2
+
+
+def test_serialize_payload():
+    payload = fragments.serialize_payload({
+        'widgets': [{'name': 'Table'}],
+        'datapackage': {'name': 'd', 'resources': [
+            {'id': 'r1', 'schema': {'fields': [{'name': 'a'}]}}]}})
+    assert fragments.json.loads(payload) == {
+        'widgets': [{'name': 'Table'}],
+        'datapackage': {'name': 'd', 'resources': [
+            {'id': 'r1', 'schema': {'fields': [{'name': 'a'}]}}]}}
+
+
+def test_attribute_value():
+    assert fragments.attribute_value(u'{"a":"<b>\'&"}') == \
+        u'{"a":"&lt;b&gt;&#39;&amp;"}'
+
+
+def test_splice():
+    assert fragments._splice(u'{}', 'a', u'1') == u'{"a":1}'
+    assert fragments._splice(u'{"a":1}', 'b', u'[2,{"c":3}]') == \
+        u'{"a":1,"b":[2,{"c":3}]}'
+
+
+def _payload(resource):
+    return fragments.json.loads(fragments.serialize_payload({
+        'widgets': [], 'datapackage': {'resources': [resource]}}))[
+        'datapackage']['resources'][0]
+
+
+def test_compact_payload(state, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.payload',
+                        'compact')
+    resource = dict(RESOURCE, id='r-compact', description='long text',
+                    api={'api': 'search'}, schema={'fields': [
+                        {'name': 'a', 'type': 'integer', 'title': 'A',
+                         'description': 'long text', 'stats': {'min': 1}}]})
+    assert _payload(resource) == {
+        'id': 'r-compact', 'datastore_active': True,
+        'api': {'api': 'search'}, 'schema': {'fields': [
+            {'name': 'a', 'type': 'integer', 'stats': {'min': 1}}]}}
+
+
+def test_schema_serialized_once_per_state(state):
+    resource = dict(RESOURCE, id='r-schema',
+                    schema={'fields': [{'name': 'a', 'type': 'integer'}]})
+    assert _payload(resource)['schema']['fields'][0]['type'] == 'integer'
+    # the same table, profile and search index: the schema is reused
+    resource['schema'] = {'fields': [{'name': 'a', 'type': 'number'}]}
+    assert _payload(resource)['schema']['fields'][0]['type'] == 'integer'
+    state['profile'] = True
+    assert _payload(resource)['schema']['fields'][0]['type'] == 'number'
+
+
+def test_schema_without_datastore_state(state):
+    resource = dict(RESOURCE, id='r-preview', datastore_active=False,
+                    schema={'fields': [{'name': 'a', 'type': 'integer'}]})
+    assert _payload(resource)['schema']['fields'][0]['type'] == 'integer'
+    resource['schema'] = {'fields': [{'name': 'a', 'type': 'number'}]}
+    assert _payload(resource)['schema']['fields'][0]['type'] == 'number'
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestResourceMetadata(object):
+
+    def _url(self, resource):
+        return '/dataexplorer/metadata/{0}.json'.format(resource['id'])
+
+    def test_metadata(self, app):
+        resource = factories.Resource(description='long text')
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'n', 'type': 'int',
+                     'info': {'label': 'Count', 'notes': 'How many'}}],
+            records=[{'n': 1}, {'n': 2}])
+        res = app.get(self._url(resource))
+        result = res.json['result']
+        assert result['description'] == 'long text'
+        assert [(f['name'], f['title'], f['description'])
+                for f in result['schema']['fields']] == \
+            [('n', 'Count', 'How many')]
+        assert res.headers['ETag']
+        assert res.headers['Cache-Control'].startswith('public')
+
+    def test_etag(self, app):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'n', 'type': 'int'}], records=[{'n': 1}])
+        etag = app.get(self._url(resource)).headers['ETag']
+        assert app.get(self._url(resource), headers={
+            'If-None-Match': etag}).status_code == 304
+        helpers.call_action('datastore_upsert', resource_id=resource['id'],
+                            force=True, method='insert', records=[{'n': 2}])
+        res = app.get(self._url(resource), headers={'If-None-Match': etag})
+        assert res.status_code == 200
+        assert res.headers['ETag'] != etag
+
+    def test_not_found(self, app):
+        app.get('/dataexplorer/metadata/missing.json', status=404)
+
+
+@pytest.mark.ckan_config('ckan.plugins',
+                         'datastore dataexplorer dataexplorer_table_view')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestViewPage(object):
+
+    def _url(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'n', 'type': 'int'}], records=[{'n': 1}])
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type='dataexplorer_table_view', title='Table')
+        return '/dataset/{0}/resource/{1}/view/{2}'.format(
+            resource['package_id'], resource['id'], view['id'])
+
+    def test_not_modified(self, app, monkeypatch):
+        url = self._url()
+        etag = app.get(url).headers['ETag']
+
+        def search_index(resource_id):
+            raise AssertionError('search index read')
+        monkeypatch.setattr(fulltext, 'search_index', search_index)
+        res = app.get(url, headers={'If-None-Match': etag})
+        assert res.status_code == 304
+        assert res.headers['ETag'] == etag
+
+    def test_etag_of_each_locale(self, app):
+        url = self._url()
+        etag = app.get(url).headers['ETag']
+        res = app.get('/fr' + url, headers={'If-None-Match': etag})
+        assert res.status_code == 200
+        assert res.headers['ETag'] != etag
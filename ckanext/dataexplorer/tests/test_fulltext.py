@@ -0,0 +1,184 @@
+# encoding: utf-8
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer import db, fulltext
+from ckanext.dataexplorer.tableschema import datastore_fields_to_schema
+
+
+def test_highlight():
+    text = u'<b>{0}cats{1}</b> & dogs'.format(fulltext.START_SEL,
+                                               fulltext.STOP_SEL)
+    assert fulltext.highlight(text) == \
+        u'&lt;b&gt;<mark>cats</mark>&lt;/b&gt; &amp; dogs'
+    assert fulltext.highlight(u'no match') is None
+    assert fulltext.highlight(None) is None
+
+
+def test_highlight_substring():
+    assert fulltext.highlight_substring(u'Cat <cat> CAT', u'cat') == (
+        u'<mark>Cat</mark> &lt;<mark>cat</mark>&gt; <mark>CAT</mark>')
+    assert fulltext.highlight_substring(u'dog', u'cat') is None
+    assert fulltext.highlight_substring(12, u'1') is None
+
+
+def test_like_pattern_escapes_wildcards():
+    assert fulltext._like_pattern(u'50%_a\\b') == u'%50\\%\\_a\\\\b%'
+
+
+def test_text_fields():
+    assert fulltext.text_fields([
+        {'name': 'a', 'type': 'string'}, {'name': 'n', 'type': 'integer'},
+        {'name': 'b', 'type': 'string'}]) == ['a', 'b']
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestSearchIndex(object):
+
+    def _resource(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'title', 'type': 'text'},
+                    {'id': 'body', 'type': 'text'},
+                    {'id': 'year', 'type': 'int'}],
+            records=[
+                {'title': 'Rivers', 'body': 'Cats swim in <rivers>',
+                 'year': 2000},
+                {'title': 'Cats', 'body': 'A book about dogs', 'year': 2001},
+                {'title': 'Mountains', 'body': 'Nothing here', 'year': 2000},
+            ])
+        return resource['id']
+
+    def _index(self, resource_id, **kwargs):
+        return fulltext.create_index(
+            resource_id, datastore_fields_to_schema({'id': resource_id}),
+            trigram=False, batch_size=2, **kwargs)
+
+    def test_create_index(self):
+        resource_id = self._resource()
+        assert fulltext.search_index(resource_id) is None
+        index = self._index(resource_id, fields=['title', 'body'],
+                            weights={'title': 'A'}, language='simple')
+        assert index == {
+            'language': 'simple',
+            'fields': [{'name': 'title', 'weight': 'A'},
+                       {'name': 'body', 'weight': 'B'}],
+            'indexed': True,
+            'trigram': [],
+        }
+
+    @pytest.mark.parametrize('kwargs', [
+        {'fields': ['year']},
+        {'fields': ['missing']},
+        {'weights': {'title': 'E'}},
+        {'fields': ['body'], 'weights': {'title': 'A'}},
+        {'language': 'klingon'},
+    ])
+    def test_invalid_index(self, kwargs):
+        resource_id = self._resource()
+        with pytest.raises(toolkit.ValidationError):
+            self._index(resource_id, **kwargs)
+
+    def test_search_ranks_weighted_fields_first(self):
+        resource_id = self._resource()
+        self._index(resource_id, weights={'title': 'A'})
+        result = helpers.call_action(
+            'dataexplorer_text_search', resource_id=resource_id, q='cats')
+        assert [r['title'] for r in result['records']] == ['Cats', 'Rivers']
+        assert result['total'] == 2
+        assert result['records'][0]['_rank'] > result['records'][1]['_rank']
+        highlight = result['records'][1]['_highlight']
+        assert list(highlight) == ['body']
+        assert highlight['body'].startswith(u'<mark>Cats</mark> swim')
+
+    def test_search_fields_and_filters(self):
+        resource_id = self._resource()
+        self._index(resource_id)
+        result = helpers.call_action(
+            'dataexplorer_text_search', resource_id=resource_id, q='cats',
+            fields=['body'], highlight=False)
+        assert [r['title'] for r in result['records']] == ['Rivers']
+        assert '_highlight' not in result['records'][0]
+        result = helpers.call_action(
+            'dataexplorer_text_search', resource_id=resource_id, q='cats',
+            filters={'year': 2001})
+        assert [r['title'] for r in result['records']] == ['Cats']
+
+    def test_rows_written_later_are_indexed(self):
+        resource_id = self._resource()
+        self._index(resource_id)
+        helpers.call_action(
+            'datastore_upsert', resource_id=resource_id, force=True,
+            method='insert', records=[{'title': 'Cats again', 'year': 2002}])
+        result = helpers.call_action(
+            'dataexplorer_text_search', resource_id=resource_id, q='cats')
+        assert result['total'] == 3
+
+    def test_repair_and_drop(self, monkeypatch):
+        queued = []
+        monkeypatch.setattr(toolkit, 'enqueue_job',
+                            lambda fn, args, **kwargs: queued.append(
+                                (fn, args)))
+        resource_id = self._resource()
+        self._index(resource_id)
+        helpers.call_action(
+            'datastore_create', resource_id=resource_id, force=True,
+            indexes='year')
+        assert not fulltext.search_index(resource_id)['indexed']
+        assert queued == [(fulltext.restore_indexes, [resource_id])]
+        fulltext.restore_indexes(resource_id, trigram=False)
+        assert fulltext.search_index(resource_id)['indexed']
+
+        helpers.call_action('dataexplorer_search_index_delete',
+                            resource_id=resource_id)
+        assert fulltext.search_index(resource_id) is None
+        with pytest.raises(toolkit.ObjectNotFound):
+            helpers.call_action('dataexplorer_text_search',
+                                resource_id=resource_id, q='cats')
+
+    def test_index_changes_bump_the_revision(self):
+        resource_id = self._resource()
+        revision = db.table_revision(resource_id)
+        self._index(resource_id)
+        assert db.table_revision(resource_id) > revision
+        revision = db.table_revision(resource_id)
+        fulltext.restore_indexes(resource_id, trigram=False)
+        assert db.table_revision(resource_id) > revision
+        revision = db.table_revision(resource_id)
+        fulltext.drop_index(resource_id)
+        assert db.table_revision(resource_id) > revision
+
+    def test_invalid_search(self):
+        resource_id = self._resource()
+        self._index(resource_id, fields=['title'])
+        for data_dict in [{'q': ''}, {'q': 'ab', 'mode': 'substring'},
+                          {'q': 'cats', 'mode': 'regex'},
+                          {'q': 'cats', 'fields': ['body']},
+                          {'q': 'cats', 'mode': 'substring'}]:
+            with pytest.raises(toolkit.ValidationError):
+                helpers.call_action('dataexplorer_text_search',
+                                    resource_id=resource_id, **data_dict)
+
+    def test_create_action_queues_the_build(self, monkeypatch):
+        queued = []
+        monkeypatch.setattr(toolkit, 'enqueue_job',
+                            lambda fn, args, **kwargs: queued.append(
+                                (fn, args)))
+        resource_id = self._resource()
+        result = helpers.call_action(
+            'dataexplorer_search_index_create', resource_id=resource_id,
+            weights={'title': 'A'}, trigram=False)
+        assert result['fields'] == ['title', 'body']
+        assert queued == [(fulltext.index_resource, [
+            resource_id, ['title', 'body'], {'title': 'A'},
+            fulltext.default_language(), False])]
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                'dataexplorer_search_index_create', resource_id=resource_id,
+                fields=['year'])
@@ -0,0 +1,181 @@
+# encoding: utf-8
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.common import json
+
+from ckanext.dataexplorer import db, geo, geoindex, indexes, query, tiles
+from ckanext.dataexplorer.tableschema import datastore_fields_to_schema
+
+
+def _point(lon, lat):
+    return json.dumps({'type': 'Point', 'coordinates': [lon, lat]})
+
+
+GEOMETRIES = [
+    _point(1, 2),
+    json.dumps({'type': 'Feature', 'properties': {}, 'geometry': {
+        'type': 'Polygon',
+        'coordinates': [[[10, 10], [13, 10], [13, 14], [10, 10]]]}}),
+    json.dumps({'type': 'GeometryCollection', 'geometries': [
+        {'type': 'Point', 'coordinates': [-5, 2]},
+        {'type': 'LineString', 'coordinates': [[1, 1], [7, -3]]}]}),
+    u'not json',
+    json.dumps({'type': 'Point'}),
+    None,
+]
+
+
+def test_view_geometry_fields():
+    assert indexes.view_geometry_fields('dataexplorer_map_view', {
+        'map_field_type': 'geometry', 'geometry_field': 'geom'}) == ['geom']
+    assert indexes.view_geometry_fields('dataexplorer_map_view', {
+        'map_field_type': 'lat_long', 'latitude_field': 'lat',
+        'longitude_field': 'lon'}) == []
+    assert indexes.view_geometry_fields('dataexplorer_table_view', {
+        'map_field_type': 'geometry', 'geometry_field': 'geom'}) == []
+
+
+def test_bbox_crossing_the_antimeridian():
+    bbox = geo.parse_bbox('170,-10,-170,10')
+    assert bbox == (170.0, -10.0, -170.0, 10.0)
+    assert geo.split_bbox(bbox) == [(170.0, -10.0, 180.0, 10.0),
+                                    (-180.0, -10.0, -170.0, 10.0)]
+    assert geo.bbox_intersects((175, 0, 176, 1), bbox)
+    assert geo.bbox_intersects((-176, 0, -175, 1), bbox)
+    assert not geo.bbox_intersects((0, 0, 1, 1), bbox)
+    with pytest.raises(ValueError):
+        geo.parse_bbox('0,10,1,-10')
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestBboxIndex(object):
+
+    def _resource(self, geometries=GEOMETRIES):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'},
+                    {'id': 'geom', 'type': 'text'}],
+            records=[{'name': str(i), 'geom': g}
+                     for i, g in enumerate(geometries)])
+        return resource['id']
+
+    def _index(self, resource_id):
+        return geoindex.create_bbox_index(
+            resource_id, datastore_fields_to_schema({'id': resource_id}),
+            'geom', batch_size=2)
+
+    def _boxes(self, resource_id):
+        return dict((r['name'], r['box']) for r in db.execute(
+            u'SELECT name, {0}::text AS box FROM {1}'.format(
+                db.identifier(geoindex.bbox_column('geom')),
+                db.identifier(resource_id))))
+
+    def test_boxes_of_existing_and_new_rows(self):
+        resource_id = self._resource()
+        assert geoindex.bbox_indexes(resource_id) == {}
+        assert not geoindex.bbox_indexed(resource_id, 'geom')
+
+        assert self._index(resource_id) == {'geom': True}
+        assert geoindex.bbox_indexed(resource_id, 'geom')
+        helpers.call_action(
+            'datastore_upsert', resource_id=resource_id, force=True,
+            method='insert', records=[{'name': 'new', 'geom': _point(3, 4)}])
+        helpers.call_action(
+            'datastore_upsert', resource_id=resource_id, force=True,
+            method='upsert', records=[{'_id': 1, 'geom': _point(-1, -2)}])
+
+        assert self._boxes(resource_id) == {
+            '0': '(-1,-2),(-1,-2)', '1': '(13,14),(10,10)',
+            '2': '(7,2),(-5,-3)', '3': None, '4': None, '5': None,
+            'new': '(3,4),(3,4)',
+        }
+
+    def test_boxes_match_geometry_bbox(self):
+        resource_id = self._resource()
+        self._index(resource_id)
+        boxes = self._boxes(resource_id)
+        for i, value in enumerate(GEOMETRIES):
+            geometry = value and geo.load_geometry(value)
+            bbox = geometry and geo.geometry_bbox(geometry)
+            expected = None
+            if bbox:
+                expected = u'({2:g},{3:g}),({0:g},{1:g})'.format(*bbox)
+            assert boxes[str(i)] == expected
+
+    def test_drop(self):
+        resource_id = self._resource()
+        self._index(resource_id)
+        geoindex.drop_bbox_index(resource_id, 'geom')
+        assert geoindex.bbox_indexes(resource_id) == {}
+        helpers.call_action(
+            'datastore_upsert', resource_id=resource_id, force=True,
+            method='insert', records=[{'name': 'new', 'geom': _point(3, 4)}])
+
+    def test_repair_after_datastore_create(self, monkeypatch):
+        queued = []
+        monkeypatch.setattr(toolkit, 'enqueue_job',
+                            lambda fn, args, **kwargs: queued.append(
+                                (fn, args)))
+        resource_id = self._resource()
+        self._index(resource_id)
+        helpers.call_action(
+            'datastore_create', resource_id=resource_id, force=True,
+            indexes='name')
+        assert geoindex.bbox_indexes(resource_id) == {'geom': False}
+        assert queued == [(geoindex.restore_indexes, [resource_id])]
+
+        geoindex.restore_indexes(resource_id)
+        assert geoindex.bbox_indexes(resource_id) == {'geom': True}
+
+    def test_tile_reads_overlapping_rows_only(self, monkeypatch):
+        far = [_point(100 + i, 40) for i in range(20)]
+        resource_id = self._resource(GEOMETRIES + far)
+        schema = datastore_fields_to_schema({'id': resource_id})
+        expected = tiles.build_tile(resource_id, schema, 'geom', {}, 3, 4, 3)
+
+        self._index(resource_id)
+        loaded = []
+        load_geometry = geo.load_geometry
+        monkeypatch.setattr(geo, 'load_geometry',
+                            lambda value: loaded.append(value) or
+                            load_geometry(value))
+        tile = tiles.build_tile(resource_id, schema, 'geom', {}, 3, 4, 3)
+        assert tile == expected
+        assert sorted(f['properties']['name'] for f in tile['features']) == [
+            '0', '1', '2']
+        assert len(loaded) == 3
+
+    def test_map_data_reads_overlapping_rows_only(self, monkeypatch):
+        far = [_point(100 + i, 40) for i in range(20)]
+        resource_id = self._resource(GEOMETRIES + far)
+        data_dict = {'resource_id': resource_id, 'geometry_field': 'geom',
+                     'bbox': '0,0,20,20', 'zoom': 5}
+        expected = helpers.call_action('dataexplorer_map_data', **data_dict)
+
+        self._index(resource_id)
+        query.invalidate(resource_id)
+        loaded = []
+        load_geometry = geo.load_geometry
+        monkeypatch.setattr(geo, 'load_geometry',
+                            lambda value: loaded.append(value) or
+                            load_geometry(value))
+        result = helpers.call_action('dataexplorer_map_data', **data_dict)
+        assert result['records'] == expected['records']
+        assert sorted(r['name'] for r in result['records']) == [
+            '0', '1', '2']
+        assert len(loaded) == 3
+
+    def test_map_data_across_the_antimeridian(self):
+        resource_id = self._resource(
+            [_point(175, 0), _point(-175, 0), _point(0, 0)])
+        self._index(resource_id)
+        result = helpers.call_action(
+            'dataexplorer_map_data', resource_id=resource_id,
+            geometry_field='geom', bbox='170,-10,-170,10', zoom=5)
+        assert sorted(r['name'] for r in result['records']) == ['0', '1']
@@ -0,0 +1,99 @@
+# encoding: utf-8
+import pytest
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer import db, fulltext, indexes
+from ckanext.dataexplorer.tableschema import datastore_fields_to_schema
+
+
+def _index_definitions(resource_id):
+    return dict((r['indexname'], r['indexdef']) for r in db.execute(u'''
+        SELECT indexname, indexdef FROM pg_indexes
+        WHERE tablename = :resource_id AND schemaname = 'public'
+    ''', {'resource_id': resource_id}))
+
+
+def test_view_index_fields():
+    assert indexes.view_index_fields('dataexplorer_chart_view', {
+        'filters': {'b': ['1'], 'a': ['2']}, 'group': 'g',
+        'sort': 'n desc'}) == [['a', 'b'], ['g'], ['n']]
+    assert indexes.view_index_fields('dataexplorer_map_view', {
+        'map_field_type': 'lat_long', 'latitude_field': 'lat',
+        'longitude_field': 'lon', 'sort': '_id'}) == [['lat', 'lon']]
+    assert indexes.view_index_fields('dataexplorer_table_view', {}) == []
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestCreateIndexes(object):
+
+    context = {'ignore_auth': True}
+
+    def _resource(self, **kwargs):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'},
+                    {'id': 'lat', 'type': 'float'},
+                    {'id': 'lon', 'type': 'float'}],
+            records=[{'name': 'a b', 'lat': 1, 'lon': 2}], **kwargs)
+        return resource['id']
+
+    def test_missing_indexes(self):
+        resource_id = self._resource(indexes='name')
+        assert indexes.table_indexes(resource_id) == [['name']]
+        wanted = [['name'], ['lat'], ['lat', 'lon'], ['lon'], ['lat', 'lon']]
+        assert indexes.missing_indexes(resource_id, wanted) == [
+            ['lat', 'lon'], ['lon']]
+
+    def test_creates_missing_btree_indexes_only(self):
+        resource_id = self._resource(indexes='name')
+        fulltext.create_index(resource_id,
+                              datastore_fields_to_schema(
+                                  {'id': resource_id}), trigram=False)
+        before = _index_definitions(resource_id)
+
+        created = indexes.create_indexes(
+            self.context, resource_id, [['name'], ['lat', 'lon'], ['lat']])
+
+        assert created == [['lat', 'lon']]
+        after = _index_definitions(resource_id)
+        # the other indexes, GIN included, are left as they are
+        assert dict((k, after[k]) for k in before) == before
+        name = indexes.index_name(resource_id, ['lat', 'lon'])
+        assert 'USING btree (lat, lon)' in after[name]
+        assert ['lat', 'lon'] in indexes.table_indexes(resource_id)
+        assert fulltext.search_index(resource_id)['indexed']
+        assert indexes.create_indexes(
+            self.context, resource_id, [['lat', 'lon']]) == []
+
+    def test_gin_index_does_not_count(self):
+        resource_id = self._resource()
+        fulltext.create_index(resource_id,
+                              datastore_fields_to_schema(
+                                  {'id': resource_id}), trigram=False)
+        assert indexes.missing_indexes(
+            resource_id, [[fulltext.COLUMN]]) == [[fulltext.COLUMN]]
+
+    def test_invalid_index_is_rebuilt(self):
+        resource_id = self._resource()
+        name = indexes.index_name(resource_id, ['lat'])
+        with db.get_write_engine().begin() as connection:
+            connection.execute(u'CREATE INDEX {0} ON {1} (lat)'.format(
+                db.identifier(name), db.identifier(resource_id)))
+            connection.execute(u'''
+                UPDATE pg_index SET indisvalid = false
+                WHERE indexrelid = '{0}'::regclass'''.format(
+                db.identifier(name)))
+        assert indexes.table_indexes(resource_id) == []
+        assert indexes.create_indexes(
+            self.context, resource_id, [['lat']]) == [['lat']]
+        assert indexes.table_indexes(resource_id) == [['lat']]
+
+    def test_unknown_field(self):
+        resource_id = self._resource()
+        with pytest.raises(helpers.logic.ValidationError):
+            indexes.create_indexes(self.context, resource_id, [['missing']])
@@ -0,0 +1,129 @@
+# encoding: utf-8
+import socket
+
+import pytest
+
+from ckanext.dataexplorer import metrics
+
+
+@pytest.fixture
+def registry():
+    metrics.registry.clear()
+    yield metrics.registry
+    metrics.registry.clear()
+
+
+def test_histogram():
+    histogram = metrics.Histogram([1, 5])
+    for value in [0.5, 1, 3, 10]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 3]
+    assert histogram.count == 4
+    assert histogram.sum == 14.5
+
+
+def test_prometheus_text(registry):
+    metrics.record('schema', 0.003, 'dataexplorer_map_view')
+    metrics.record('schema', 0.02, 'dataexplorer_map_view')
+    metrics.record_payload('dataexplorer_map_view', 2000)
+    lines = metrics.prometheus_text().splitlines()
+    labels = u'phase="schema",view_type="dataexplorer_map_view"'
+    assert u'dataexplorer_phase_seconds_bucket{{le="0.001",{0}}} 0'.format(
+        labels) in lines
+    assert u'dataexplorer_phase_seconds_bucket{{le="0.005",{0}}} 1'.format(
+        labels) in lines
+    assert u'dataexplorer_phase_seconds_bucket{{le="+Inf",{0}}} 2'.format(
+        labels) in lines
+    assert u'dataexplorer_phase_seconds_sum{{{0}}} 0.023000'.format(
+        labels) in lines
+    assert u'dataexplorer_phase_seconds_count{{{0}}} 2'.format(
+        labels) in lines
+    assert u'dataexplorer_payload_bytes_bucket{le="1024",' \
+        u'view_type="dataexplorer_map_view"} 0' in lines
+    assert u'dataexplorer_payload_bytes_bucket{le="4096",' \
+        u'view_type="dataexplorer_map_view"} 1' in lines
+    assert u'# TYPE dataexplorer_payload_bytes histogram' in lines
+
+
+def test_label_values_escaped(registry):
+    metrics.record('a"b\\c', 1)
+    assert u'phase="a\\"b\\\\c"' in metrics.prometheus_text()
+
+
+def test_timed(registry):
+    @metrics.timed('work')
+    def work(value):
+        return value * 2
+    assert work(21) == 42
+    assert registry.latency[(metrics.NO_VIEW, 'work')].count == 1
+
+
+def test_statsd():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    metrics.configure({
+        'ckanext.dataexplorer.metrics.statsd': '127.0.0.1:{0}'.format(
+            server.getsockname()[1]),
+        'ckanext.dataexplorer.metrics.statsd_prefix': 'site'})
+    try:
+        metrics.record('schema', 0.0125, 'dataexplorer_table_view')
+        assert server.recv(1024) == \
+            b'site.dataexplorer_table_view.schema:12.500|ms'
+        metrics.record_payload(None, 300)
+        assert server.recv(1024) == b'site.api.payload_bytes:300|h'
+    finally:
+        metrics.configure({})
+        server.close()
+    assert metrics._statsd['address'] is None
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+class TestRequestMetrics(object):
+
+    def test_timed_view(self, registry):
+        class View(object):
+            @metrics.timed_view
+            def setup_template_variables(self, context, data_dict):
+                with metrics.timer('schema'):
+                    pass
+                return {}
+        View().setup_template_variables({}, {'resource_view': {
+            'view_type': 'dataexplorer_chart_view'}})
+        metrics.record('url_for', 0.001)
+        assert sorted(registry.latency) == [
+            ('api', 'url_for'),
+            ('dataexplorer_chart_view', 'render'),
+            ('dataexplorer_chart_view', 'schema')]
+        timing = metrics.server_timing()
+        assert timing.startswith(u'api.url_for;dur=1.0, '
+                                 u'dataexplorer_chart_view.render;dur=')
+        assert u'dataexplorer_chart_view.schema;dur=' in timing
+
+    def test_metrics_endpoint(self, app, ckan_config, monkeypatch, registry):
+        monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.metrics.token',
+                            'secret')
+        metrics.record('schema', 0.01, 'dataexplorer_view')
+        app.get('/dataexplorer/metrics', status=403)
+        app.get('/dataexplorer/metrics', status=403,
+                headers={'Authorization': 'Bearer wrong'})
+        res = app.get('/dataexplorer/metrics',
+                      headers={'Authorization': 'Bearer secret'})
+        assert res.headers['Content-Type'].startswith('text/plain')
+        assert u'dataexplorer_phase_seconds_count{phase="schema",' \
+            u'view_type="dataexplorer_view"} 1' in res.body
+
+    def test_server_timing_header(self, app, ckan_config, monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.dataexplorer.metrics.debug_header', 'true')
+        monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.metrics.token',
+                            'secret')
+        res = app.get('/dataexplorer/metrics',
+                      headers={'Authorization': 'Bearer secret'})
+        assert 'Server-Timing' not in res.headers
+        monkeypatch.setattr(metrics, 'server_timing',
+                            lambda: u'api.schema;dur=1.0')
+        res = app.get('/dataexplorer/metrics',
+                      headers={'Authorization': 'Bearer secret'})
+        assert res.headers['Server-Timing'] == u'api.schema;dur=1.0'
@@ -0,0 +1,185 @@
+# encoding: utf-8
+import base64
+
+import pytest
+
+from ckan.common import json
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer import paging
+
+
+def test_parse_sort():
+    assert paging.parse_sort(None) == (u'_id', False)
+    assert paging.parse_sort(u'name') == (u'name', False)
+    assert paging.parse_sort(u'"name" DESC') == (u'name', True)
+    assert paging.parse_sort(u'first name asc') == (u'first name', False)
+
+
+def test_seek_first_page():
+    params = {}
+    assert paging.seek(u'_id', False, None, params) == (None, u'"_id" ASC')
+    assert paging.seek(u'_id', True, None, params) == (None, u'"_id" DESC')
+    assert paging.seek(u'name', False, None, params) == (
+        None, u'"name" ASC NULLS LAST, "_id" ASC')
+    assert paging.seek(u'name', True, None, params) == (
+        None, u'"name" DESC NULLS LAST, "_id" DESC')
+    assert params == {}
+
+
+@pytest.mark.parametrize(u'descending, direction, op, order', [
+    (False, u'next', u'>', u'ASC'),
+    (False, u'prev', u'<', u'DESC'),
+    (True, u'next', u'<', u'DESC'),
+    (True, u'prev', u'>', u'ASC'),
+])
+def test_seek_by_id(descending, direction, op, order):
+    params = {}
+    cursor = {u'v': 10, u'id': 10, u'd': direction}
+    assert paging.seek(u'_id', descending, cursor, params) == (
+        u'"_id" {0} :cursor_id'.format(op), u'"_id" {0}'.format(order))
+    assert params == {u'cursor_id': 10}
+
+
+@pytest.mark.parametrize(u'descending, direction, op, order, nulls', [
+    (False, u'next', u'>', u'ASC', u'LAST'),
+    (False, u'prev', u'<', u'DESC', u'FIRST'),
+    (True, u'next', u'<', u'DESC', u'LAST'),
+    (True, u'prev', u'>', u'ASC', u'FIRST'),
+])
+def test_seek_by_field(descending, direction, op, order, nulls):
+    params = {}
+    cursor = {u'v': u'b', u'id': 3, u'd': direction}
+    condition, order_by = paging.seek(u'name', descending, cursor, params)
+    assert order_by == u'"name" {0} NULLS {1}, "_id" {0}'.format(
+        order, nulls)
+    assert u'("name", "_id") {0} (:cursor_value, :cursor_id)'.format(
+        op) in condition
+    # rows with no value come after all the others when reading forward
+    assert (u'"name" IS NULL' in condition) == (direction == u'next')
+    assert params == {u'cursor_value': u'b', u'cursor_id': 3}
+
+
+def test_seek_null_cursor_value():
+    params = {}
+    condition, _ = paging.seek(
+        u'name', False, {u'v': None, u'id': 3, u'd': u'next'}, params)
+    assert condition == u'"name" IS NULL AND "_id" > :cursor_id'
+    condition, _ = paging.seek(
+        u'name', False, {u'v': None, u'id': 3, u'd': u'prev'}, params)
+    assert condition == (u'("name" IS NOT NULL OR '
+                         u'("name" IS NULL AND "_id" < :cursor_id))')
+
+
+@pytest.mark.parametrize(u'direction', [u'next', u'prev'])
+@pytest.mark.parametrize(u'value', [
+    u'caf\xe9', 12, 1.5, None, True, u'2020-01-01T10:00:00'])
+def test_cursor_round_trip(direction, value):
+    cursor = paging.encode_cursor(
+        {u'name': value, u'_id': 42}, u'name', direction)
+    assert u'=' not in cursor
+    assert paging.decode_cursor(cursor) == {
+        u'v': value, u'id': 42, u'd': direction}
+
+
+def _raw_cursor(data):
+    return base64.urlsafe_b64encode(
+        json.dumps(data).encode(u'utf-8')).decode(u'ascii')
+
+
+@pytest.mark.parametrize(u'cursor', [
+    u'not a cursor', u'', paging.encode_cursor(
+        {u'_id': 1}, u'_id', u'sideways'),
+    _raw_cursor([1, 2]),
+    _raw_cursor({u'd': u'next'}),
+    _raw_cursor({u'v': 1, u'id': u'1', u'd': u'next'}),
+    _raw_cursor({u'v': 1, u'id': True, u'd': u'next'}),
+    _raw_cursor({u'v': [1], u'id': 1, u'd': u'next'}),
+    _raw_cursor({u'v': 1, u'id': 1, u'd': u'next', u'x': 1})])
+def test_decode_invalid_cursor(cursor):
+    with pytest.raises(toolkit.ValidationError):
+        paging.decode_cursor(cursor)
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'datastore dataexplorer')
+@pytest.mark.usefixtures(u'clean_datastore', u'with_plugins',
+                         u'with_request_context')
+class TestKeysetPaging(object):
+
+    def _resource(self):
+        resource = factories.Resource()
+        names = [u'c', None, u'a', u'b', None, u'a', u'd']
+        helpers.call_action(
+            u'datastore_create', resource_id=resource[u'id'], force=True,
+            fields=[{u'id': u'name', u'type': u'text'}],
+            records=[{u'name': n} for n in names])
+        return resource[u'id']
+
+    def _search(self, resource_id, sort, cursor=None):
+        return helpers.call_action(
+            u'dataexplorer_search', resource_id=resource_id, sort=sort,
+            limit=2, cursor=cursor, include_total=False)
+
+    def _pages(self, resource_id, sort):
+        page = self._search(resource_id, sort)
+        pages = [page]
+        while page[u'next_cursor']:
+            page = self._search(resource_id, sort, page[u'next_cursor'])
+            pages.append(page)
+        return pages
+
+    def _ids(self, pages):
+        return [r[u'_id'] for p in pages for r in p[u'records']]
+
+    @pytest.mark.parametrize(u'sort, expected', [
+        (u'_id', [1, 2, 3, 4, 5, 6, 7]),
+        (u'_id desc', [7, 6, 5, 4, 3, 2, 1]),
+        (u'name', [3, 6, 4, 1, 7, 2, 5]),
+        (u'name desc', [7, 1, 4, 6, 3, 5, 2]),
+    ])
+    def test_pages(self, sort, expected):
+        resource_id = self._resource()
+        pages = self._pages(resource_id, sort)
+        assert self._ids(pages) == expected
+        assert all(len(p[u'records']) == 2 for p in pages[:-1])
+
+    @pytest.mark.parametrize(u'sort', [u'_id', u'_id desc', u'name',
+                                       u'name desc'])
+    def test_prev_pages(self, sort):
+        resource_id = self._resource()
+        forward = self._pages(resource_id, sort)
+        page = forward[-1]
+        backward = [page]
+        while page[u'prev_cursor']:
+            page = self._search(resource_id, sort, page[u'prev_cursor'])
+            backward.insert(0, page)
+        assert self._ids(backward) == self._ids(forward)
+
+    def test_total_of_the_first_page_only(self):
+        resource_id = self._resource()
+        page = helpers.call_action(
+            u'dataexplorer_search', resource_id=resource_id, limit=2)
+        assert page[u'total'] == 7
+        page = helpers.call_action(
+            u'dataexplorer_search', resource_id=resource_id, limit=2,
+            cursor=page[u'next_cursor'])
+        assert u'total' not in page
+        page = helpers.call_action(
+            u'dataexplorer_search', resource_id=resource_id, limit=2,
+            cursor=page[u'next_cursor'], include_total=True)
+        assert page[u'total'] == 7
+
+    def test_cursor_value_of_another_type(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            u'datastore_create', resource_id=resource[u'id'], force=True,
+            fields=[{u'id': u'n', u'type': u'int'}],
+            records=[{u'n': 1}, {u'n': 2}])
+        cursor = _raw_cursor({u'v': u'abc', u'id': 1, u'd': u'next'})
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                u'dataexplorer_search', resource_id=resource[u'id'],
+                sort=u'n', cursor=cursor)
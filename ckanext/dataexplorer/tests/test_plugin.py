@@ -1,5 +1,193 @@
 """Tests for plugin.py."""
-import ckanext.dataexplorer-react.plugin as plugin
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import ckan.plugins as p
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.common import json
+
+import ckanext.dataexplorer.plugin as plugin
+
+VIEWS = ['dataexplorer_view', 'dataexplorer_table_view',
+         'dataexplorer_chart_view', 'dataexplorer_map_view']
+
 
 def test_plugin():
-    pass
\ No newline at end of file
+    assert p.IClick.implemented_by(plugin.DataExplorerPlugin)
+
+
+@pytest.mark.ckan_config('ckan.plugins',
+                         'datastore dataexplorer ' + ' '.join(VIEWS))
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestViewProfile(object):
+
+    def _view(self, view_type):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'},
+                    {'id': 'n', 'type': 'int'}],
+            records=[{'name': 'a', 'n': 1}, {'name': 'b', 'n': 2}])
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type=view_type, title=view_type)
+        return resource, view
+
+    def _url(self, resource, view):
+        return '/dataset/{0}/resource/{1}/view/{2}'.format(
+            resource['package_id'], resource['id'], view['id'])
+
+    @pytest.mark.parametrize('view_type', VIEWS)
+    def test_profile_read_when_payload_built(self, app, monkeypatch,
+                                             view_type):
+        calls = []
+        monkeypatch.setattr(plugin, 'load_profile',
+                            lambda resource: calls.append(resource['id']))
+        resource, view = self._view(view_type)
+        assert app.get(self._url(resource, view)).status_code == 200
+        assert calls == [resource['id']]
+        # the payload comes from the fragment cache
+        assert app.get(self._url(resource, view)).status_code == 200
+        assert calls == [resource['id']]
+
+    @pytest.mark.parametrize('view_type', VIEWS)
+    def test_profile_database_error(self, app, monkeypatch, view_type):
+        def load_profile(resource):
+            raise OperationalError('SELECT', {}, Exception('gone'))
+        monkeypatch.setattr(plugin, 'load_profile', load_profile)
+        resource, view = self._view(view_type)
+        assert app.get(self._url(resource, view)).status_code == 200
+
+
+@pytest.mark.ckan_config('ckan.plugins',
+                         'datastore dataexplorer dataexplorer_table_view')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestInlineRows(object):
+
+    def _resource(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'name', 'type': 'text'},
+                    {'id': 'n', 'type': 'int'}],
+            records=[{'name': name, 'n': i}
+                     for i, name in enumerate(['ann', 'bob', 'cyd', 'dee'])])
+        return resource
+
+    def test_disabled(self):
+        assert plugin.inline_rows(self._resource()) == []
+
+    def test_first_rows(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.inline_rows',
+                            '2')
+        resource = self._resource()
+        assert [r['name'] for r in plugin.inline_rows(resource)] == [
+            'ann', 'bob']
+        assert [r['name'] for r in plugin.inline_rows(
+            resource, {'name': ['bob', 'cyd', 'dee']})] == ['bob', 'cyd']
+
+    def test_cut_to_fit(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.inline_rows',
+                            '10')
+        resource = self._resource()
+        first = plugin.inline_rows(resource)[0]
+        monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.inline_bytes',
+                            str(2 * (len(json.dumps(first)) + 1)))
+        assert [r['name'] for r in plugin.inline_rows(resource)] == [
+            'ann', 'bob']
+
+    def test_embedded_in_table_views(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.inline_rows',
+                            '1')
+        resource = helpers.call_action('resource_show',
+                                       id=self._resource()['id'])
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type='dataexplorer_table_view', title='Table')
+        variables = p.get_plugin(
+            'dataexplorer_table_view').setup_template_variables(
+            {}, {'resource': resource, 'resource_view': view})
+        embedded = variables['datapackage']['resources'][0]
+        assert 'data' not in embedded
+        assert '/api/3/action/datastore_search?' in embedded['api']
+        assert [r['name'] for r in embedded['prefetch']['records']] == [
+            'ann']
+
+
+@pytest.mark.ckan_config('ckan.plugins',
+                         'datastore dataexplorer dataexplorer_chart_view')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestChartView(object):
+
+    def _embedded(self, **view):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'x', 'type': 'int'}, {'id': 'y', 'type': 'int'}],
+            records=[{'x': 1, 'y': 2}, {'x': 2, 'y': 3}])
+        resource = helpers.call_action('resource_show', id=resource['id'])
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type='dataexplorer_chart_view', title='Chart',
+            chart_type='line', group='x', chart_series='y', **view)
+        variables = p.get_plugin(
+            'dataexplorer_chart_view').setup_template_variables(
+            {}, {'resource': resource, 'resource_view': view})
+        return variables['datapackage']['resources'][0]
+
+    def test_aggregate(self):
+        embedded = self._embedded(aggregate='sum')
+        assert '/api/3/action/datastore_search?' in embedded['api']
+        assert '/api/3/action/dataexplorer_chart_aggregate?' in \
+            embedded['aggregate']['api']
+        assert embedded['aggregate']['function'] == 'sum'
+
+    def test_downsample(self):
+        embedded = self._embedded(downsample='lttb', downsample_points=100)
+        assert '/api/3/action/datastore_search?' in embedded['api']
+        assert '/api/3/action/dataexplorer_chart_downsample?' in \
+            embedded['downsample']['api']
+        assert embedded['downsample']['method'] == 'lttb'
+        assert embedded['downsample']['points'] == 100
+        assert 'points=100' in embedded['downsample']['api']
+
+    def test_sample(self):
+        embedded = self._embedded(sample='reservoir', sample_seed=3)
+        assert '/api/3/action/datastore_search?' in embedded['api']
+        assert '/api/3/action/dataexplorer_sample?' in \
+            embedded['sample']['api']
+        assert 'seed=3' in embedded['sample']['api']
+        assert embedded['sample']['method'] == 'reservoir'
+
+
+@pytest.mark.ckan_config('ckan.plugins',
+                         'datastore dataexplorer dataexplorer_map_view')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestMapView(object):
+
+    def test_lat_long(self):
+        resource = factories.Resource()
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': 'lat', 'type': 'numeric'},
+                    {'id': 'lon', 'type': 'numeric'}],
+            records=[{'lat': 1, 'lon': 2}])
+        resource = helpers.call_action('resource_show', id=resource['id'])
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type='dataexplorer_map_view', title='Map',
+            map_field_type='lat_long', latitude_field='lat',
+            longitude_field='lon')
+        variables = p.get_plugin(
+            'dataexplorer_map_view').setup_template_variables(
+            {}, {'resource': resource, 'resource_view': view})
+        embedded = variables['datapackage']['resources'][0]
+        assert '/api/3/action/datastore_search?' in embedded['api']
+        assert '/api/3/action/dataexplorer_map_data?' in \
+            embedded['map']['api']
+        assert 'latitude_field=lat' in embedded['map']['api']
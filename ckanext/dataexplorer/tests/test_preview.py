@@ -0,0 +1,231 @@
+# encoding: utf-8
+import io
+import os
+import socket
+
+import pytest
+
+from ckanext.dataexplorer import plugin, preview
+
+CSV = (u'name,n,when,ok\n'
+       u'a,1,2020-01-01,true\n'
+       u'b,2.5,2020-01-02,false\n'
+       u'c,,2020-01-03,\n').encode('utf-8')
+
+
+@pytest.fixture
+def cache_dir(tmp_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'ckanext.dataexplorer.cache_dir',
+                        str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def resolve(monkeypatch):
+    addresses = {}
+
+    def getaddrinfo(host, port, *args):
+        if host not in addresses:
+            raise socket.gaierror('unknown host')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 (address, port)) for address in addresses[host]]
+    monkeypatch.setattr(preview.socket, 'getaddrinfo', getaddrinfo)
+    return addresses
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, location=None, body=b''):
+        self.status_code = status_code
+        self.headers = {'location': location} if location else {}
+        self.is_redirect = location is not None
+        self.body = body
+        self.raw = self
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise preview.requests.HTTPError(str(self.status_code))
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    responses = {}
+    urls = []
+
+    def get(url, **kwargs):
+        assert kwargs['allow_redirects'] is False
+        urls.append(url)
+        return responses[url]
+    monkeypatch.setattr(preview.requests, 'get', get)
+    responses['urls'] = urls
+    return responses
+
+
+def _resource(**kwargs):
+    resource = {'id': 'r1', 'url': 'http://data.example.org/file.csv',
+                'format': 'CSV', 'last_modified': '2020-01-01T00:00:00'}
+    resource.update(kwargs)
+    return resource
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/file.csv',
+    'http://10.0.0.5/file.csv',
+    'http://169.254.169.254/latest/meta-data',
+    'http://[::1]/file.csv',
+    'http://[::ffff:127.0.0.1]/file.csv',
+    'http://0.0.0.0/file.csv',
+    'file:///etc/passwd',
+    'ftp://data.example.org/file.csv',
+])
+def test_check_url_refuses_internal_addresses(url):
+    with pytest.raises(preview.PreviewError):
+        preview.check_url(url)
+
+
+def test_check_url_resolves_hosts(resolve):
+    resolve['data.example.org'] = ['93.184.216.34']
+    resolve['internal.example.org'] = ['93.184.216.34', '192.168.1.1']
+    preview.check_url('https://data.example.org/file.csv')
+    with pytest.raises(preview.PreviewError):
+        preview.check_url('https://internal.example.org/file.csv')
+    preview.check_url('https://internal.example.org/file.csv',
+                      {'internal.example.org'})
+    with pytest.raises(preview.PreviewError):
+        preview.check_url('https://unknown.example.org/file.csv')
+
+
+def test_redirects_are_checked(resolve, fetched):
+    resolve['data.example.org'] = ['93.184.216.34']
+    fetched['http://data.example.org/file.csv'] = FakeResponse(
+        302, location='http://127.0.0.1/admin.csv')
+    with pytest.raises(preview.PreviewError):
+        preview.build_preview(_resource(), preview._settings())
+    assert fetched['urls'] == ['http://data.example.org/file.csv']
+
+
+def test_build_preview(resolve, fetched):
+    resolve['data.example.org'] = ['93.184.216.34']
+    fetched['http://data.example.org/file.csv'] = FakeResponse(
+        301, location='/moved.csv')
+    fetched['http://data.example.org/moved.csv'] = FakeResponse(body=CSV)
+    sample = preview.build_preview(_resource(), preview._settings())
+    assert sample['schema'] == [
+        {'name': 'name', 'type': 'string'},
+        {'name': 'n', 'type': 'number'},
+        {'name': 'when', 'type': 'date'},
+        {'name': 'ok', 'type': 'boolean'},
+    ]
+    assert sample['columns'] == [
+        [u'a', u'b', u'c'], [1.0, 2.5, None],
+        [u'2020-01-01', u'2020-01-02', u'2020-01-03'], [True, False, None]]
+    assert preview.preview_records(sample)[0] == {
+        'name': u'a', 'n': 1.0, 'when': u'2020-01-01', 'ok': True}
+
+
+@pytest.mark.parametrize('values, expected', [
+    ([u'1', u'2', u''], 'integer'),
+    ([u'1', u'2.5'], 'number'),
+    ([u'2020-01-01', u'2020-01-01T10:00:00'], 'datetime'),
+    ([u'1', u'x'], 'string'),
+    ([u'', None], 'string'),
+])
+def test_infer_type(values, expected):
+    assert preview.infer_type(values) == expected
+
+
+@pytest.fixture
+def local_file(monkeypatch):
+    files = {}
+    monkeypatch.setattr(preview, '_open',
+                        lambda resource, settings: io.BytesIO(
+                            files[resource['url']]))
+    return files
+
+
+def test_update_and_load_preview(cache_dir, local_file):
+    resource = _resource()
+    local_file[resource['url']] = CSV
+    assert preview.load_preview(resource) is None
+    assert preview.preview_state(resource) is None
+    sample = preview.update_preview(resource)
+    assert preview.load_preview(resource) == sample
+    assert preview.preview_state(resource) == 'ready'
+
+    # a new version of the file replaces the previous preview
+    newer = _resource(last_modified='2020-02-01T00:00:00')
+    local_file[newer['url']] = CSV + b'd,4,2020-01-04,true\n'
+    previous = preview._preview_path(resource, preview._settings())
+    os.utime(previous, (0, 0))
+    assert len(preview.update_preview(newer)['columns'][0]) == 4
+    assert not os.path.exists(previous)
+    assert preview.load_preview(resource) is None
+
+
+def test_cleanup_keeps_files_being_written(cache_dir, local_file):
+    resource = _resource()
+    local_file[resource['url']] = CSV
+    directory = os.path.dirname(
+        preview._preview_path(resource, preview._settings()))
+    in_progress = os.path.join(directory, 'other.tmp')
+    with open(in_progress, 'wb') as f:
+        f.write(b'')
+    os.utime(in_progress, (0, 0))
+    preview.update_preview(resource)
+    assert os.path.exists(in_progress)
+
+
+def test_failed_preview_is_recorded(cache_dir, local_file):
+    resource = _resource()
+    local_file[resource['url']] = b''
+    with pytest.raises(preview.PreviewError):
+        preview.update_preview(resource)
+    assert preview.preview_state(resource) == 'failed'
+    with pytest.raises(preview.PreviewError):
+        preview.load_preview(resource)
+
+    error = preview._error_path(
+        preview._preview_path(resource, preview._settings()))
+    expired = os.path.getmtime(error) - preview.ERROR_TTL - 1
+    os.utime(error, (expired, expired))
+    assert preview.preview_state(resource) is None
+    assert preview.load_preview(resource) is None
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+class TestAddPreview(object):
+
+    def test_missing_preview_is_queued(self, cache_dir, monkeypatch):
+        queued = []
+        monkeypatch.setattr(preview, 'enqueue_preview', queued.append)
+        monkeypatch.setattr(preview, 'build_preview', None)
+        resource = _resource()
+        plugin.add_preview(resource)
+        assert queued == ['r1']
+        assert 'schema' not in resource
+
+    def test_stored_preview_is_added(self, cache_dir, local_file):
+        resource = _resource()
+        local_file[resource['url']] = CSV
+        preview.update_preview(resource)
+        plugin.add_preview(resource)
+        assert [f['name'] for f in resource['schema']['fields']] == [
+            'name', 'n', 'when', 'ok']
+        assert len(resource['data']) == 3
+        assert resource['preview'].endswith('/dataexplorer/preview/r1.json')
+
+    def test_unreadable_cache(self, cache_dir, monkeypatch):
+        def load_preview(resource):
+            raise OSError('gone')
+        monkeypatch.setattr(preview, 'load_preview', load_preview)
+        resource = _resource()
+        plugin.add_preview(resource)
+        assert 'schema' not in resource
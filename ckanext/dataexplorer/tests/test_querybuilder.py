@@ -0,0 +1,107 @@
+# encoding: utf-8
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import querybuilder
+
+SCHEMA = [{'name': 'name', 'type': 'string'},
+          {'name': 'n', 'type': 'integer'},
+          {'name': 'odd "name"', 'type': 'string'}]
+
+
+def _conditions(where):
+    params = {}
+    return querybuilder.conditions(where, SCHEMA, params), params
+
+
+def test_comparisons_are_bound():
+    sql, params = _conditions([
+        {'field': 'n', 'op': '>=', 'value': 2},
+        {'field': 'name', 'value': "x' OR 1=1 --"}])
+    assert sql == [u'"n" >= :q0', u'"name" = :q1']
+    assert params == {'q0': 2, 'q1': "x' OR 1=1 --"}
+
+
+def test_list_and_null_operators():
+    sql, params = _conditions([
+        {'field': 'n', 'op': 'in', 'value': [1, 2]},
+        {'field': 'n', 'op': 'BETWEEN', 'value': [3, 4]},
+        {'field': 'name', 'op': 'is not null'},
+        {'field': 'n', 'op': 'ilike', 'value': '1%'}])
+    assert sql == [u'"n" IN (:q0, :q1)', u'"n" BETWEEN :q2 AND :q3',
+                   u'"name" IS NOT NULL', u'"n"::text ILIKE :q4']
+    assert params == {'q0': 1, 'q1': 2, 'q2': 3, 'q3': 4, 'q4': '1%'}
+
+
+def test_nested_groups():
+    sql, params = _conditions([{'or': [
+        {'field': 'n', 'op': '<', 'value': 1},
+        {'and': [{'field': 'n', 'op': '>', 'value': 5},
+                 {'field': 'odd "name"', 'op': '!=', 'value': 'a'}]}]}])
+    assert sql == [u'("n" < :q0 OR ("n" > :q1 AND "odd ""name""" <> :q2))']
+
+
+@pytest.mark.parametrize('where', [
+    {'field': 'n'},
+    [{'field': 'missing', 'value': 1}],
+    [{'field': 'n', 'op': 'drop table', 'value': 1}],
+    [{'field': 'n', 'value': {'a': 1}}],
+    [{'field': 'n', 'op': 'in', 'value': []}],
+    [{'field': 'n', 'op': 'between', 'value': [1]}],
+    [{'field': 'n', 'op': 'like', 'value': 1}],
+    [{'or': []}],
+    ['n = 1'],
+])
+def test_invalid_conditions(where):
+    with pytest.raises(toolkit.ValidationError):
+        _conditions(where)
+
+
+def test_too_deep():
+    condition = {'field': 'n', 'value': 1}
+    for i in range(querybuilder.MAX_DEPTH + 1):
+        condition = {'and': [condition]}
+    with pytest.raises(toolkit.ValidationError):
+        _conditions([condition])
+
+
+def test_compile_query():
+    sql, params, where, where_params, fields = querybuilder.compile_query(
+        'res', SCHEMA, {
+            'fields': ['name'],
+            'filters': {'n': [1, 2]},
+            'where': [{'field': 'name', 'op': 'like', 'value': 'a%'}],
+            'sort': 'n desc',
+            'limit': 50000,
+            'offset': 10,
+        }, 1000)
+    assert sql == (u'SELECT "_id", "name" FROM "res" WHERE "name"::text '
+                   u'LIKE :q0 AND "n" IN (:p1, :p2) ORDER BY "n" DESC, '
+                   u'"_id" LIMIT :limit OFFSET :offset')
+    assert params == {'q0': 'a%', 'p1': 1, 'p2': 2, 'limit': 1000,
+                      'offset': 10}
+    assert where == u' WHERE "name"::text LIKE :q0 AND "n" IN (:p1, :p2)'
+    assert where_params == {'q0': 'a%', 'p1': 1, 'p2': 2}
+    assert fields == ['_id', 'name']
+
+
+def test_compile_query_sort_list():
+    sql = querybuilder.compile_query('res', SCHEMA, {
+        'sort': [{'field': 'name', 'order': 'DESC'}, {'field': 'n'}]},
+        100)[0]
+    assert sql.endswith(u'ORDER BY "name" DESC, "n" ASC, "_id" '
+                        u'LIMIT :limit OFFSET :offset')
+
+
+@pytest.mark.parametrize('spec', [
+    {'fields': 'name'},
+    {'fields': ['missing']},
+    {'sort': 'missing'},
+    {'limit': -1},
+    {'offset': 'x'},
+    {'filters': ['n']},
+])
+def test_compile_invalid_spec(spec):
+    with pytest.raises(toolkit.ValidationError):
+        querybuilder.compile_query('res', SCHEMA, spec, 100)
@@ -0,0 +1,59 @@
+# encoding: utf-8
+import collections
+
+import pytest
+
+from ckanext.dataexplorer import sampling
+
+
+def test_reservoir_size_and_seed():
+    rows = list(range(1000))
+    sample = sampling.reservoir(iter(rows), 10, 42)
+    assert len(sample) == 10
+    assert len(set(sample)) == 10
+    assert set(sample) <= set(rows)
+    assert sampling.reservoir(iter(rows), 10, 42) == sample
+    assert sampling.reservoir(iter(rows), 10, 43) != sample
+
+
+def test_reservoir_fewer_rows_than_size():
+    assert sampling.reservoir(iter(range(5)), 10, 1) == [0, 1, 2, 3, 4]
+    assert sampling.reservoir(iter([]), 10, 1) == []
+
+
+def test_reservoir_is_uniform():
+    counts = collections.Counter()
+    for seed in range(2000):
+        counts.update(sampling.reservoir(iter(range(20)), 5, seed))
+    # each row is picked 2000 * 5 / 20 = 500 times on average
+    assert min(counts.values()) > 400
+    assert max(counts.values()) < 600
+
+
+@pytest.mark.parametrize('method, size, matching, table_rows, percent', [
+    # unknown table size: read whole
+    ('system', 100, None, None, None),
+    ('system', 100, 0, 0, None),
+    # 150 rows (1.5 oversampling) of 10000
+    ('system', 100, 10000, 10000, 1.5),
+    ('bernoulli', 100, 10000, 10000, 1.5),
+    # filters matching a tenth of the rows need ten times more
+    ('system', 100, 1000, 10000, 15.0),
+    # never more than max_scan
+    ('system', 5000, 5000, 100000, 5.0),
+    # reservoir reads max_scan rows
+    ('reservoir', 100, 10000, 100000, 5.0),
+    # small tables are read whole
+    ('system', 100, 120, 120, None),
+    ('reservoir', 100, 1000, 4000, None),
+])
+def test_sample_percent(method, size, matching, table_rows, percent):
+    assert sampling.sample_percent(
+        method, size, matching, table_rows, 5000) == percent
+
+
+def test_sample_fraction():
+    assert sampling.sample_fraction(100, 1000) == 0.1
+    assert sampling.sample_fraction(100, 50) == 1.0
+    assert sampling.sample_fraction(0, 0) == 1.0
+    assert sampling.sample_fraction(10, None) == 1.0
@@ -0,0 +1,132 @@
+# encoding: utf-8
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dataexplorer import tableschema
+from ckanext.dataexplorer.plugin import in_schema_fields
+from ckanext.dataexplorer.tableschema import (
+    datastore_fields_to_schema, schema_cache)
+
+
+def _package(tables):
+    dataset = factories.Dataset()
+    for fields in tables:
+        resource = factories.Resource(package_id=dataset['id'])
+        helpers.call_action(
+            'datastore_create', resource_id=resource['id'], force=True,
+            fields=[{'id': f, 'type': 'text'} for f in fields])
+    factories.Resource(package_id=dataset['id'])
+    return helpers.call_action('package_show', id=dataset['id'])
+
+
+def _count_queries(monkeypatch):
+    # catalog queries and datastore_search calls run from now on
+    calls = []
+    execute = tableschema.db.execute
+
+    def counted_execute(sql, params=None):
+        if u'pg_attribute' in sql:
+            calls.append('catalog')
+        return execute(sql, params)
+
+    get_action = toolkit.get_action
+
+    def counted_get_action(name):
+        if name == 'datastore_search':
+            calls.append(name)
+        return get_action(name)
+    monkeypatch.setattr(tableschema.db, 'execute', counted_execute)
+    monkeypatch.setattr(toolkit, 'get_action', counted_get_action)
+    schema_cache.clear()
+    return calls
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestPrefetchSchemas(object):
+
+    def test_package_schemas_read_at_once(self, monkeypatch):
+        package = _package([['a', 'b'], ['c']])
+        calls = _count_queries(monkeypatch)
+        first, second, plain = package['resources']
+        assert [f['name'] for f in datastore_fields_to_schema(
+            first, package)] == ['a', 'b']
+        assert calls == ['catalog']
+        assert [f['name'] for f in datastore_fields_to_schema(
+            second, package)] == ['c']
+        assert datastore_fields_to_schema(first, package) == [
+            {'name': 'a', 'type': 'string'}, {'name': 'b', 'type': 'string'}]
+        assert calls == ['catalog']
+        assert schema_cache.stats()['size'] == 2
+
+    def test_without_package(self, monkeypatch):
+        package = _package([['a']])
+        calls = _count_queries(monkeypatch)
+        datastore_fields_to_schema(package['resources'][0])
+        assert calls == ['datastore_search']
+
+    def test_falls_back_to_datastore_search(self, monkeypatch):
+        package = _package([['a']])
+        calls = _count_queries(monkeypatch)
+
+        def failing(resources):
+            raise tableschema.SQLAlchemyError('gone')
+        monkeypatch.setattr(tableschema, 'prefetch_schemas', failing)
+        assert [f['name'] for f in datastore_fields_to_schema(
+            package['resources'][0], package)] == ['a']
+        assert calls == ['datastore_search']
+
+
+@pytest.mark.ckan_config('ckan.plugins',
+                         'datastore dataexplorer dataexplorer_chart_view')
+@pytest.mark.usefixtures('clean_datastore', 'with_plugins',
+                         'with_request_context')
+class TestRequestSchema(object):
+
+    def test_resolved_once_per_request(self, monkeypatch):
+        resource = _package([['a']])['resources'][0]
+        calls = []
+
+        def datastore_fields_to_schema(resource, package=None):
+            calls.append(resource['id'])
+            return [{'name': 'a', 'type': 'string'}]
+        monkeypatch.setattr(tableschema, 'datastore_fields_to_schema',
+                            datastore_fields_to_schema)
+        first = tableschema.request_schema(resource)
+        assert tableschema.request_schema_by_id(resource['id']) is first
+        assert calls == [resource['id']]
+        tableschema.invalidate_schema(resource['id'])
+        tableschema.request_schema(resource)
+        assert len(calls) == 2
+
+    def test_unknown_resource(self):
+        with pytest.raises(toolkit.ObjectNotFound):
+            tableschema.request_schema_by_id('missing')
+
+    def test_in_schema_fields(self):
+        resource = _package([['a', 'b']])['resources'][0]
+        data = {('resource_id',): resource['id'], ('group',): 'b'}
+        in_schema_fields(('group',), data, {}, {})
+        data[('group',)] = 'c'
+        with pytest.raises(toolkit.Invalid):
+            in_schema_fields(('group',), data, {}, {})
+        data[('resource_id',)] = 'missing'
+        with pytest.raises(toolkit.Invalid):
+            in_schema_fields(('group',), data, {}, {})
+
+    def test_view_fields_validated(self):
+        resource = _package([['a', 'b']])['resources'][0]
+        with pytest.raises(toolkit.ValidationError) as error:
+            helpers.call_action(
+                'resource_view_create', resource_id=resource['id'],
+                view_type='dataexplorer_chart_view', title='Chart',
+                group='c')
+        assert 'group' in error.value.error_dict
+        view = helpers.call_action(
+            'resource_view_create', resource_id=resource['id'],
+            view_type='dataexplorer_chart_view', title='Chart', group='b')
+        assert view['group'] == 'b'
@@ -0,0 +1,40 @@
+# encoding: utf-8
+import pytest
+
+from ckanext.dataexplorer import warm
+from ckanext.dataexplorer.cli import dataexplorer
+
+
+@pytest.mark.parametrize('backend, shared', [
+    ('memory', False), ('none', False), ('file', True), ('redis', True)])
+def test_shared_payloads(ckan_config, monkeypatch, backend, shared):
+    monkeypatch.setitem(ckan_config,
+                        'ckanext.dataexplorer.fragment_cache.backend', backend)
+    assert warm.shared_payloads() is shared
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datastore dataexplorer')
+@pytest.mark.usefixtures('clean_db', 'with_plugins',
+                         'with_request_context')
+class TestWarmCommand(object):
+
+    def test_refuses_to_render_into_memory_cache(self, cli, tmp_path):
+        result = cli.invoke(dataexplorer, [
+            'warm', '--state-file', str(tmp_path / 'done')])
+        assert result.exit_code == 2
+        assert 'fragment_cache.backend' in result.output
+
+    def test_no_render_with_memory_cache(self, cli, tmp_path):
+        result = cli.invoke(dataexplorer, [
+            'warm', '--no-render',
+            '--state-file', str(tmp_path / 'done')])
+        assert result.exit_code == 0, result.output
+        assert 'Warmed 0 resources' in result.output
+
+    @pytest.mark.ckan_config('ckanext.dataexplorer.fragment_cache.backend',
+                             'file')
+    def test_renders_with_shared_cache(self, cli, tmp_path):
+        result = cli.invoke(dataexplorer, [
+            'warm', '--state-file', str(tmp_path / 'done')])
+        assert result.exit_code == 0, result.output
+        assert 'Warmed 0 resources' in result.output
@@ -0,0 +1,129 @@
+# encoding: utf-8
+'''
+Simplified GeoJSON tiles for geometry map views. Tiles are built from the
+DataStore table, simplified and trimmed for their zoom level, and cached
+gzipped on disk by resource revision and tile coordinates.
+'''
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from logging import getLogger
+
+from ckan.common import json
+
+from ckanext.dataexplorer import db, geo, geoindex
+from ckanext.dataexplorer.cache import cache_directory
+
+log = getLogger(__name__)
+
+MAX_ZOOM = 22
+
+
+def _hash(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+def check_tile(z, x, y):
+    '''
+    Raise ValueError unless z/x/y are valid XYZ tile coordinates.
+    '''
+    if not 0 <= z <= MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError('Invalid tile {0}/{1}/{2}'.format(z, x, y))
+
+
+def build_tile(resource_id, schema, geometry_field, filters, z, x, y):
+    '''
+    Return a FeatureCollection with the rows whose geometry intersects a
+    tile, simplified to the tile pixel size. The other fields of the row
+    become the feature properties and ``_id`` its id. With a bounding box
+    index on the geometry field only the rows overlapping the tile are
+    read.
+    '''
+    tolerance = geo.tolerance(z)
+    decimals = geo.precision(z)
+    box = geo.tile_bbox(z, x, y)
+    # one pixel margin, so features touching the tile edge are kept
+    box = (box[0] - tolerance, box[1] - tolerance,
+           box[2] + tolerance, box[3] + tolerance)
+    params = {}
+    conditions = [u'{0} IS NOT NULL'.format(db.identifier(geometry_field))]
+    if geoindex.bbox_indexed(resource_id, geometry_field):
+        conditions.append(geoindex.overlaps(geometry_field, box, params))
+    where = db.where_clause(filters, schema, params, conditions)
+    rows = db.stream(u'SELECT {0} FROM {1}{2}'.format(
+        db.select_columns(schema), db.identifier(resource_id), where),
+        params, records=True)
+    features = []
+    for row in rows:
+        geometry = geo.load_geometry(row.pop(geometry_field))
+        bbox = geometry and geo.geometry_bbox(geometry)
+        if not bbox or not geo.bbox_intersects(bbox, box):
+            continue
+        geometry = geo.simplify(geometry, tolerance, decimals)
+        if geometry is None:
+            continue
+        features.append({'type': 'Feature', 'id': row['_id'],
+                         'geometry': geometry, 'properties': row})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def gunzip(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+        return f.read()
+
+
+def tile_etag(resource, geometry_field, filters, z, x, y):
+    '''
+    Return the ETag of a tile, which changes with the resource revision.
+    '''
+    revision = db.revision_key(resource)
+    return _hash(revision, geometry_field, filters, z, x, y), revision
+
+
+def get_tile(resource, schema, geometry_field, filters, z, x, y):
+    '''
+    Return the ETag and the gzipped GeoJSON of a tile, building it and
+    storing it in the tile cache on the first request.
+    :param resource: resource dict
+    :type resource: dict
+    :param schema: table schema fields
+    :type schema: list of dicts
+    '''
+    check_tile(z, x, y)
+    etag, revision = tile_etag(resource, geometry_field, filters, z, x, y)
+    resource_dir = cache_directory('tiles', resource['id'])
+    new_revision = not os.path.isdir(os.path.join(resource_dir, revision))
+    directory = cache_directory('tiles', resource['id'], revision,
+                                _hash(geometry_field, filters),
+                                str(z), str(x))
+    path = os.path.join(directory, '{0}.geojson.gz'.format(y))
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return etag, f.read()
+
+    body = _gzip(json.dumps(
+        build_tile(resource['id'], schema, geometry_field, filters, z, x, y),
+        separators=(',', ':')).encode('utf-8'))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    os.rename(tmp, path)
+
+    if new_revision:
+        # tiles of older revisions will never be served again
+        for name in os.listdir(resource_dir):
+            if name != revision:
+                shutil.rmtree(os.path.join(resource_dir, name),
+                              ignore_errors=True)
+    return etag, body
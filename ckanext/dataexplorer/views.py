@@ -0,0 +1,279 @@
+# encoding: utf-8
+from flask import Blueprint, Response, request, stream_with_context
+
+from ckan.common import json, config
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dataexplorer import (
+    columnar, db, export, fragments, metrics, preview, query, tiles)
+from ckanext.dataexplorer.profile import load_profile, profiled_fields
+from ckanext.dataexplorer.tableschema import (
+    datastore_fields_to_schema, schema_field_to_datastore_field)
+
+dataexplorer = Blueprint(u'dataexplorer', __name__)
+
+
+def _context():
+    return {u'model': model, u'session': model.Session,
+            u'user': toolkit.g.user}
+
+
+def _resource(resource_id, auth):
+    context = _context()
+    try:
+        toolkit.check_access(auth, context,
+                             {u'resource_id': resource_id})
+        return toolkit.get_action(u'resource_show')(
+            context, {u'id': resource_id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._(u'Resource not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, toolkit._(u'Not authorized'))
+
+
+def _datastore_resource(resource_id, auth=u'dataexplorer_map_data'):
+    resource = _resource(resource_id, auth)
+    if not resource.get(u'datastore_active'):
+        return toolkit.abort(404, toolkit._(u'Resource has no DataStore'))
+    return resource
+
+
+def _filters():
+    try:
+        filters = json.loads(request.args.get(u'filters') or u'{}')
+    except ValueError:
+        filters = None
+    if not isinstance(filters, dict):
+        return toolkit.abort(400, toolkit._(u'Invalid filters'))
+    return filters
+
+
+def _where():
+    try:
+        where = json.loads(request.args.get(u'where') or u'[]')
+    except ValueError:
+        where = None
+    if not isinstance(where, list):
+        return toolkit.abort(400, toolkit._(u'Invalid where'))
+    return where
+
+
+def map_tile(resource_id, z, x, y):
+    u'''
+    Simplified GeoJSON tile of the ``geometry_field`` of a resource.
+    '''
+    resource = _datastore_resource(resource_id)
+    geometry_field = request.args.get(u'geometry_field')
+    filters = _filters()
+    schema = datastore_fields_to_schema(resource)
+    try:
+        db.check_fields([geometry_field], schema)
+        etag, body = tiles.get_tile(
+            resource, schema, geometry_field, filters, z, x, y)
+    except (toolkit.ValidationError, ValueError):
+        return toolkit.abort(400, toolkit._(u'Invalid tile request'))
+
+    gzipped = u'gzip' in request.headers.get(u'Accept-Encoding', u'')
+    response = Response(body if gzipped else tiles.gunzip(body),
+                        content_type=u'application/geo+json')
+    if gzipped:
+        response.headers[u'Content-Encoding'] = u'gzip'
+    response.headers[u'Vary'] = u'Accept-Encoding'
+    response.headers[u'Cache-Control'] = u'private, max-age={0}'.format(
+        toolkit.asint(config.get(
+            u'ckanext.dataexplorer.map.tile_max_age', 300)))
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def _natural_arg(name, default):
+    try:
+        value = int(request.args.get(name) or default)
+    except ValueError:
+        value = -1
+    if value < 0:
+        return toolkit.abort(400, toolkit._(u'Invalid {0}').format(name))
+    return value
+
+
+def data_page(resource_id, wire):
+    u'''
+    Page of rows of a resource in a column oriented wire format: ``json``
+    (one array of values per field) or ``arrow`` (Arrow IPC stream). Takes
+    the ``filters``, ``sort``, ``limit`` and ``offset`` of datastore_search.
+    '''
+    if wire not in columnar.WIRE_FORMATS:
+        return toolkit.abort(404, toolkit._(u'Unknown wire format'))
+    if wire == u'arrow' and not columnar.arrow_available():
+        return toolkit.abort(400, toolkit._(
+            u'Arrow is not available on this site'))
+    resource = _datastore_resource(resource_id, u'dataexplorer_search')
+    filters = _filters()
+    limit = _natural_arg(u'limit', 100)
+    offset = _natural_arg(u'offset', 0)
+    sort = request.args.get(u'sort')
+    include_total = toolkit.asbool(request.args.get(u'include_total', True))
+    try:
+        page = query.run(
+            resource_id, db.resource_revision(resource), u'page',
+            [filters, sort, limit, offset, include_total],
+            lambda: columnar.read_page(
+                resource_id, datastore_fields_to_schema(resource), filters,
+                sort, limit, offset, include_total))
+    except toolkit.ValidationError:
+        return toolkit.abort(400, toolkit._(u'Invalid data request'))
+    body = (columnar.arrow_ipc(page) if wire == u'arrow'
+            else columnar.columns_json(page))
+    return Response(body, content_type=columnar.WIRE_FORMATS[wire])
+
+
+def preview_data(resource_id):
+    u'''
+    Preview of a CSV, TSV, XLS or XLSX resource that is not in the
+    DataStore: its inferred fields and the first rows of the file, one
+    array of values per field in ``columns``.
+    '''
+    resource = _resource(resource_id, u'dataexplorer_preview')
+    try:
+        sample = preview.load_preview(resource)
+    except preview.PreviewError as e:
+        return toolkit.abort(404, toolkit._(u'No preview: {0}').format(e))
+    if sample is None:
+        preview.enqueue_preview(resource_id)
+        return toolkit.abort(404, toolkit._(u'The preview is being built'))
+    return Response(json.dumps({u'success': True, u'result': {
+        u'resource_id': resource_id,
+        u'fields': [schema_field_to_datastore_field(f)
+                    for f in sample[u'schema']],
+        u'columns': sample[u'columns'],
+    }}, separators=(u',', u':')), content_type=u'application/json')
+
+
+def _described_fields(resource):
+    # schema fields with the profile stats and the DataStore data
+    # dictionary label and description of their column
+    fields = profiled_fields(datastore_fields_to_schema(resource),
+                             load_profile(resource))
+    info = dict(
+        (f[u'id'], f.get(u'info') or {})
+        for f in toolkit.get_action(u'datastore_search')(_context(), {
+            u'resource_id': resource[u'id'], u'limit': 0})[u'fields'])
+    described = []
+    for f in fields:
+        f = dict(f)
+        field_info = info.get(f[u'name'], {})
+        if field_info.get(u'label'):
+            f[u'title'] = field_info[u'label']
+        if field_info.get(u'notes'):
+            f[u'description'] = field_info[u'notes']
+        described.append(f)
+    return described
+
+
+def resource_metadata(resource_id):
+    u'''
+    Full metadata of a resource for the views embedding a compact payload:
+    the resource dict and its schema fields with their profile stats,
+    labels and descriptions. Sent with an ETag of the resource revision.
+    '''
+    resource = _resource(resource_id, u'dataexplorer_metadata')
+    etag = fragments.fragment_key({u'metadata': resource_id}, resource)
+    if etag in request.if_none_match:
+        response = Response(u'', 304)
+        response.set_etag(etag)
+        return response
+
+    result = dict(resource)
+    if resource.get(u'datastore_active'):
+        result[u'schema'] = {u'fields': _described_fields(resource)}
+    elif preview.preview_format(resource):
+        try:
+            sample = preview.load_preview(resource)
+        except preview.PreviewError:
+            sample = None
+        if sample is not None:
+            result[u'schema'] = {u'fields': sample[u'schema']}
+    package = toolkit.get_action(u'package_show')(
+        _context(), {u'id': resource[u'package_id']})
+    response = Response(
+        fragments.dumps({u'success': True, u'result': result}),
+        content_type=u'application/json')
+    response.set_etag(etag)
+    response.headers[u'Cache-Control'] = u'{0}, max-age={1}'.format(
+        u'private' if package.get(u'private') else u'public',
+        toolkit.asint(config.get(
+            u'ckanext.dataexplorer.metadata.max_age', 300)))
+    return response
+
+
+def export_rows(resource_id, output):
+    u'''
+    Stream the rows of a resource matching ``filters`` and the query
+    builder ``where`` conditions as CSV, NDJSON or Parquet, gzipped when
+    the client accepts it (CSV and NDJSON only, Parquet pages are
+    compressed already).
+    '''
+    if output not in export.FORMATS:
+        return toolkit.abort(404, toolkit._(u'Unknown export format'))
+    if output == u'parquet' and not export.parquet_available():
+        return toolkit.abort(400, toolkit._(
+            u'Parquet export is not available on this site'))
+    resource = _datastore_resource(resource_id, u'dataexplorer_export')
+    filters = _filters()
+    fields = [f for f in request.args.get(u'fields', u'').split(u',') if f]
+    limit = _natural_arg(u'limit', 0)
+    try:
+        chunks = export.export_chunks(
+            output, resource_id, datastore_fields_to_schema(resource),
+            fields, filters, request.args.get(u'sort'), limit, _where())
+    except toolkit.ValidationError:
+        return toolkit.abort(400, toolkit._(u'Invalid export request'))
+
+    gzipped = (output != u'parquet' and
+               u'gzip' in request.headers.get(u'Accept-Encoding', u''))
+    if gzipped:
+        chunks = export.gzip_chunks(chunks)
+    response = Response(stream_with_context(chunks),
+                        content_type=export.FORMATS[output])
+    if gzipped:
+        response.headers[u'Content-Encoding'] = u'gzip'
+    response.headers[u'Vary'] = u'Accept-Encoding'
+    response.headers[u'Content-Disposition'] = (
+        u'attachment; filename="{0}.{1}"'.format(resource_id, output))
+    return response
+
+
+def metrics_text():
+    u'''
+    Rendering metrics of this process in the Prometheus text format, for
+    sysadmins or scrapers sending ``ckanext.dataexplorer.metrics.token``
+    as bearer token.
+    '''
+    token = config.get(u'ckanext.dataexplorer.metrics.token')
+    if not (token and request.headers.get(u'Authorization') ==
+            u'Bearer ' + token):
+        try:
+            toolkit.check_access(u'dataexplorer_metrics', _context(), {})
+        except toolkit.NotAuthorized:
+            return toolkit.abort(403, toolkit._(u'Not authorized'))
+    return Response(metrics.prometheus_text(),
+                    content_type=u'text/plain; version=0.0.4')
+
+
+dataexplorer.add_url_rule(
+    u'/dataexplorer/data/<resource_id>.<wire>', view_func=data_page)
+dataexplorer.add_url_rule(u'/dataexplorer/metrics', view_func=metrics_text)
+dataexplorer.add_url_rule(
+    u'/dataexplorer/metadata/<resource_id>.json', view_func=resource_metadata)
+dataexplorer.add_url_rule(
+    u'/dataexplorer/preview/<resource_id>.json', view_func=preview_data)
+dataexplorer.add_url_rule(
+    u'/dataexplorer/export/<resource_id>.<output>', view_func=export_rows)
+dataexplorer.add_url_rule(
+    u'/dataexplorer/tiles/<resource_id>/<int:z>/<int:x>/<int:y>.geojson',
+    view_func=map_tile)
+
+
+def get_blueprints():
+    return [dataexplorer]
@@ -0,0 +1,144 @@
+# encoding: utf-8
+'''
+Pre-warming of the resources with dataexplorer views after a deploy or a
+restart: table schemas, the first page of rows (which also loads the table
+into the PostgreSQL buffers) and the rendered payload of every view.
+
+The schema and query caches live in the memory of each process, only the
+PostgreSQL buffers, the on-disk caches (file previews) and a ``file`` or
+``redis`` fragment cache are shared with the web workers, so the payloads
+are only rendered with one of those backends.
+'''
+import io
+import os
+import threading
+import time
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckan.common import config
+
+from ckanext.dataexplorer import indexes, preview
+from ckanext.dataexplorer.cache import cache_directory
+
+
+SHARED_BACKENDS = ['file', 'redis']
+
+
+def shared_payloads():
+    '''
+    Return whether the view payloads rendered here reach the web workers,
+    which needs a ``file`` or ``redis`` fragment cache.
+    '''
+    return config.get('ckanext.dataexplorer.fragment_cache.backend',
+                      'memory') in SHARED_BACKENDS
+
+
+def resources_to_warm():
+    '''
+    Return ``{resource_id: [view ids]}`` for every resource with a
+    dataexplorer view.
+    '''
+    views = {}
+    for view in indexes.dataexplorer_views():
+        views.setdefault(view.resource_id, []).append(view.id)
+    return views
+
+
+class RateLimiter(object):
+    '''
+    Shared by the worker threads, lets at most ``rate`` calls a second go.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Progress(object):
+    '''
+    Resource ids already warmed, appended to a file as they are done so an
+    interrupted run can resume where it stopped.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_directory('warm'), 'done')
+        self.lock = threading.Lock()
+
+    def done(self):
+        try:
+            with io.open(self.path, encoding='utf-8') as f:
+                return set(line.strip() for line in f if line.strip())
+        except (IOError, OSError):
+            return set()
+
+    def add(self, resource_id):
+        with self.lock:
+            with io.open(self.path, 'a', encoding='utf-8') as f:
+                f.write(resource_id + u'\n')
+
+    def reset(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def warm_resource(context, resource_id, view_ids, page_size=100,
+                  render=True):
+    '''
+    Warm the table schema, the first page of rows and, when ``render`` is
+    set, the payload of the given views of a resource. Returns the number
+    of views rendered.
+    '''
+    from ckan.lib.datapreview import get_view_plugin
+    from ckanext.dataexplorer.tableschema import datastore_fields_to_schema
+
+    try:
+        resource = toolkit.get_action('resource_show')(
+            dict(context), {'id': resource_id})
+        package = toolkit.get_action('package_show')(
+            dict(context), {'id': resource['package_id']})
+        if resource.get('datastore_active'):
+            datastore_fields_to_schema(resource, package)
+            toolkit.get_action('datastore_search')(dict(context), {
+                'resource_id': resource_id,
+                'limit': page_size,
+            })
+        elif preview.preview_format(resource):
+            # rendering views only queues the preview jobs
+            try:
+                preview.update_preview(resource)
+            except preview.PreviewError:
+                pass
+        if not render:
+            return 0
+        rendered = 0
+        for view_id in view_ids:
+            resource_view = toolkit.get_action('resource_view_show')(
+                dict(context), {'id': view_id})
+            view_plugin = get_view_plugin(resource_view['view_type'])
+            if view_plugin is None:
+                continue
+            # views update the resource dict they are given
+            view_plugin.setup_template_variables(dict(context), {
+                'resource': dict(resource),
+                'resource_view': resource_view,
+                'package': package,
+            })
+            rendered += 1
+        return rendered
+    finally:
+        # worker threads each have their own scoped session
+        model.Session.remove()
@@ -80,6 +80,7 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points='''
         [ckan.plugins]
+        dataexplorer=ckanext.dataexplorer.plugin:DataExplorerPlugin
         dataexplorer_view=ckanext.dataexplorer.plugin:DataExplorerView
         dataexplorer_table_view=ckanext.dataexplorer.plugin:DataExplorerTableView
         dataexplorer_chart_view=ckanext.dataexplorer.plugin:DataExplorerChartView